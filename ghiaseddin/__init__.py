@@ -1,9 +1,15 @@
 from extractors import VGG16, GoogLeNet
+import extractors
 import utils
 import settings
-from datasets import Zappos50K1, Zappos50K2, LFW10, OSR, PubFig
-from ranker import Ghiaseddin
+import shards
+import features
+import bundle
+import checkpoints
+from datasets import Zappos50K1, Zappos50K2, LFW10, OSR, PubFig, MultiAttributeDataset
+from ranker import Ghiaseddin, MultiAttributeGhiaseddin
+from session import Session
 
 
 __version__ = "0.1"
-__all__ = ["VGG16", "Ghiaseddin", "GoogLeNet", "Zappos50K1", "Zappos50K2", "LFW10", "settings", "utils", "OSR", "PubFig"]
+__all__ = ["VGG16", "Ghiaseddin", "MultiAttributeGhiaseddin", "MultiAttributeDataset", "Session", "GoogLeNet", "Zappos50K1", "Zappos50K2", "LFW10", "settings", "utils", "extractors", "shards", "features", "bundle", "checkpoints", "OSR", "PubFig"]
@@ -0,0 +1,86 @@
+import numpy as np
+
+
+class BatchAugmentation(object):
+    """
+    Applies random flips, zooms and rotations to a whole batch of images at once.
+
+    The images are a (N x H x W x C) uint8 batch which is already resized to the input size of the network. Each image gets its own
+    random parameters, drawn from the same distributions as `utils.random_augmentation`, and the whole batch is then warped with a single
+    vectorized gather. The pixel grid of the images is precomputed, the per sample affine matrices turn it into gather indices with
+    nearest neighbour interpolation and `nearest` fill mode, like `keras_image_preprocessing.apply_transform`.
+    """
+    ZOOM_RANGE = (0.65, 0.6)
+    ROTATION_RANGE = 20
+
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
+        rows, cols = np.mgrid[0:height, 0:width]
+        self._grid = np.array([rows.ravel(), cols.ravel(), np.ones(height * width)], dtype=np.float64)
+        self._center = np.array([float(height) / 2 + 0.5, float(width) / 2 + 0.5])
+
+    def random_parameters(self, n):
+        """
+        Draws the random parameters of `n` samples.
+        Returns:
+            (flips, zooms, thetas) -- a (n) bool array, a (n x 2) array of zoom factors and a (n) array of rotation angles in radians
+        """
+        flips = np.random.rand(n) > 0.5
+        zooms = np.random.uniform(self.ZOOM_RANGE[0], self.ZOOM_RANGE[1], (n, 2))
+        thetas = np.pi / 180 * np.random.uniform(-self.ROTATION_RANGE, self.ROTATION_RANGE, n)
+        return flips, zooms, thetas
+
+    def matrices(self, flips, zooms, thetas):
+        """
+        Returns the (n x 3 x 3) affine matrices, mapping output (row, col, 1) coordinates to input coordinates, for the parameters.
+        The flip is applied first, then the zoom and then the rotation, the zoom and the rotation are around the image center.
+        """
+        n = len(flips)
+        cos = np.cos(thetas)
+        sin = np.sin(thetas)
+
+        # (zoom . rotation) without the offsets
+        linear = np.zeros((n, 2, 2))
+        linear[:, 0, 0] = zooms[:, 0] * cos
+        linear[:, 0, 1] = -zooms[:, 0] * sin
+        linear[:, 1, 0] = zooms[:, 1] * sin
+        linear[:, 1, 1] = zooms[:, 1] * cos
+
+        matrices = np.zeros((n, 3, 3))
+        matrices[:, :2, :2] = linear
+        matrices[:, :2, 2] = self._center - np.einsum('nij,j->ni', linear, self._center)
+        matrices[:, 2, 2] = 1
+
+        # the flip maps col to (width - 1 - col) in the original image
+        matrices[flips, 1, :] = -matrices[flips, 1, :]
+        matrices[flips, 1, 2] += self.width - 1
+        return matrices
+
+    def gather_indices(self, matrices):
+        """
+        Returns the (n x H*W) indices of the source pixel of every output pixel, into the batch flattened to (N*H*W x C).
+        """
+        coords = np.einsum('nij,jk->nik', matrices[:, :2, :], self._grid)
+        rows = np.clip(np.rint(coords[:, 0, :]), 0, self.height - 1).astype(np.intp)
+        cols = np.clip(np.rint(coords[:, 1, :]), 0, self.width - 1).astype(np.intp)
+        offsets = np.arange(len(matrices), dtype=np.intp)[:, np.newaxis] * (self.height * self.width)
+        return rows * self.width + cols + offsets
+
+    def __call__(self, batch, parameters=None, out=None):
+        """
+        Augments the (N x H x W x C) `batch`, with `parameters` as returned by `random_parameters` or new random ones.
+        If `out` is given, the result is written to it, it must be C contiguous and not the same array as `batch`.
+        """
+        n, h, w, c = batch.shape
+        assert (h, w) == (self.height, self.width)
+        if parameters is None:
+            parameters = self.random_parameters(n)
+
+        indices = self.gather_indices(self.matrices(*parameters))
+        flat = batch.reshape(n * h * w, c)
+        if out is None:
+            out = np.empty_like(batch)
+        assert out.flags.c_contiguous
+        np.take(flat, indices.ravel(), axis=0, out=out.reshape(n * h * w, c))
+        return out
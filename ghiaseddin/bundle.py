@@ -0,0 +1,154 @@
+"""
+Inference bundles: the rankers of several attributes on the same extractor, stacked into one output layer and saved in one file, so
+all the attribute scores of an image come from one forward pass of the extractor.
+
+A bundle is an `.npz` file with:
+    - `extractor`: the name of the extractor class.
+    - `attributes`: the name of each attribute, in the order of the columns of `W`.
+    - `W` and `b`: the (feature dim x attributes) weights and (attributes) biases of the stacked rankers.
+    - `weights_hash`: the md5 hash of the weights file of the extractor, or '' if it is not known.
+    - `num_extractor_params` and `extractor_param_<i>`: the parameter values of the extractor, if they are included in the bundle.
+Without the extractor parameters the bundle is only valid for the extractor built from the weights file with `weights_hash`.
+
+The rankers can only be stacked if they are on the same extractor parameters: frozen extractors (the baselines), or the shared
+extractor of a `MultiAttributeGhiaseddin`. Fine-tuned models of separate attributes each have their own extractor and can not be
+bundled.
+
+Example Usage:
+>>> bundle.bundle_from_models([model_0, model_1, model_2, model_3], 'zappos1.npz')
+>>> predictor = bundle.RankPredictor(VGG16(settings.vgg16_weights), 'zappos1.npz')
+>>> scores = predictor.predict(image_addresses)  # (images x attributes)
+"""
+import numpy as np
+import theano
+import theano.tensor as T
+import lasagne
+import features
+import checkpoints
+
+
+def _save_bundle(path, extractor, attribute_names, W, b, extractor_values=None):
+    weights_hash = features.weights_hash(extractor.weights) if extractor.weights is not None else ''
+    arrays = {'extractor': np.array(extractor.__class__.__name__),
+              'attributes': np.array(attribute_names),
+              'W': np.asarray(W, dtype=np.float32),
+              'b': np.asarray(b, dtype=np.float32),
+              'weights_hash': np.array(weights_hash),
+              'num_extractor_params': np.array(0 if extractor_values is None else len(extractor_values))}
+    if extractor_values is not None:
+        for i, value in enumerate(extractor_values):
+            arrays['extractor_param_%d' % i] = value
+    np.savez(path, **arrays)
+
+
+def _same_values(values, other_values):
+    return len(values) == len(other_values) and all(np.array_equal(v, o) for v, o in zip(values, other_values))
+
+
+def bundle_from_models(models, path, include_extractor=True):
+    """
+    Saves the rankers of `models` into the bundle at `path`. `models` is a list of `Ghiaseddin`s (e.g. one per attribute, loaded with
+    `load`) on the same extractor parameters, or a single `MultiAttributeGhiaseddin`.
+    With `include_extractor` the extractor parameters are saved in the bundle too.
+    """
+    if not isinstance(models, (list, tuple)):
+        models = [models]
+
+    extractor_values = lasagne.layers.get_all_param_values(models[0].extractor_layer)
+    attribute_names = []
+    Ws = []
+    bs = []
+    for model in models:
+        if not _same_values(extractor_values, lasagne.layers.get_all_param_values(model.extractor_layer)):
+            raise Exception("The models do not have the same extractor parameters, only rankers on a shared or frozen extractor can "
+                            "be bundled")
+        if hasattr(model, 'rank_heads'):
+            heads = model.rank_heads
+            attribute_names.extend(model.dataset._ATT_NAMES)
+        else:
+            heads = [model.absolute_rank_estimate]
+            attribute_names.append(model.dataset._ATT_NAMES[model.dataset.attribute_index])
+        for head in heads:
+            Ws.append(head.W.get_value())
+            bs.append(head.b.get_value())
+
+    _save_bundle(path, models[0].extractor, attribute_names, np.concatenate(Ws, axis=1), np.concatenate(bs),
+                 extractor_values if include_extractor else None)
+
+
+def bundle_from_files(extractor, model_paths, attribute_names, path, include_extractor=True):
+    """
+    Same as `bundle_from_models`, but reads the rankers from files saved with `Ghiaseddin.save` (in either format of `checkpoints`),
+    without building the models.
+    The models must have been trained on `extractor` with its single dense ranker (the parameters in each file are the parameters of
+    the extractor followed by the weights and the bias of the ranker).
+    """
+    assert len(model_paths) == len(attribute_names)
+    num_extractor_params = len(lasagne.layers.get_all_params(extractor.get_output_layer()))
+
+    extractor_values = None
+    Ws = []
+    bs = []
+    for model_path in model_paths:
+        values = checkpoints.load_checkpoint(model_path, extractor)
+        if len(values) != num_extractor_params + 2:
+            raise Exception("%s is not a model of %s with a single dense ranker" % (model_path, extractor.__class__.__name__))
+        if extractor_values is None:
+            extractor_values = values[:num_extractor_params]
+        elif not _same_values(extractor_values, values[:num_extractor_params]):
+            raise Exception("%s does not have the same extractor parameters as the other models" % model_path)
+        Ws.append(values[-2])
+        bs.append(values[-1])
+
+    _save_bundle(path, extractor, attribute_names, np.concatenate(Ws, axis=1), np.concatenate(bs),
+                 extractor_values if include_extractor else None)
+
+
+class RankPredictor(object):
+    """
+    Scores images on all the attributes of a bundle with one forward pass of `extractor`, which must be of the same class as the one the
+    bundle was made with. If the bundle has the extractor parameters, they are set on `extractor`, so a bundle with the extractor
+    parameters needs an extractor of its own, not the extractor of a model which is still used.
+    The input variable of `extractor` is only replaced while the scoring function is compiled, and restored afterwards.
+    """
+
+    def __init__(self, extractor, path, batch_size=32):
+        self.extractor = extractor
+        self.batch_size = batch_size
+        with np.load(path) as data:
+            if str(data['extractor']) != extractor.__class__.__name__:
+                raise Exception("The bundle is for %s, not %s" % (data['extractor'], extractor.__class__.__name__))
+            self.attributes = [str(name) for name in data['attributes']]
+            W = data['W']
+            b = data['b']
+            weights_hash = str(data['weights_hash'])
+            extractor_values = [data['extractor_param_%d' % i] for i in range(int(data['num_extractor_params']))]
+
+        if extractor_values:
+            lasagne.layers.set_all_param_values(extractor.get_output_layer(), extractor_values)
+        elif weights_hash and (extractor.weights is None or features.weights_hash(extractor.weights) != weights_hash):
+            raise Exception("The bundle does not include the extractor parameters and the extractor is not built from the same weights")
+
+        input_layer = extractor.net[extractor.INPUT_LAYER_NAME]
+        previous_input = (input_layer.input_var, input_layer.shape)
+        self.input_var = T.ftensor4('inputs')
+        extractor.set_input_var(self.input_var)
+        try:
+            self.scores_layer = lasagne.layers.DenseLayer(extractor.get_output_layer(), num_units=len(self.attributes), W=W, b=b,
+                                                          nonlinearity=lasagne.nonlinearities.linear)
+            self.scores_function = theano.function(
+                [self.input_var], lasagne.layers.get_output(self.scores_layer, deterministic=True))
+        finally:
+            # the compiled function does not depend on it any more, and a model may still be using the extractor with its own
+            input_layer.input_var, input_layer.shape = previous_input
+        self._input_buffer = np.zeros((batch_size, 3, extractor._input_height, extractor._input_width), dtype=np.float32)
+
+    def predict(self, image_addresses):
+        """
+        Returns the (images x attributes) absolute rank estimates of the images at `image_addresses`.
+        """
+        scores = np.zeros((len(image_addresses), len(self.attributes)), dtype=np.float32)
+        for start in range(0, len(image_addresses), self.batch_size):
+            chunk = image_addresses[start:(start + self.batch_size)]
+            scores[start:(start + len(chunk))] = self.scores_function(self.extractor.preprocess_images(chunk, out=self._input_buffer))
+        return scores
@@ -0,0 +1,85 @@
+"""
+Model checkpoints which only store the parameters that differ from the pretrained weights of the extractor, so the checkpoint of a
+model on a frozen extractor (e.g. the baselines) is only its ranker, and a model fine-tuned above a cut layer only stores the layers
+above the cut. The other parameters are read back from the weights file of the extractor when the checkpoint is loaded.
+
+A checkpoint is an `.npz` file with:
+    - `weights_hash`: the md5 hash of the weights file of the extractor.
+    - `num_params`: the number of parameters of the model.
+    - `param_<i>`: the value of the i-th parameter (in the order of `lasagne.layers.get_all_params`), only for the parameters which
+      are not the same as the pretrained value.
+Checkpoints with all the parameter values in `params` (the only format before, and still written with `full=True` or for an extractor
+without a weights file) are read as well.
+
+The pretrained values are the first values under 'param values' of the weights file, which is how the extractors set their weights.
+"""
+import os
+import hashlib
+import numpy as np
+import lasagne
+import features
+
+# the hashes of the pretrained values, per weights file and number of extractor parameters
+_pretrained_hashes = {}
+
+
+def _pretrained_values(extractor):
+    values = extractor._get_weights_from_file(extractor.weights, 'param values')
+    return values[:len(lasagne.layers.get_all_params(extractor.get_output_layer()))]
+
+
+def _value_hash(value):
+    value = np.ascontiguousarray(value)
+    return value.dtype.str, value.shape, hashlib.md5(value.data).hexdigest()
+
+
+def _pretrained_value_hashes(extractor):
+    """
+    Returns the hashes (`_value_hash`) of the pretrained values of `extractor`, which are remembered as long as the weights file does not
+    change, so saving checkpoints in a loop only reads the weights file once.
+    """
+    stat = os.stat(extractor.weights)
+    num_params = len(lasagne.layers.get_all_params(extractor.get_output_layer()))
+    key = (os.path.abspath(extractor.weights), stat.st_size, stat.st_mtime, num_params)
+    if key not in _pretrained_hashes:
+        _pretrained_hashes[key] = [_value_hash(value) for value in _pretrained_values(extractor)]
+    return _pretrained_hashes[key]
+
+
+def save_checkpoint(path, values, extractor, full=False):
+    """
+    Saves the parameter `values` of a model on `extractor` to `path`, without the extractor parameters which still have their
+    pretrained values unless `full` is set.
+    """
+    if full or extractor.weights is None:
+        np.savez(path, params=values)
+        return
+
+    pretrained = _pretrained_value_hashes(extractor)
+    arrays = {'weights_hash': np.array(features.weights_hash(extractor.weights)),
+              'num_params': np.array(len(values))}
+    for i, value in enumerate(values):
+        if i >= len(pretrained) or _value_hash(value) != pretrained[i]:
+            arrays['param_%d' % i] = value
+    np.savez(path, **arrays)
+
+
+def load_checkpoint(path, extractor):
+    """
+    Returns the parameter values of the checkpoint at `path` of a model on `extractor`, with the parameters which are not stored in the
+    checkpoint read from the weights file of `extractor`.
+    """
+    with np.load(path, allow_pickle=True) as data:
+        if 'params' in data.files:
+            return list(data['params'])
+        weights_hash = str(data['weights_hash'])
+        num_params = int(data['num_params'])
+        stored = dict((i, data['param_%d' % i]) for i in range(num_params) if 'param_%d' % i in data.files)
+
+    if len(stored) == num_params:
+        return [stored[i] for i in range(num_params)]
+    if extractor.weights is None or features.weights_hash(extractor.weights) != weights_hash:
+        raise Exception("%s only has the parameters which differ from the pretrained weights, the extractor must be built from the "
+                        "same weights file" % path)
+    pretrained = _pretrained_values(extractor)
+    return [stored[i] if i in stored else pretrained[i] for i in range(num_params)]
@@ -2,12 +2,187 @@ import scipy.io
 import os
 import matplotlib.pylab as plt
 import utils
+import indexes
 import numpy as np
 import itertools
+import collections
 import boltons.iterutils
 import keras_image_preprocessing
 
 
+class PairBatch(collections.namedtuple('PairBatch', ['pair_ids', 'left', 'right', 'targets', 'mask'])):
+    """
+    A minibatch of pairs as arrays of length `batch_size`, yielded by `Dataset.train_batches` and `Dataset.test_batches`:
+        - pair_ids: the index of each pair in the training (testing) pairs
+        - left, right: the index of the first and the second image of each pair in `_image_addresses`
+        - targets: the target posterior of each pair (float32)
+        - mask: 1 for the pairs and 0 for the padding at the end of the last batch (int8), the padding has a pair id of -1 and image 0
+    """
+    __slots__ = ()
+
+
+class ImageBatch(collections.namedtuple('ImageBatch', ['image_ids', 'labels', 'mask'])):
+    """
+    A minibatch of training images with their labels as arrays of length `batch_size`, yielded by `Dataset.train_image_batches`:
+        - image_ids: the index of each image in `_image_addresses`
+        - labels: the label of each image for the attribute (float32), negative for unlabeled images
+        - mask: 1 for the images and 0 for the padding at the end of the last batch (int8), the padding has an image id of 0
+    """
+    __slots__ = ()
+
+
+class LazyPermutation(object):
+    """
+    A random permutation of `range(n)` which is computed on demand instead of being stored.
+
+    The permutation is a Feistel network over the smallest even power of two at least as large as `n`, values which fall outside of
+    `range(n)` are encrypted again until they fall inside (cycle walking), which keeps it a bijection on `range(n)`.
+    Items can be looked up one by one, with an array of positions or with a slice, e.g. `perm[1000:2000]`.
+    """
+    _ROUNDS = 4
+
+    def __init__(self, n, random_state=None):
+        if random_state is None:
+            random_state = np.random
+        self.n = n
+        self._half_bits = max(1, int(np.ceil(np.log2(max(n, 2)) / 2.0)))
+        self._mask = np.uint64((1 << self._half_bits) - 1)
+        self._keys = random_state.randint(0, 2 ** 31 - 1, size=self._ROUNDS).astype(np.uint64)
+
+    def __len__(self):
+        return self.n
+
+    def _round_function(self, right, key):
+        # a cheap integer hash, only needs to mix the bits of `right` well
+        h = (right + key) * np.uint64(0x9E3779B97F4A7C15)
+        h ^= h >> np.uint64(29)
+        h *= np.uint64(0xBF58476D1CE4E5B9)
+        h ^= h >> np.uint64(32)
+        return h & self._mask
+
+    def _encrypt(self, x):
+        bits = np.uint64(self._half_bits)
+        left = x >> bits
+        right = x & self._mask
+        for key in self._keys:
+            left, right = right, left ^ self._round_function(right, key)
+        return (left << bits) | right
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            key = np.arange(*key.indices(self.n))
+        scalar = np.ndim(key) == 0
+        positions = np.atleast_1d(np.asarray(key, dtype=np.int64))
+        assert np.all((0 <= positions) & (positions < self.n)), "index out of range"
+
+        with np.errstate(over='ignore'):
+            values = self._encrypt(positions.astype(np.uint64))
+            outside = values >= self.n
+            while np.any(outside):
+                values[outside] = self._encrypt(values[outside])
+                outside = values >= self.n
+        values = values.astype(np.int64)
+        return values[0] if scalar else values
+
+
+class AllPairs(object):
+    """
+    A lazy replacement for the (n x 2) pairs array when the pairs are all the pairs of a set of images with per image labels
+    (OSR and PubFig), without materializing the O(n^2) pairs.
+
+    The k-th pair is the same as the k-th item of `itertools.combinations(image_ids, 2)`, it is found from k with triangular number
+    arithmetic. It can be indexed like the pairs array, e.g. `pairs[k, :]`, `pairs[k, 0]`, `pairs[ks]` or `pairs[1000:2000]`, and
+    `targets` can be indexed like the targets array, computing the targets from `labels` on the fly.
+    """
+
+    def __init__(self, image_ids, labels):
+        self.image_ids = np.asarray(image_ids)
+        self.labels = np.asarray(labels)
+        assert len(self.image_ids) == len(self.labels)
+        self._n = len(self.image_ids)
+        self.targets = _AllPairsTargets(self)
+
+    def __len__(self):
+        return self._n * (self._n - 1) // 2
+
+    @property
+    def shape(self):
+        return (len(self), 2)
+
+    def _pairs_before_row(self, i):
+        # number of pairs with a first item before i: (n - 1) + (n - 2) + ... + (n - i)
+        return i * (2 * self._n - i - 1) // 2
+
+    def _positions(self, pair_ids):
+        """
+        Returns the positions (i, j), i < j, inside `image_ids` of the two images of each pair in `pair_ids`.
+        """
+        pair_ids = np.asarray(pair_ids, dtype=np.int64)
+        pair_ids = np.where(pair_ids < 0, pair_ids + len(self), pair_ids)
+        assert np.all((0 <= pair_ids) & (pair_ids < len(self))), "index out of range"
+
+        # solve _pairs_before_row(i) <= k for the largest i, then fix any floating point error
+        b = 2 * self._n - 1
+        i = np.floor((b - np.sqrt(np.maximum(b * b - 8.0 * pair_ids, 0))) / 2).astype(np.int64)
+        i = np.clip(i, 0, self._n - 2)
+        i -= self._pairs_before_row(i) > pair_ids
+        i += self._pairs_before_row(i + 1) <= pair_ids
+        j = pair_ids - self._pairs_before_row(i) + i + 1
+        return i, j
+
+    def pair_ids(self, i, j):
+        """
+        The inverse of `_positions`: returns the id of the pair of the images at positions i < j of `image_ids`.
+        """
+        i = np.asarray(i, dtype=np.int64)
+        return self._pairs_before_row(i) + np.asarray(j, dtype=np.int64) - i - 1
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows, cols = key
+            return self[rows][..., cols]
+        if isinstance(key, slice):
+            key = np.arange(*key.indices(len(self)))
+        i, j = self._positions(key)
+        return np.stack([self.image_ids[i], self.image_ids[j]], axis=-1)
+
+    def __array__(self, dtype=None):
+        pairs = self[:]
+        return pairs if dtype is None else pairs.astype(dtype)
+
+    def take_targets(self, key):
+        if isinstance(key, slice):
+            key = np.arange(*key.indices(len(self)))
+        i, j = self._positions(key)
+        li = self.labels[i]
+        lj = self.labels[j]
+        return ((li == lj) * 0.5 + (li > lj) * 1.0).astype(np.float32)
+
+    def permutation(self, seed=None):
+        """
+        Returns a `LazyPermutation` of the pair ids, seeded with `seed` or with numpy's global random state when it is `None`.
+        """
+        random_state = np.random.RandomState(seed) if seed is not None else None
+        return LazyPermutation(len(self), random_state)
+
+
+class _AllPairsTargets(object):
+    """The targets array of `AllPairs`."""
+
+    def __init__(self, pairs):
+        self._pairs = pairs
+
+    def __len__(self):
+        return len(self._pairs)
+
+    def __getitem__(self, key):
+        return self._pairs.take_targets(key)
+
+    def __array__(self, dtype=None):
+        targets = self[:]
+        return targets if dtype is None else targets.astype(dtype)
+
+
 class Dataset(object):
     """
     Base class for a dataset helper. Implements functionality while subclasses will focus on loading
@@ -17,14 +192,22 @@ class Dataset(object):
         1. _ATT_NAMES: It is a 1 dimensional list or list-like object, containing string names for the attributes in the dataset.
         2. _image_addresses: It is a 1 dimensional list or list-like object, containing absolute image address for each image in the dataset.
         3. _train_pairs: It is a (n x 2) array where n in the number of training pairs and they contain index of the images as the image
-        address is specified with that index in _image_addresses.
+        address is specified with that index in _image_addresses. An `AllPairs` object can be used instead of the array.
         4. _train_targets: It is a (n) shaped array where n in the number of training pairs and contains the target posterior for our method
         ($\in [0, 1]$).
         5. _test_pairs: Similar to _train_pairs but for testing pairs.
         6. _test_targets: Similar to _train_targets but for for testing pairs.
 
+    Datasets where the pairs are all the pairs of a set of images with per image labels (e.g. OSR and PubFig) can also fill:
+        7. _test_image_ids: It is a 1 dimensional array containing the index of each testing image.
+        8. _test_image_labels: It is a 1 dimensional array containing the label of each testing image for the attribute, a pair of test
+        images has a target of 1 if the label of the first image is larger, 0 if it is smaller and 0.5 if they are equal.
+        9. _train_image_ids: Similar to _test_image_ids but for the training images.
+        10. _train_image_labels: Similar to _test_image_labels but for the training images. A negative label marks an unlabeled image.
+
     Each dataset helper needs to implement its __init__ function which fills the above properties according to the way this data is stored
-    on disk.
+    on disk. The arrays which are parsed from the annotation files should go through `indexes.cached_index`, so they are only parsed
+    once and later constructions just memory map them.
     """
     _ATT_NAMES = None
     _train_pairs = None
@@ -32,6 +215,10 @@ class Dataset(object):
     _test_pairs = None
     _test_targets = None
     _image_addresses = None
+    _test_image_ids = None
+    _test_image_labels = None
+    _train_image_ids = None
+    _train_image_labels = None
 
     def __init__(self, root, attribute_index, augmentation=False):
         self.root = root
@@ -104,9 +291,122 @@ class Dataset(object):
 
         self._show_image_path_target(img1_path, img2_path, target, augment)
 
-    def _iterate_pair_target(self, indices, values, targets):
-        for i in indices:
-            yield ((self._image_addresses[values[i, 0]], self._image_addresses[values[i, 1]]), targets[i])
+    def _iterate_pair_target(self, indices, values, targets, chunk_size=1024):
+        # pairs and targets are looked up a chunk at a time, so `values` and `targets` can also be the lazy `AllPairs` ones
+        for start in range(0, len(indices), chunk_size):
+            chunk = np.asarray(indices[start:(start + chunk_size)])
+            for (i, j), target in zip(values[chunk], targets[chunk]):
+                yield ((self._image_addresses[i], self._image_addresses[j]), target)
+
+    @staticmethod
+    def _pair_indices(pairs, shuffle):
+        if shuffle and isinstance(pairs, AllPairs):
+            return pairs.permutation()
+
+        indices = np.arange(len(pairs))
+        if shuffle:
+            # shuffle the indices in-place
+            np.random.shuffle(indices)
+        return indices
+
+    @staticmethod
+    def _iterate_pair_batches(indices, pairs, targets, batch_size, num_batches):
+        for b in range(num_batches):
+            pair_ids = np.asarray(indices[(b * batch_size):((b + 1) * batch_size)], dtype=np.int64)
+            n = len(pair_ids)
+            batch_pairs = np.asarray(pairs[pair_ids])
+            batch_targets = np.asarray(targets[pair_ids])
+            # a pair can have a row of targets (see `MultiAttributeDataset`)
+            batch = PairBatch(pair_ids=np.full((batch_size,), -1, dtype=np.int64),
+                              left=np.zeros((batch_size,), dtype=np.int64),
+                              right=np.zeros((batch_size,), dtype=np.int64),
+                              targets=np.zeros((batch_size,) + batch_targets.shape[1:], dtype=np.float32),
+                              mask=np.zeros((batch_size,), dtype=np.int8))
+            batch.pair_ids[:n] = pair_ids
+            batch.left[:n] = batch_pairs[:, 0]
+            batch.right[:n] = batch_pairs[:, 1]
+            batch.targets[:n] = batch_targets
+            batch.mask[:n] = 1
+            yield batch
+
+    def train_batches(self, batch_size, shuffle=True, cut_tail=True):
+        """
+        Returns a generator of the training pairs as `PairBatch`es of index arrays, which is the array version of `train_generator`.
+        With `cut_tail` the last pairs which do not fill a whole batch are dropped, otherwise the last batch is padded (see `mask`).
+
+        Example Usage:
+        >>> for batch in dataset.train_batches(64):
+        >>>     images, targets, mask = extractor.preprocess_pair_batch(batch, dataset._image_addresses)
+        """
+        indices = self._pair_indices(self._train_pairs, shuffle)
+        num_batches = len(indices) // batch_size if cut_tail else -(-len(indices) // batch_size)
+        return self._iterate_pair_batches(indices, self._train_pairs, self._train_targets, batch_size, num_batches)
+
+    def shared_image_batches(self, batch_size, cut_tail=True):
+        """
+        Like `train_batches` with shuffling, but the pairs of a batch are chosen so they share images as much as possible, so a batch
+        has fewer distinct images to pass through the network (see `Extractor.preprocess_unique_pair_batch`).
+
+        Each batch starts with a random pair which is not used yet in this epoch and is filled with the unused pairs which have an
+        image in common with the pairs already in the batch, or with another random pair when there are none. For `AllPairs` each
+        batch is made of random pairs among a random subset of just enough images, which keeps it independent of the O(n^2) pairs.
+        """
+        if isinstance(self._train_pairs, AllPairs):
+            return self._all_pairs_shared_image_batches(batch_size, cut_tail)
+
+        pairs = np.asarray(self._train_pairs)
+        order = np.random.permutation(len(pairs))
+        num_batches = len(order) // batch_size if cut_tail else -(-len(order) // batch_size)
+        return self._iterate_pair_batches(self._shared_image_order(pairs, order), self._train_pairs, self._train_targets, batch_size,
+                                          num_batches)
+
+    @staticmethod
+    def _shared_image_order(pairs, order):
+        """
+        Greedily reorders the pair ids `order` so consecutive pairs share images, pairs are taken from `order` when nothing is shared.
+        """
+        image_pairs = {}
+        for pair_id in order:
+            image_pairs.setdefault(pairs[pair_id, 0], []).append(pair_id)
+            image_pairs.setdefault(pairs[pair_id, 1], []).append(pair_id)
+
+        used = np.zeros((len(pairs),), dtype=np.bool)
+        result = []
+        frontier = []
+        next_random = 0
+        while len(result) < len(pairs):
+            if not frontier:
+                while used[order[next_random]]:
+                    next_random += 1
+                frontier.append(order[next_random])
+            pair_id = frontier.pop()
+            if used[pair_id]:
+                continue
+            used[pair_id] = True
+            result.append(pair_id)
+            for image_id in pairs[pair_id]:
+                frontier.extend(p for p in image_pairs.pop(image_id, []) if not used[p])
+        return np.array(result, dtype=np.int64)
+
+    def _all_pairs_shared_image_batches(self, batch_size, cut_tail):
+        pairs = self._train_pairs
+        num_batches = len(pairs) // batch_size if cut_tail else -(-len(pairs) // batch_size)
+        # the fewest images which have at least `batch_size` pairs
+        num_images = min(pairs._n, int(np.ceil((1 + np.sqrt(1 + 8 * batch_size)) / 2)))
+        for _ in range(num_batches):
+            positions = np.sort(np.random.choice(pairs._n, num_images, replace=False))
+            i, j = np.triu_indices(num_images, 1)
+            pair_ids = pairs.pair_ids(positions[i], positions[j])
+            pair_ids = pair_ids[np.random.permutation(len(pair_ids))[:batch_size]]
+            for batch in self._iterate_pair_batches(pair_ids, pairs, self._train_targets, batch_size, 1):
+                yield batch
+
+    def test_batches(self, batch_size, shuffle=False):
+        """
+        Similar to `train_batches` but for the test set, the last batch is padded.
+        """
+        indices = self._pair_indices(self._test_pairs, shuffle)
+        return self._iterate_pair_batches(indices, self._test_pairs, self._test_targets, batch_size, -(-len(indices) // batch_size))
 
     def train_generator(self, batch_size, shuffle=True, cut_tail=True):
         """
@@ -123,11 +423,7 @@ class Dataset(object):
         >>>     for (img1_path, img2_path), target in batch:
         >>>         # do something with the batch
         """
-        indices = np.arange(len(self._train_targets))
-
-        if shuffle:
-            # shuffle the indices in-place
-            np.random.shuffle(indices)
+        indices = self._pair_indices(self._train_pairs, shuffle)
 
         to_return = boltons.iterutils.chunked_iter(self._iterate_pair_target(indices, self._train_pairs, self._train_targets), batch_size)
 
@@ -145,29 +441,87 @@ class Dataset(object):
         The last item from the generator might contain `None`. This means that the test data was not enough to fill the last batch.
         The user of the dataset must take care of these `None` values.
         """
-        indices = np.arange(len(self._test_targets))
-
-        if shuffle:
-            # shuffle the indices in-place
-            np.random.shuffle(indices)
+        indices = self._pair_indices(self._test_pairs, shuffle)
 
         return boltons.iterutils.chunked_iter(self._iterate_pair_target(indices, self._test_pairs, self._test_targets), batch_size, fill=None)
 
+    def has_test_image_labels(self):
+        return self._test_image_labels is not None
+
+    def has_train_image_labels(self):
+        return self._train_image_labels is not None
+
+    def train_image_batches(self, batch_size, shuffle=True, cut_tail=True):
+        """
+        Returns a generator of the training images with their labels as `ImageBatch`es, for training on all the pairs of the images of
+        a batch at once. Only for datasets with per image labels (see `has_train_image_labels`).
+        """
+        if not self.has_train_image_labels():
+            raise Exception("%s does not have per image labels" % self.__class__.__name__)
+
+        image_ids = np.asarray(self._train_image_ids)
+        labels = np.asarray(self._train_image_labels)
+        indices = np.random.permutation(len(image_ids)) if shuffle else np.arange(len(image_ids))
+        num_batches = len(indices) // batch_size if cut_tail else -(-len(indices) // batch_size)
+        for b in range(num_batches):
+            batch_indices = indices[(b * batch_size):((b + 1) * batch_size)]
+            n = len(batch_indices)
+            batch = ImageBatch(image_ids=np.zeros((batch_size,), dtype=np.int64),
+                               labels=np.zeros((batch_size,), dtype=np.float32),
+                               mask=np.zeros((batch_size,), dtype=np.int8))
+            batch.image_ids[:n] = image_ids[batch_indices]
+            batch.labels[:n] = labels[batch_indices]
+            batch.mask[:n] = 1
+            yield batch
+
+    def test_image_labels(self):
+        """
+        Returns the index of each testing image and its label for the attribute. The testing pairs of these datasets are all the pairs
+        of these images, so this is enough for computing the accuracy over all of them without building the pairs.
+        """
+        if not self.has_test_image_labels():
+            raise Exception("%s does not have per image labels" % self.__class__.__name__)
+        return self._test_image_ids, self._test_image_labels
+
+    def _load_relative_attributes(self, images_path):
+        """
+        Loads the `data.mat` file of the relative attributes datasets (OSR and PubFig), fills `_image_addresses` and returns the
+        training and testing image ids and their (n x attributes) labels.
+        """
+        data_path = os.path.join(self.root, 'data.mat')
+
+        def build():
+            data_file = scipy.io.loadmat(data_path, appendmat=False)
+            # self._ATT_NAMES = map(lambda x: x[0], data_file['attribute_names'][0])
+            im_names = data_file['im_names'].squeeze()
+            image_addresses = [os.path.join(images_path, im_names[i][0]) for i in xrange(len(im_names))]
+            class_labels = data_file['class_labels'][:, 0]
+            used_for_training = data_file['used_for_training'][:, 0]
+
+            X = np.arange(len(im_names), dtype=np.int32)
+            y = data_file['relative_ordering'][:, class_labels - 1].T.astype(np.int16)
+            return {'image_addresses': np.array(image_addresses),
+                    'train_image_ids': X[np.where(used_for_training)], 'test_image_ids': X[np.where(used_for_training - 1)],
+                    'train_labels': y[np.where(used_for_training)], 'test_labels': y[np.where(used_for_training - 1)]}
+
+        index = indexes.cached_index(self.__class__.__name__, [data_path], build)
+        self._image_addresses = index['image_addresses']
+        return index['train_image_ids'], index['test_image_ids'], index['train_labels'], index['test_labels']
+
+    def image_ids(self, test=False):
+        """
+        Returns the sorted index of all the images which appear in the training (or testing) pairs.
+        """
+        pairs = self._test_pairs if test else self._train_pairs
+        if isinstance(pairs, AllPairs):
+            return np.unique(pairs.image_ids)
+        return np.unique(pairs)
+
     def all_images(self, for_all=False, test=False):
         if for_all:
             return self._image_addresses
 
-        all_images_path = set()
-        if not test:
-            pair_ids = self._train_pairs
-        else:
-            pair_ids = self._test_pairs
-
-        for pid in range(len(pair_ids)):
-            all_images_path.add(self._image_addresses[pair_ids[pid][0]])
-            all_images_path.add(self._image_addresses[pair_ids[pid][1]])
-
-        return list(all_images_path)
+        return [self._image_addresses[i] for i in self.image_ids(test)]
 
 
 class Zappos50K1(Dataset):
@@ -181,55 +535,71 @@ class Zappos50K1(Dataset):
 
         data_path = os.path.join(self.root, 'ut-zap50k-data')
         images_path = os.path.join(self.root, 'ut-zap50k-images')
-        imagepath_info = scipy.io.loadmat(os.path.join(data_path, 'image-path.mat'))['imagepath'].flatten()
-        train_test_file = scipy.io.loadmat(os.path.join(data_path, 'train-test-splits.mat'))
-        labels_file = scipy.io.loadmat(os.path.join(data_path, 'zappos-labels.mat'))
+        train_test_path = os.path.join(data_path, 'train-test-splits.mat')
+        labels_path = os.path.join(data_path, 'zappos-labels.mat')
 
-        train_info = train_test_file['trainIndexAll'].flatten()
-        test_info = train_test_file['testIndexAll'].flatten()
+        def build():
+            train_test_file = scipy.io.loadmat(train_test_path)
+            labels_file = scipy.io.loadmat(labels_path)
 
-        train_index = train_info[attribute_index].flatten()[split_index].flatten()
-        test_index = test_info[attribute_index].flatten()[split_index].flatten()
-        image_pairs_order = labels_file['mturkOrder'].flatten()[attribute_index].astype(int)
+            train_info = train_test_file['trainIndexAll'].flatten()
+            test_info = train_test_file['testIndexAll'].flatten()
 
-        # create placeholders
-        self._train_pairs = np.zeros((len(train_index), 2), dtype=np.int)
-        self._train_targets = np.zeros((len(train_index),), dtype=np.float32)
-        self._test_pairs = np.zeros((len(test_index), 2), dtype=np.int)
-        self._test_targets = np.zeros((len(test_index),), dtype=np.float32)
+            train_index = train_info[attribute_index].flatten()[split_index].flatten()
+            test_index = test_info[attribute_index].flatten()[split_index].flatten()
+            image_pairs_order = labels_file['mturkOrder'].flatten()[attribute_index].astype(int)
 
-        # fill place holders
-        self._image_addresses = []
-        for p in imagepath_info:  # you see this crazy for loop? yes I hate it too.
-            this_thing = str(p[0])
-            this_thing_parts = this_thing.rsplit('/', 1)
-            if this_thing_parts[0].endswith('.'):
-                this_thing_parts[0] = this_thing_parts[0][:-1]
-                this_thing = '/'.join(this_thing_parts)
-            if "Levi's " in this_thing_parts[0]:
-                this_thing_parts[0] = this_thing_parts[0].replace("Levi's ", "Levi's&#174; ")
-                this_thing = '/'.join(this_thing_parts)
-            self._image_addresses.append(os.path.join(images_path, this_thing))
-
-        Zappos50K1._fill_pair_target(train_index, image_pairs_order, self._train_pairs, self._train_targets)
-        Zappos50K1._fill_pair_target(test_index, image_pairs_order, self._test_pairs, self._test_targets)
+            train_pairs, train_targets = Zappos50K1._pair_target(train_index, image_pairs_order)
+            test_pairs, test_targets = Zappos50K1._pair_target(test_index, image_pairs_order)
+            return {'train_pairs': train_pairs, 'train_targets': train_targets, 'test_pairs': test_pairs, 'test_targets': test_targets}
+
+        index = indexes.cached_index('Zappos50K1-%d-%d' % (attribute_index, split_index), [train_test_path, labels_path], build)
+        self._train_pairs = index['train_pairs']
+        self._train_targets = index['train_targets']
+        self._test_pairs = index['test_pairs']
+        self._test_targets = index['test_targets']
+        self._image_addresses = Zappos50K1._load_image_addresses(data_path, images_path)
 
     def get_name(self):
         return "Zap1-%d-%d" % (self.attribute_index, self.split_index)
 
     @staticmethod
-    def _fill_pair_target(indexes, pair_order, pairs, targets):
-        for i, id in enumerate(indexes):
-            pair_info = pair_order[id - 1]  # because of matlab indexing
-            pairs[i, :] = pair_info[0:2] - 1
-            if pair_info[3] == 1:
-                targets[i] = 1.0
-            elif pair_info[3] == 2:
-                targets[i] = 0.0
-            elif pair_info[3] == 3:
-                targets[i] = 0.5
-            else:
-                raise Exception("invalid target")
+    def _load_image_addresses(data_path, images_path):
+        """
+        Returns the address of each image of Zappos50K, as an array of strings, which is shared by both versions of the dataset.
+        """
+        imagepath_path = os.path.join(data_path, 'image-path.mat')
+
+        def build():
+            imagepath_info = scipy.io.loadmat(imagepath_path)['imagepath'].flatten()
+            image_addresses = []
+            for p in imagepath_info:  # you see this crazy for loop? yes I hate it too. at least it only runs once now.
+                this_thing = str(p[0])
+                this_thing_parts = this_thing.rsplit('/', 1)
+                if this_thing_parts[0].endswith('.'):
+                    this_thing_parts[0] = this_thing_parts[0][:-1]
+                    this_thing = '/'.join(this_thing_parts)
+                if "Levi's " in this_thing_parts[0]:
+                    this_thing_parts[0] = this_thing_parts[0].replace("Levi's ", "Levi's&#174; ")
+                    this_thing = '/'.join(this_thing_parts)
+                image_addresses.append(os.path.join(images_path, this_thing))
+            return {'image_addresses': np.array(image_addresses)}
+
+        return indexes.cached_index('Zappos50K-images', [imagepath_path], build)['image_addresses']
+
+    @staticmethod
+    def _pair_target(indexes, pair_order):
+        """
+        Returns the (n x 2) pairs and the (n) targets of the comparisons `indexes` (1-based) of `pair_order`.
+        """
+        pair_info = pair_order[np.asarray(indexes, dtype=np.int) - 1]  # because of matlab indexing
+        pairs = (pair_info[:, 0:2] - 1).astype(np.int32)
+        answers = pair_info[:, 3]
+        if np.any((answers < 1) | (answers > 3)):
+            raise Exception("invalid target")
+        # answer 1: the first image has more of the attribute, 2: less, 3: about the same
+        targets = np.array([np.nan, 1.0, 0.0, 0.5], dtype=np.float32)[answers]
+        return pairs, targets
 
 
 class Zappos50K2(Dataset):
@@ -240,36 +610,28 @@ class Zappos50K2(Dataset):
 
         data_path = os.path.join(self.root, 'ut-zap50k-data')
         images_path = os.path.join(self.root, 'ut-zap50k-images')
-        imagepath_info = scipy.io.loadmat(os.path.join(data_path, 'image-path.mat'))['imagepath'].flatten()
-        labels_file = scipy.io.loadmat(os.path.join(data_path, 'zappos-labels.mat'))
-        labels_file_fg = scipy.io.loadmat(os.path.join(data_path, 'zappos-labels-fg.mat'))
+        labels_path = os.path.join(data_path, 'zappos-labels.mat')
+        labels_fg_path = os.path.join(data_path, 'zappos-labels-fg.mat')
 
-        image_pairs_order = labels_file['mturkOrder'].flatten()[attribute_index].astype(int)
-        image_pairs_order_fg = labels_file_fg['mturkHard'].flatten()[attribute_index].astype(int)
-        train_index = np.arange(len(image_pairs_order), dtype=np.int)
-        test_index = np.arange(len(image_pairs_order_fg), dtype=np.int)
+        def build():
+            labels_file = scipy.io.loadmat(labels_path)
+            labels_file_fg = scipy.io.loadmat(labels_fg_path)
 
-        # create placeholders
-        self._train_pairs = np.zeros((len(image_pairs_order), 2), dtype=np.int)
-        self._train_targets = np.zeros((len(image_pairs_order),), dtype=np.float32)
-        self._test_pairs = np.zeros((len(image_pairs_order_fg), 2), dtype=np.int)
-        self._test_targets = np.zeros((len(image_pairs_order_fg),), dtype=np.float32)
+            image_pairs_order = labels_file['mturkOrder'].flatten()[attribute_index].astype(int)
+            image_pairs_order_fg = labels_file_fg['mturkHard'].flatten()[attribute_index].astype(int)
+            train_index = np.arange(len(image_pairs_order), dtype=np.int)
+            test_index = np.arange(len(image_pairs_order_fg), dtype=np.int)
 
-        # fill place holders
-        self._image_addresses = []
-        for p in imagepath_info:  # you see this crazy for loop? yes I hate it too.
-            this_thing = str(p[0])
-            this_thing_parts = this_thing.rsplit('/', 1)
-            if this_thing_parts[0].endswith('.'):
-                this_thing_parts[0] = this_thing_parts[0][:-1]
-                this_thing = '/'.join(this_thing_parts)
-            if "Levi's " in this_thing_parts[0]:
-                this_thing_parts[0] = this_thing_parts[0].replace("Levi's ", "Levi's&#174; ")
-                this_thing = '/'.join(this_thing_parts)
-            self._image_addresses.append(os.path.join(images_path, this_thing))
-
-        Zappos50K1._fill_pair_target(train_index, image_pairs_order, self._train_pairs, self._train_targets)
-        Zappos50K1._fill_pair_target(test_index, image_pairs_order_fg, self._test_pairs, self._test_targets)
+            train_pairs, train_targets = Zappos50K1._pair_target(train_index, image_pairs_order)
+            test_pairs, test_targets = Zappos50K1._pair_target(test_index, image_pairs_order_fg)
+            return {'train_pairs': train_pairs, 'train_targets': train_targets, 'test_pairs': test_pairs, 'test_targets': test_targets}
+
+        index = indexes.cached_index('Zappos50K2-%d' % attribute_index, [labels_path, labels_fg_path], build)
+        self._train_pairs = index['train_pairs']
+        self._train_targets = index['train_targets']
+        self._test_pairs = index['test_pairs']
+        self._test_targets = index['test_targets']
+        self._image_addresses = Zappos50K1._load_image_addresses(data_path, images_path)
 
 
 class LFW10(Dataset):
@@ -284,39 +646,36 @@ class LFW10(Dataset):
         data_path = os.path.join(self.root, 'annotations')
         images_path = os.path.join(self.root, 'images')
 
-        annotation_file_train = scipy.io.loadmat(os.path.join(data_path, '{}train.mat'.format(self._ATT_NAMES[attribute_index])))
-        annotation_file_test = scipy.io.loadmat(os.path.join(data_path, '{}test.mat'.format(self._ATT_NAMES[attribute_index])))
-
-        # the training set
-        self._train_pairs = np.zeros((500, 2), dtype=np.int)
-        self._train_targets = np.zeros((500,), dtype=np.float32)
-        for i in xrange(500):
-            self._train_pairs[i, 0] = int(annotation_file_train['images_compare'][i, 1][0][:-4]) - 1  # first to remove the '.jpg' part
-            self._train_pairs[i, 1] = int(annotation_file_train['images_compare'][i, 2][0][:-4]) - 1  # , then to convert to index
-            idx = np.argmax(annotation_file_train['attribute_strengths'][i, 1:])
-            if idx == 0:
-                self._train_targets[i] = 1.0  # image1 has more strength
-            elif idx == 1:
-                self._train_targets[i] = 0.0  # image1 has less strength
-            else:
-                self._train_targets[i] = 0.5  # two images have about the same strength
-
-        self._test_pairs = np.zeros((500, 2), dtype=np.int)
-        self._test_targets = np.zeros((500,), dtype=np.float32)
-        for i in xrange(500):
-            self._test_pairs[i, 0] = int(annotation_file_test['images_compare'][i, 1][0][:-4]) - 1  # first to remove the '.jpg' part
-            self._test_pairs[i, 1] = int(annotation_file_test['images_compare'][i, 2][0][:-4]) - 1  # , then to convert to index
-            idx = np.argmax(annotation_file_test['attribute_strengths'][i, 1:])
-            if idx == 0:
-                self._test_targets[i] = 1.0  # image1 has more strength
-            elif idx == 1:
-                self._test_targets[i] = 0.0  # image1 has less strength
-            else:
-                self._test_targets[i] = 0.5  # two images have about the same strength
+        train_path = os.path.join(data_path, '{}train.mat'.format(self._ATT_NAMES[attribute_index]))
+        test_path = os.path.join(data_path, '{}test.mat'.format(self._ATT_NAMES[attribute_index]))
+
+        def build():
+            train_pairs, train_targets = LFW10._pair_target(scipy.io.loadmat(train_path))
+            test_pairs, test_targets = LFW10._pair_target(scipy.io.loadmat(test_path))
+            return {'train_pairs': train_pairs, 'train_targets': train_targets, 'test_pairs': test_pairs, 'test_targets': test_targets}
+
+        index = indexes.cached_index('LFW10-%d' % attribute_index, [train_path, test_path], build)
+        self._train_pairs = index['train_pairs']
+        self._train_targets = index['train_targets']
+        self._test_pairs = index['test_pairs']
+        self._test_targets = index['test_targets']
 
         # fill place holders
         self._image_addresses = [os.path.join(images_path, '{}.jpg'.format(p + 1)) for p in xrange(2000)]
 
+    @staticmethod
+    def _pair_target(annotation_file, n=500):
+        """
+        Returns the (n x 2) pairs and the (n) targets of an annotation file.
+        """
+        images_compare = annotation_file['images_compare']
+        # first to remove the '.jpg' part, then to convert to index
+        pairs = np.array([[int(images_compare[i, 1][0][:-4]), int(images_compare[i, 2][0][:-4])] for i in xrange(n)], dtype=np.int32) - 1
+        idx = np.argmax(annotation_file['attribute_strengths'][:n, 1:], axis=1)
+        # image1 has more strength, image1 has less strength or the two images have about the same strength
+        targets = np.where(idx == 0, 1.0, np.where(idx == 1, 0.0, 0.5)).astype(np.float32)
+        return pairs, targets
+
 
 class PubFig(Dataset):
     """The dataset helper class for PubFig dataset."""
@@ -326,43 +685,18 @@ class PubFig(Dataset):
     def __init__(self, root, attribute_index):
         super(PubFig, self).__init__(root, attribute_index)
 
-        data_path = self.root
         images_path = os.path.join(self.root, 'images')
-        data_file = scipy.io.loadmat(os.path.join(data_path, 'data.mat'), appendmat=False)
-        # self._ATT_NAMES = map(lambda x: x[0], data_file['attribute_names'][0])
-        im_names = data_file['im_names'].squeeze()
-        self._image_addresses = [os.path.join(images_path, im_names[i][0]) for i in xrange(len(im_names))]
-        class_labels = data_file['class_labels'][:, 0]
-        used_for_training = data_file['used_for_training'][:, 0]
-
-        X = np.arange(len(im_names), dtype=np.int)
-        y = np.zeros((len(im_names), len(self._ATT_NAMES)), dtype=np.int)
-        for i in xrange(len(im_names)):
-            y[i, :] = data_file['relative_ordering'][:, class_labels[i] - 1]
-        Xtrain = X[np.where(used_for_training)]
-        Xtest = X[np.where(used_for_training - 1)]
-        ytrain = y[np.where(used_for_training)]
-        ytest = y[np.where(used_for_training - 1)]
-
-        idxs = list(itertools.combinations(range(len(Xtrain)), 2))
-        self._train_pairs = np.zeros((len(idxs), 2), dtype=np.int)
-        self._train_targets = np.zeros((len(idxs),), dtype=np.float32)
-        for cnt, ij in enumerate(idxs):
-            i, j = ij
-            self._train_pairs[cnt][0] = Xtrain[i]
-            self._train_pairs[cnt][1] = Xtrain[j]
-            self._train_targets[cnt] = (ytrain[i, attribute_index] == ytrain[j, attribute_index]) * 0.5 +\
-                                       (ytrain[i, attribute_index] > ytrain[j, attribute_index]) * 1.0
-
-        idxs = list(itertools.combinations(range(len(Xtest)), 2))
-        self._test_pairs = np.zeros((len(idxs), 2), dtype=np.int)
-        self._test_targets = np.zeros((len(idxs),), dtype=np.float32)
-        for cnt, ij in enumerate(idxs):
-            i, j = ij
-            self._test_pairs[cnt][0] = Xtest[i]
-            self._test_pairs[cnt][1] = Xtest[j]
-            self._test_targets[cnt] = (ytest[i, attribute_index] == ytest[j, attribute_index]) * 0.5 +\
-                                      (ytest[i, attribute_index] > ytest[j, attribute_index]) * 1.0
+        Xtrain, Xtest, ytrain, ytest = self._load_relative_attributes(images_path)
+        self._test_image_ids = Xtest
+        self._test_image_labels = ytest[:, attribute_index]
+        self._train_image_ids = Xtrain
+        self._train_image_labels = ytrain[:, attribute_index]
+
+        # the pairs are all the pairs of training (testing) images, they are computed on demand
+        self._train_pairs = AllPairs(Xtrain, ytrain[:, attribute_index])
+        self._train_targets = self._train_pairs.targets
+        self._test_pairs = AllPairs(Xtest, ytest[:, attribute_index])
+        self._test_targets = self._test_pairs.targets
 
 
 class OSR(Dataset):
@@ -374,51 +708,105 @@ class OSR(Dataset):
     def __init__(self, root, attribute_index):
         super(OSR, self).__init__(root, attribute_index)
 
-        data_path = self.root
         images_path = os.path.join(self.root, 'spatial_envelope_256x256_static_8outdoorcategories')
-        data_file = scipy.io.loadmat(os.path.join(data_path, 'data.mat'), appendmat=False)
-        # self._ATT_NAMES = map(lambda x: x[0], data_file['attribute_names'][0])
-        im_names = data_file['im_names'].squeeze()
-        self._image_addresses = [os.path.join(images_path, im_names[i][0]) for i in xrange(len(im_names))]
-        class_labels = data_file['class_labels'][:, 0]
-        used_for_training = data_file['used_for_training'][:, 0]
-
-        X = np.arange(len(im_names), dtype=np.int)
-        y = np.zeros((len(im_names), len(self._ATT_NAMES)), dtype=np.int)
-        for i in xrange(len(im_names)):
-            y[i, :] = data_file['relative_ordering'][:, class_labels[i] - 1]
-        Xtrain = X[np.where(used_for_training)]
-        Xtest = X[np.where(used_for_training - 1)]
-        ytrain = y[np.where(used_for_training)]
-        ytest = y[np.where(used_for_training - 1)]
-
-        idxs = list(itertools.combinations(range(len(Xtrain)), 2))
-        self._train_pairs = np.zeros((len(idxs), 2), dtype=np.int)
-        self._train_targets = np.zeros((len(idxs),), dtype=np.float32)
-        for cnt, ij in enumerate(idxs):
-            i, j = ij
-            self._train_pairs[cnt][0] = Xtrain[i]
-            self._train_pairs[cnt][1] = Xtrain[j]
-            self._train_targets[cnt] = (ytrain[i, attribute_index] == ytrain[j, attribute_index]) * 0.5 +\
-                                       (ytrain[i, attribute_index] > ytrain[j, attribute_index]) * 1.0
-
-        idxs = list(itertools.combinations(range(len(Xtest)), 2))
-        self._test_pairs = np.zeros((len(idxs), 2), dtype=np.int)
-        self._test_targets = np.zeros((len(idxs),), dtype=np.float32)
-        for cnt, ij in enumerate(idxs):
-            i, j = ij
-            self._test_pairs[cnt][0] = Xtest[i]
-            self._test_pairs[cnt][1] = Xtest[j]
-            self._test_targets[cnt] = (ytest[i, attribute_index] == ytest[j, attribute_index]) * 0.5 +\
-                                      (ytest[i, attribute_index] > ytest[j, attribute_index]) * 1.0
+        Xtrain, Xtest, ytrain, ytest = self._load_relative_attributes(images_path)
+        self._test_image_ids = Xtest
+        self._test_image_labels = ytest[:, attribute_index]
+        self._train_image_ids = Xtrain
+        self._train_image_labels = ytrain[:, attribute_index]
+
+        # the pairs are all the pairs of training (testing) images, they are computed on demand
+        self._train_pairs = AllPairs(Xtrain, ytrain[:, attribute_index])
+        self._train_targets = self._train_pairs.targets
+        self._test_pairs = AllPairs(Xtest, ytest[:, attribute_index])
+        self._test_targets = self._test_pairs.targets
 
         # Since the number of test_pairs are very large, nearly 3 millions, we only sample 5% of them
-        # for the actual evaluation
+        # for the actual evaluation. The accuracy on all of them is available with `eval_accuracy(all_pairs=True)`, it stays opt-in
+        # because the published OSR results are on this 5% sample (which is also what `test_generator` and the per-pair loss use).
         the_test_length = len(self._test_targets)
         fraction_of_the_length = int(the_test_length * self.TEST_FRACTION)
 
-        indices = np.arange(len(self._test_targets), dtype=np.int)
-        np.random.shuffle(indices)
+        indices = self._test_pairs.permutation()[:fraction_of_the_length]
+
+        self._test_targets = self._test_targets[indices]
+        self._test_pairs = self._test_pairs[indices]
+
 
-        self._test_pairs = self._test_pairs[indices][:fraction_of_the_length]
-        self._test_targets = self._test_targets[indices][:fraction_of_the_length]
+def _equal_row_ids(keys):
+    """
+    Returns the order which sorts the rows of the (n x k) array `keys` and the id of each row, equal rows have the same id and the ids
+    are increasing in that order.
+    """
+    order = np.lexsort(keys.T[::-1])
+    sorted_keys = keys[order]
+    new_id = np.concatenate([[True], np.any(sorted_keys[1:] != sorted_keys[:-1], axis=1)])
+    ids = np.empty((len(keys),), dtype=np.int64)
+    ids[order] = np.cumsum(new_id) - 1
+    return order, ids
+
+
+class MultiAttributeDataset(Dataset):
+    """
+    Several attributes of a dataset at once, for training one model with a ranker head per attribute (`MultiAttributeGhiaseddin`).
+
+    `datasets` are the helpers of the attributes, in the order of the heads, they must have the same images. The training pairs of all
+    of them are merged: a pair of images which is annotated for several attributes (e.g. all the pairs of OSR and PubFig) is a single
+    training pair, `_train_targets` is a (pairs x attributes) matrix with the target of each attribute and `_train_target_mask` marks
+    the attributes which annotate the pair, so a pair trains all of its heads at once. A pair which is repeated within the pairs of an
+    attribute stays repeated. The testing pairs stay with the helper of their attribute.
+
+    Example Usage:
+    >>> dataset = MultiAttributeDataset([Zappos50K1(root, attribute_index=i, split_index=0) for i in range(4)])
+    """
+
+    def __init__(self, datasets):
+        self.datasets = list(datasets)
+        first = self.datasets[0]
+        for dataset in self.datasets[1:]:
+            if dataset._image_addresses is not first._image_addresses and \
+                    list(dataset._image_addresses) != list(first._image_addresses):
+                raise Exception("The datasets of the attributes do not have the same images")
+        self.root = first.root
+        self.attribute_index = None
+        self.augmentation = first.augmentation
+        self._ATT_NAMES = [dataset._ATT_NAMES[dataset.attribute_index] for dataset in self.datasets]
+        self._image_addresses = first._image_addresses
+
+        # the lazy `AllPairs` are materialized, the training pairs of an attribute are at most a few millions
+        pairs = np.concatenate([np.asarray(dataset._train_pairs[:], dtype=np.int64) for dataset in self.datasets])
+        targets = np.concatenate([np.asarray(dataset._train_targets[:], dtype=np.float32) for dataset in self.datasets])
+        attributes = np.concatenate([np.full((len(dataset._train_targets),), i, dtype=np.int64) for i, dataset in enumerate(self.datasets)])
+
+        # the k-th occurrence of a pair in an attribute is merged with the k-th occurrences of the pair in the other attributes
+        order, groups = _equal_row_ids(np.column_stack([attributes, pairs]))
+        sorted_groups = groups[order]
+        occurrences = np.empty((len(pairs),), dtype=np.int64)
+        occurrences[order] = np.arange(len(pairs)) - np.searchsorted(sorted_groups, sorted_groups)
+        _, rows = _equal_row_ids(np.column_stack([pairs, occurrences]))
+
+        num_rows = rows.max() + 1 if len(rows) > 0 else 0
+        self._train_pairs = np.zeros((num_rows, 2), dtype=np.int64)
+        self._train_pairs[rows] = pairs
+        self._train_targets = np.zeros((num_rows, len(self.datasets)), dtype=np.float32)
+        self._train_targets[rows, attributes] = targets
+        self._train_target_mask = np.zeros((num_rows, len(self.datasets)), dtype=np.int8)
+        self._train_target_mask[rows, attributes] = 1
+
+    def get_name(self):
+        return "%s-heads:%s" % (self.datasets[0].get_name(), '.'.join(str(dataset.attribute_index) for dataset in self.datasets))
+
+    def pair_target_mask(self, pair_ids):
+        """
+        Returns the (n x attributes) float32 mask of the attributes which annotate each of the training `pair_ids`, all zeros for the
+        padding pairs (a pair id of -1).
+        """
+        pair_ids = np.asarray(pair_ids)
+        mask = self._train_target_mask[np.maximum(pair_ids, 0)].astype(np.float32)
+        mask[pair_ids < 0] = 0
+        return mask
+
+    def image_ids(self, test=False):
+        if test:
+            return np.unique(np.concatenate([dataset.image_ids(test=True) for dataset in self.datasets]))
+        return super(MultiAttributeDataset, self).image_ids(test)
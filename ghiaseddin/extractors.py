@@ -1,5 +1,9 @@
+import os
 import lasagne
+import threading
 import utils
+import indexes
+from augmentation import BatchAugmentation
 
 from lasagne.layers.dnn import Conv2DDNNLayer as ConvLayer
 from lasagne.layers.dnn import MaxPool2DDNNLayer as PoolLayerDNN
@@ -10,6 +14,32 @@ import cPickle as pickle
 import numpy as np
 
 
+def _unpickle_weights(file_addr, weights_key):
+    with open(file_addr, 'rb') as f:
+        params = pickle.load(f)
+        init_weights = params[weights_key]
+    return init_weights
+
+
+def converted_weights_path(file_addr, weights_key='param values'):
+    """
+    Returns the path of the directory `convert_weights` writes the arrays of `weights_key` of the weights pickle at `file_addr` to.
+    """
+    return '%s-%s' % (os.path.splitext(file_addr)[0], weights_key.replace(' ', '_'))
+
+
+def convert_weights(file_addr, weights_key='param values'):
+    """
+    Converts the arrays under `weights_key` of the weights pickle at `file_addr` (e.g. `settings.vgg16_weights`) to one `.npy` file
+    per array, stored like a dataset index (see `indexes`), so building an extractor only has to memory map them.
+    The pickle is kept, the converted arrays are only used as long as it does not change.
+    """
+    values = _unpickle_weights(file_addr, weights_key)
+    path = converted_weights_path(file_addr, weights_key)
+    indexes.save_index(path, [file_addr], dict(('param_%04d' % i, np.ascontiguousarray(value)) for i, value in enumerate(values)))
+    return path
+
+
 class Extractor(object):
     """
     The Feature Learning and Extractor Sub-Network
@@ -17,6 +47,10 @@ class Extractor(object):
     You are able to:
         - create a custom feature extractor, by creating a class that extends this one.
 
+    Images are kept as uint8 through loading, resizing and (batch) augmentation, and the whole batch is then converted to the network
+    input in a single vectorized pass. If `batch_augmentation` is set to `True` (e.g. by `Ghiaseddin(batch_augmentation=True)`) this is
+    also done for training with augmentation, otherwise the augmentation is done one image at a time with `_general_image_preprocess`.
+
     A custom extractor must have the following properties:
         - net
             this contains the network layers
@@ -30,17 +64,48 @@ class Extractor(object):
     _input_width = 224
     _input_raw_scale = 255
     _input_mean_to_subtract = [104, 117, 123]
+    batch_augmentation = False
 
     def __init__(self, weights=None, augmentation=False):
         self.weights = weights
         self.augmentation = augmentation
+        self._batch_augmenter = None
+        self.image_shard = None
+        # uint8 staging buffers of `_preprocess_batched`, one set per thread since the prefetcher calls `preprocess` from several
+        self._staging = threading.local()
+
+    def use_shard(self, shard):
+        """
+        Reads the images from a packed `shards.ImageShard` instead of decoding them from disk. Images which are not in the shard are
+        still loaded from disk. Passing `None` stops using the shard.
+        """
+        if shard is not None:
+            assert tuple(shard.image_dims) == (self._input_height, self._input_width), "the shard is for another input size"
+        self.image_shard = shard
 
     @staticmethod
     def _get_weights_from_file(file_addr, weights_key):
-        with open(file_addr, 'rb') as f:
-            params = pickle.load(f)
-            init_weights = params[weights_key]
-        return init_weights
+        """
+        Returns the list of arrays under `weights_key` of the weights pickle at `file_addr`. If the pickle was converted with
+        `convert_weights` the converted arrays are memory mapped instead of unpickling the whole file.
+        """
+        arrays = indexes.load_index(converted_weights_path(file_addr, weights_key), [file_addr], mmap_mode='c')
+        if arrays is not None:
+            return [arrays['param_%04d' % i] for i in range(len(arrays))]
+        return _unpickle_weights(file_addr, weights_key)
+
+    def _set_weights(self, values):
+        """
+        Same as `lasagne.layers.set_all_param_values(self.out_layer, values)`, but the parameters borrow the arrays instead of copying
+        them, so memory mapped weights stay shared with the page cache (and with other processes) until a parameter is updated.
+        """
+        params = lasagne.layers.get_all_params(self.out_layer)
+        if len(params) != len(values):
+            raise ValueError("mismatch: got %d values to set %d parameters" % (len(values), len(params)))
+        for p, v in zip(params, values):
+            if p.get_value(borrow=True).shape != v.shape:
+                raise ValueError("mismatch: parameter has shape %r but value to set has shape %r" % (p.get_value(borrow=True).shape, v.shape))
+            p.set_value(v, borrow=True)
 
     def set_input_var(self, input_var, batch_size=None):
         input_layer_shape = list(self.net[self.INPUT_LAYER_NAME].shape)
@@ -67,8 +132,9 @@ class Extractor(object):
             [numpy.ndarray] -- [returns another numpy array ready for the network, typical has a shape of (3, d, d)]
         """
         if augmentation:
-            img = utils.random_augmentation(img)
-        img = utils.resize_image(img, (self._input_height, self._input_height))
+            img = utils.random_augmentation_resized(img, (self._input_height, self._input_width))
+        else:
+            img = utils.resize_image(img, (self._input_height, self._input_width))
 
         img = img.transpose((2, 0, 1))
         img = self._input_raw_scale * img[::-1, ...]
@@ -78,6 +144,109 @@ class Extractor(object):
 
         return img
 
+    def load_image(self, image_addr):
+        """
+        Loads an image already resized to the input size of the network, as a float32 (h, w, 3) array in [0, 1].
+        The image is read from the packed shard if one is used (see `use_shard`), otherwise the decoded images are kept in
+        `utils.image_cache`, so an image is only read from disk once as long as it fits the cache.
+        """
+        return self._load_resized_uint8(image_addr).astype(np.float32) / 255
+
+    def _load_resized_uint8(self, image_addr):
+        if self.image_shard is not None and image_addr in self.image_shard:
+            return self.image_shard.get(image_addr)
+        return utils.load_resized_image(image_addr, (self._input_height, self._input_width))
+
+    def _uint8_normalization(self):
+        """
+        Returns the (scale, offset) which map a uint8 pixel value `v` to the network input `v * scale - offset`.
+        """
+        return self._input_raw_scale / 255.0, np.array(self._input_mean_to_subtract, dtype=np.float32)
+
+    def _normalize_uint8_batch(self, images, out):
+        """
+        Vectorized version of the last steps of `_general_image_preprocess` for a (N x H x W x 3) uint8 batch of RGB images.
+        Writes the (N x 3 x H x W) float32 BGR, scaled and mean subtracted images to `out`, without any temporary arrays.
+        """
+        scale, offset = self._uint8_normalization()
+        np.multiply(images[..., ::-1].transpose((0, 3, 1, 2)), scale, out=out, dtype=np.float32)
+        out -= offset[:, np.newaxis, np.newaxis]
+
+    def _staging_buffers(self, n):
+        """
+        Returns two (n x H x W x 3) uint8 buffers of the calling thread, views on buffers which only grow when a larger `n` is needed.
+        """
+        buffers = getattr(self._staging, 'buffers', None)
+        if buffers is None or len(buffers[0]) < n:
+            shape = (n, self._input_height, self._input_width, 3)
+            buffers = (np.zeros(shape, dtype=np.uint8), np.zeros(shape, dtype=np.uint8))
+            self._staging.buffers = buffers
+        return buffers[0][:n], buffers[1][:n]
+
+    def new_batch_buffers(self, batch_size, unique_images=False):
+        """
+        Allocates the (images, annotations, mask) arrays for a batch of `batch_size` pairs, to be reused with `preprocess(..., out=)`.
+        With `unique_images` it allocates the (images, pair_indices, annotations, mask) arrays of `preprocess_unique_pair_batch`.
+        """
+        images = np.zeros((batch_size * 2, 3, self._input_height, self._input_width), dtype=np.float32)
+        annotations = np.zeros((batch_size), dtype=np.float32)
+        mask = np.ones((batch_size), dtype=np.int8)
+        if unique_images:
+            return images, np.zeros((batch_size, 2), dtype=np.int32), annotations, mask
+        return images, annotations, mask
+
+    def new_image_batch_buffers(self, num_images):
+        """
+        Allocates the (images, labels, mask) arrays for a batch of `num_images` images, to be reused with `preprocess_image_batch`.
+        """
+        return (np.zeros((num_images, 3, self._input_height, self._input_width), dtype=np.float32),
+                np.zeros((num_images), dtype=np.float32),
+                np.ones((num_images), dtype=np.int8))
+
+    def preprocess_images(self, image_addrs, out=None, augmentation=False):
+        """
+        Loads and preprocesses (without augmentation by default) the images at `image_addrs` into a (N x 3 x H x W) input array for
+        the network. If `out` is given, the images are written to it, it can have more rows than there are images.
+        """
+        if out is None:
+            out = np.zeros((len(image_addrs), 3, self._input_height, self._input_width), dtype=np.float32)
+        self._preprocess_addresses(image_addrs, augmentation, out[:len(image_addrs)])
+        return out[:len(image_addrs)]
+
+    def _preprocess_addresses(self, addresses, augmentation, images):
+        """
+        Fills `images` with the preprocessed images at `addresses`, the rows of the addresses which are `None` are set to zero.
+        """
+        valid = [i for i, address in enumerate(addresses) if address is not None]
+        if self.batch_augmentation or not augmentation:
+            resized, augmented = self._staging_buffers(len(images))
+            for i in valid:
+                resized[i, ...] = self._load_resized_uint8(addresses[i])
+
+            if augmentation:
+                if self._batch_augmenter is None:
+                    self._batch_augmenter = BatchAugmentation(self._input_height, self._input_width)
+                resized = self._batch_augmenter(resized, out=augmented)
+
+            self._normalize_uint8_batch(resized, images)
+        else:
+            for i in valid:
+                images[i, ...] = self._general_image_preprocess(self.load_image(addresses[i]), augmentation)
+
+        if len(valid) < len(images):
+            images[np.setdiff1d(np.arange(len(images)), valid), ...] = 0
+
+    def _preprocess_pairs(self, left, right, mask, augmentation, images):
+        """
+        Fills `images` with the preprocessed images of the pairs, the two images of a pair are next to each other.
+        `left` and `right` are the addresses of the first and the second images, they are ignored where `mask` is 0.
+        """
+        addresses = [None] * len(images)
+        for i in np.flatnonzero(mask):
+            addresses[2 * i] = left[i]
+            addresses[2 * i + 1] = right[i]
+        self._preprocess_addresses(addresses, augmentation, images)
+
     def output_for_image(self, image_addr):
         """
         This function gives you the output from the extractor for a single image.
@@ -91,7 +260,7 @@ class Extractor(object):
 
         This function is just here for historical reasons and for debugging.
         """
-        img = utils.load_image(image_addr)
+        img = self.load_image(image_addr)
         img = self._general_image_preprocess(img)
 
         data = np.zeros((1, 3, self._input_height, self._input_width), dtype=np.float32)
@@ -105,6 +274,18 @@ class Extractor(object):
     def get_output_layer(self):
         return self.out_layer
 
+    def get_frozen_feature_layer(self):
+        """
+        Returns the highest layer whose output is the same in training and testing: the input of the lowest dropout layer, or the
+        output layer if there is no dropout (e.g. `fc6` of VGG16 and `pool5/7x7_s1` of GoogLeNet).
+        The outputs of a frozen extractor are cached at this layer, so the layers above it, with their dropout, are still applied when
+        the ranker is trained on the cached outputs, the same as when it is trained on the images.
+        """
+        for layer in lasagne.layers.get_all_layers(self.out_layer):
+            if isinstance(layer, lasagne.layers.DropoutLayer):
+                return layer.input_layer
+        return self.out_layer
+
     def get_output_function(self, layer=None):
         inp = lasagne.utils.T.tensor4('inp')
         self.set_input_var(inp, batch_size=1)
@@ -114,24 +295,85 @@ class Extractor(object):
 
         return lasagne.utils.theano.function([inp], [out])
 
-    def preprocess(self, batch, augmentation=False):
-        batch_size = len(batch)
-        images = np.zeros((batch_size * 2, 3, self._input_height, self._input_width), dtype=np.float32)
-        annotations = np.zeros((batch_size), dtype=np.float32)
-        mask = np.ones((batch_size), dtype=np.int8)
-
+    def preprocess(self, batch, augmentation=False, out=None):
+        """
+        Preprocesses a batch from the dataset generators into the (images, annotations, mask) arrays for the network.
+        If `out` is given it must be a tuple of arrays with the same shapes and types (see `new_batch_buffers`), which will be filled
+        instead of new arrays.
+        """
+        if out is None:
+            images, annotations, mask = self.new_batch_buffers(len(batch))
+        else:
+            images, annotations, mask = out
+            annotations[...] = 0
+            mask[...] = 1
+
+        left = [None] * len(batch)
+        right = [None] * len(batch)
         for i, batch_item in enumerate(batch):
             if batch_item is None:
                 mask[i] = 0
                 continue
+            (left[i], right[i]), annotations[i] = batch_item
 
-            (img1_path, img2_path), target = batch_item
-            images[2 * i, ...] = self._general_image_preprocess(utils.load_image(img1_path), augmentation)
-            images[2 * i + 1, ...] = self._general_image_preprocess(utils.load_image(img2_path), augmentation)
-            annotations[i] = target
+        self._preprocess_pairs(left, right, mask, augmentation, images)
+        return images, annotations, mask
 
+    def preprocess_pair_batch(self, batch, image_addresses, augmentation=False, out=None):
+        """
+        Same as `preprocess` for a `datasets.PairBatch`, whose images are looked up by id in `image_addresses`.
+        """
+        if out is None:
+            images, annotations, mask = self.new_batch_buffers(len(batch.mask))
+        else:
+            images, annotations, mask = out
+        annotations[...] = batch.targets
+        mask[...] = batch.mask
+
+        left = [image_addresses[i] for i in batch.left]
+        right = [image_addresses[i] for i in batch.right]
+        self._preprocess_pairs(left, right, mask, augmentation, images)
         return images, annotations, mask
 
+    def preprocess_image_batch(self, batch, image_addresses, augmentation=False, out=None):
+        """
+        Preprocesses a `datasets.ImageBatch` into the (images, labels, mask) arrays for the network, the images are looked up by id
+        in `image_addresses`. If `out` is given it must be a tuple of arrays as allocated by `new_image_batch_buffers`.
+        """
+        if out is None:
+            images, labels, mask = self.new_image_batch_buffers(len(batch.mask))
+        else:
+            images, labels, mask = out
+        labels[...] = batch.labels
+        mask[...] = batch.mask
+
+        addresses = [image_addresses[i] if m else None for i, m in zip(batch.image_ids, batch.mask)]
+        self._preprocess_addresses(addresses, augmentation, images)
+        return images, labels, mask
+
+    def preprocess_unique_pair_batch(self, batch, image_addresses, augmentation=False, out=None):
+        """
+        Preprocesses a `datasets.PairBatch` into (images, pair_indices, annotations, mask), where each distinct image of the batch is
+        preprocessed (and augmented) only once. `images` has a row for each distinct image and `pair_indices` is the (batch_size x 2)
+        position of the two images of each pair in `images`, the padding pairs point to the first image.
+        If `out` is given it must be a tuple of arrays as allocated by `new_batch_buffers(batch_size, unique_images=True)`.
+        """
+        if out is None:
+            images, pair_indices, annotations, mask = self.new_batch_buffers(len(batch.mask), unique_images=True)
+        else:
+            images, pair_indices, annotations, mask = out
+        annotations[...] = batch.targets
+        mask[...] = batch.mask
+
+        valid = batch.mask == 1
+        image_ids, inverse = np.unique(np.stack([batch.left[valid], batch.right[valid]], axis=1), return_inverse=True)
+        pair_indices[...] = 0
+        pair_indices[valid] = inverse.reshape((-1, 2))
+
+        images = images[:len(image_ids)]
+        self._preprocess_addresses([image_addresses[i] for i in image_ids], augmentation, images)
+        return images, pair_indices, annotations, mask
+
 
 class GoogLeNet(Extractor):
     _input_height = 224
@@ -201,7 +443,7 @@ class GoogLeNet(Extractor):
         if self.weights is not None:
             init_weights = self._get_weights_from_file(self.weights, 'param values')
             init_weights = init_weights[:-2]  # since we have chopped off the last two layers of the network (loss3/classifier and prob), we won't need those
-            lasagne.layers.set_all_param_values(self.out_layer, init_weights)
+            self._set_weights(init_weights)
 
 
 class VGG16(Extractor):
@@ -247,7 +489,7 @@ class VGG16(Extractor):
         if self.weights is not None:
             init_weights = self._get_weights_from_file(self.weights, 'param values')
             init_weights = init_weights[:-2]  # since we have chopped off the last two layers of the network, we won't need those
-            lasagne.layers.set_all_param_values(self.out_layer, init_weights)
+            self._set_weights(init_weights)
 
 
 class InceptionV3(Extractor):
@@ -257,8 +499,9 @@ class InceptionV3(Extractor):
 
     def _general_image_preprocess(self, img, augmentation=False):
         if augmentation:
-            img = utils.random_augmentation(img)
-        img = utils.resize_image(img, (self._input_height, self._input_height))
+            img = utils.random_augmentation_resized(img, (self._input_height, self._input_width))
+        else:
+            img = utils.resize_image(img, (self._input_height, self._input_width))
 
         img = img.transpose((2, 0, 1))
         img = 2 * img[::-1, ...] - 1  # change image from (0, 1) to (-1, 1)
@@ -268,6 +511,9 @@ class InceptionV3(Extractor):
 
         return img
 
+    def _uint8_normalization(self):
+        return 2 / 255.0, 1 + np.array(self._input_mean_to_subtract, dtype=np.float32)
+
     def __init__(self, weights=None, augmentation=False):
         super(InceptionV3, self).__init__(weights, augmentation)
 
@@ -422,4 +668,4 @@ class InceptionV3(Extractor):
         if self.weights is not None:
             init_weights = self._get_weights_from_file(self.weights, 'param values')
             init_weights = init_weights[:-2]  # since we have chopped off the last two layers of the network (loss3/classifier and prob), we won't need those
-            lasagne.layers.set_all_param_values(self.out_layer, init_weights)
+            self._set_weights(init_weights)
@@ -0,0 +1,140 @@
+"""
+A persistent store of extractor outputs (features), so the network is run on an image only once for all the experiments which use the
+same frozen extractor on the same dataset.
+
+A store is a directory, named after the extractor class, the output layer, the hash of the weights file, the dataset class and the
+type of the stored features, with:
+    - `features.npy`: a (number of images x feature shape) array, or (number of images x variants x feature shape) for a store of
+      several augmented variants of each image, float32 or float16, which is read and written with a memory map.
+    - `present.npy`: a bool array which marks the images whose features have been computed.
+The rows are the image ids of the dataset (the index in `Dataset._image_addresses`), all the attributes and splits of a dataset share
+the store. The store is filled incrementally, only the images which are not present yet are computed.
+
+The features are only valid for the weights in the file, a store should not be used with an extractor which is being fine-tuned.
+"""
+import os
+import numpy as np
+import lasagne
+import boltons.fileutils
+import settings
+import utils
+
+_weights_hashes = {}
+
+
+def weights_hash(path):
+    """
+    Returns the md5 hash of a weights file, which is remembered as long as the file does not change.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if key not in _weights_hashes:
+        _weights_hashes[key] = utils.file_hash(path)
+    return _weights_hashes[key]
+
+
+def layer_name(extractor, layer):
+    for name, l in extractor.net.items():
+        if l is layer:
+            return name
+    raise Exception("The layer is not in the net of %s" % extractor.__class__.__name__)
+
+
+def store_path(dataset, extractor, layer=None, dtype=np.float32, root=None, variants=1):
+    """
+    Returns the path of the store of the outputs of `layer` for the images of `dataset`. By default the layer is the one at which a
+    frozen extractor is cached, `extractor.get_frozen_feature_layer()`.
+    """
+    if extractor.weights is None:
+        raise Exception("The features of an extractor without a weights file can not be stored")
+    if root is None:
+        root = settings.feature_root
+    if layer is None:
+        layer = extractor.get_frozen_feature_layer()
+    name = "%s-%s-%s-%s-%s" % (extractor.__class__.__name__, layer_name(extractor, layer).replace('/', '_'),
+                               weights_hash(extractor.weights)[:12], dataset.__class__.__name__, np.dtype(dtype).name)
+    if variants > 1:
+        name = "%s-x%d" % (name, variants)
+    return os.path.join(root, name)
+
+
+def open_feature_store(dataset, extractor, layer=None, dtype=np.float32, root=None, variants=1):
+    """
+    Opens (or creates) the `FeatureStore` of the outputs of `layer` of `extractor` for the images of `dataset`.
+    With `variants` > 1 each image has that many rows of features, the first one unaugmented and the others augmented.
+    """
+    if layer is None:
+        layer = extractor.get_frozen_feature_layer()
+    feature_shape = lasagne.layers.get_output_shape(layer, (None, 3, extractor._input_height, extractor._input_width))[1:]
+    if variants > 1:
+        feature_shape = (variants,) + tuple(feature_shape)
+    return FeatureStore(store_path(dataset, extractor, layer, dtype, root, variants), len(dataset._image_addresses), feature_shape,
+                        dtype)
+
+
+class FeatureStore(object):
+    """
+    The features of `num_images` images, each of `feature_shape`, stored with `dtype` in the directory `path`.
+
+    Example Usage:
+    >>> store = open_feature_store(dataset, extractor, dtype=np.float16)
+    >>> missing = store.missing(image_ids)
+    >>> store.put(missing, compute_features(missing))
+    >>> features = store.get(image_ids)
+    """
+
+    def __init__(self, path, num_images, feature_shape, dtype=np.float32):
+        self.path = path
+        dtype = np.dtype(dtype)
+        shape = (num_images,) + tuple(feature_shape)
+        features_path = os.path.join(path, 'features.npy')
+        present_path = os.path.join(path, 'present.npy')
+
+        if os.path.exists(features_path):
+            self._features = np.load(features_path, mmap_mode='r+')
+            self._present = np.load(present_path, mmap_mode='r+')
+            if self._features.shape != shape or self._features.dtype != dtype:
+                raise Exception("The feature store at %s has the shape %s and type %s instead of %s and %s" % (
+                    path, self._features.shape, self._features.dtype, shape, dtype))
+        else:
+            boltons.fileutils.mkdir_p(path)
+            self._features = np.lib.format.open_memmap(features_path, mode='w+', dtype=dtype, shape=shape)
+            self._present = np.lib.format.open_memmap(present_path, mode='w+', dtype=np.bool, shape=(num_images,))
+
+    @property
+    def feature_shape(self):
+        return self._features.shape[1:]
+
+    def __len__(self):
+        return len(self._features)
+
+    def __contains__(self, image_id):
+        return bool(self._present[image_id])
+
+    def missing(self, image_ids):
+        """
+        Returns the unique ids in `image_ids` whose features are not in the store.
+        """
+        image_ids = np.unique(image_ids)
+        return image_ids[~self._present[image_ids]]
+
+    def put(self, image_ids, features):
+        """
+        Stores the `features` of the images `image_ids`. The features are written before the images are marked as present.
+        """
+        image_ids = np.asarray(image_ids)
+        self._features[image_ids] = features
+        self._features.flush()
+        self._present[image_ids] = True
+        self._present.flush()
+
+    def get(self, image_ids, variants=None):
+        """
+        Returns the features of `image_ids` as a float32 array, all of them must be in the store.
+        For a store of augmented variants, `variants` picks one variant for each image.
+        """
+        image_ids = np.asarray(image_ids)
+        assert np.all(self._present[image_ids]), "some of the features are not in the store"
+        if variants is not None:
+            return self._features[image_ids, variants].astype(np.float32)
+        return self._features[image_ids].astype(np.float32)
@@ -0,0 +1,139 @@
+"""
+Cached dataset indexes: the arrays which a dataset helper builds from its annotation files (image addresses, pairs, targets, labels),
+stored once so later constructions only have to memory map them.
+
+An index is a directory with one `.npy` file per array, since the arrays of an `.npz` file can not be memory mapped, and a
+`meta.json` file with the version of the index format and the size, modification time and md5 hash of each of the source files.
+The index is rebuilt when the version or any of the source files change (or are missing). A source file whose modification time
+changed is hashed again, if its content is the same the index is still used and the new modification time is recorded.
+
+Several processes can use the same index at once: `meta.json` is replaced atomically, an index is written to a temporary directory and
+renamed in place, and an index is never deleted while it is up to date, since other processes may have its arrays memory mapped.
+"""
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+import settings
+import utils
+
+INDEX_VERSION = 1
+
+
+def _meta_path(path):
+    return os.path.join(path, 'meta.json')
+
+
+def _write_meta(path, meta):
+    # written next to it and renamed over it, so a concurrent reader never sees a partial file
+    tmp_path = '%s.%d.tmp' % (_meta_path(path), os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.rename(tmp_path, _meta_path(path))
+
+
+def _read_meta(path):
+    try:
+        with open(_meta_path(path)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _source_info(source, with_hash=True):
+    stat = os.stat(source)
+    info = {'path': os.path.abspath(source), 'size': stat.st_size, 'mtime': stat.st_mtime}
+    if with_hash:
+        info['md5'] = utils.file_hash(source)
+    return info
+
+
+def _is_fresh(meta, sources):
+    """
+    Returns whether the index described by `meta` was built from the current version of `sources`.
+    """
+    if meta.get('version') != INDEX_VERSION or len(meta['sources']) != len(sources):
+        return False
+    for info, source in zip(meta['sources'], sources):
+        try:
+            current = _source_info(source, with_hash=False)
+        except OSError:
+            # a missing source file
+            return False
+        if current['path'] != info['path'] or current['size'] != info['size']:
+            return False
+        if current['mtime'] != info['mtime'] and utils.file_hash(source) != info['md5']:
+            return False
+    return True
+
+
+def load_index(path, sources, mmap_mode='r'):
+    """
+    Returns the arrays of the index at `path`, memory mapped with `mmap_mode`, or `None` if there is no index or it is stale.
+    """
+    meta = _read_meta(path)
+    if meta is None or not _is_fresh(meta, sources):
+        return None
+
+    current = [_source_info(source, with_hash=False) for source in sources]
+    if any(info['mtime'] != source['mtime'] for info, source in zip(current, meta['sources'])):
+        # only touched, so the hashes do not have to be computed again next time
+        for info, source in zip(current, meta['sources']):
+            source['mtime'] = info['mtime']
+        _write_meta(path, meta)
+    return dict((key, np.load(os.path.join(path, '%s.npy' % key), mmap_mode=mmap_mode)) for key in meta['keys'])
+
+
+def save_index(path, sources, arrays):
+    """
+    Writes `arrays`, a dict of name to array, as the index at `path` built from `sources`.
+    The index is written to a temporary directory first and then moved in place, so a partial index is never read.
+    If another process has written an up to date index at `path` meanwhile, that one is kept. A stale index is moved aside before
+    it is deleted, so the rename never races with its deletion.
+    """
+    parent = os.path.dirname(path)
+    tmp_path = tempfile.mkdtemp(dir=parent)
+    for key, array in arrays.items():
+        np.save(os.path.join(tmp_path, '%s.npy' % key), array)
+    meta = {'version': INDEX_VERSION, 'keys': sorted(arrays.keys()), 'sources': [_source_info(source) for source in sources]}
+    _write_meta(tmp_path, meta)
+
+    while True:
+        try:
+            os.rename(tmp_path, path)
+            return
+        except OSError:
+            if not os.path.exists(path):
+                raise
+        existing = _read_meta(path)
+        if existing is not None and _is_fresh(existing, sources):
+            # written by another process in the meantime
+            shutil.rmtree(tmp_path)
+            return
+        stale_path = tempfile.mkdtemp(dir=parent)
+        try:
+            os.rename(path, os.path.join(stale_path, 'index'))
+        except OSError:
+            # moved by another process, try again
+            pass
+        shutil.rmtree(stale_path)
+
+
+def cached_index(name, sources, build, root=None):
+    """
+    Returns the arrays of the index `name`, built from the files in `sources`.
+    `build` is called without arguments and must return a dict of name to array, it is only called when there is no up to date index.
+    With `settings.CACHE_DATASET_INDEXES` set to `False` the index is always built and never stored.
+    """
+    if not settings.CACHE_DATASET_INDEXES:
+        return build()
+
+    if root is None:
+        root = settings.index_root
+    path = os.path.join(root, name)
+    arrays = load_index(path, sources)
+    if arrays is None:
+        save_index(path, sources, build())
+        arrays = load_index(path, sources)
+    return arrays
@@ -0,0 +1,277 @@
+import sys
+import threading
+import Queue
+import atexit
+import ctypes
+import traceback
+import weakref
+import multiprocessing
+import multiprocessing.sharedctypes
+import numpy as np
+import settings
+import utils
+
+
+_END = object()
+
+
+class Prefetcher(object):
+    """
+    Applies `function` to the items of `iterable` in background worker threads, so the next items are being prepared while the
+    consumer works on the current one.
+
+    At most `size` items are being prepared or are ready and waiting for the consumer at any time. The results are yielded in the
+    same order as the items of `iterable`. If `function` (or `iterable`) raises an exception in a worker, it is raised again in the
+    consumer with the original traceback.
+
+    With more than one worker the calls to numpy's global random number generator (e.g. for augmentation) can happen in a different
+    order in different runs.
+
+    Use it as a context manager, or call `close`, so the workers are stopped if the consumer stops before the end:
+    >>> with Prefetcher(dataset.train_batches(16), lambda b: extractor.preprocess_pair_batch(b, dataset._image_addresses)) as batches:
+    >>>     for images, targets, mask in batches:
+    >>>         # do something with the batch
+    """
+
+    def __init__(self, iterable, function, size=4, workers=1):
+        assert size >= 1 and workers >= 1
+        self._iterator = iter(iterable)
+        self._function = function
+        self._iterator_lock = threading.Lock()
+        self._num_taken = 0
+        self._slots = threading.Semaphore(size)
+        self._results = Queue.Queue()
+        self._stop = threading.Event()
+
+        self._threads = [threading.Thread(target=self._work) for _ in range(workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        while True:
+            self._slots.acquire()
+            if self._stop.is_set():
+                return
+
+            with self._iterator_lock:
+                index = self._num_taken
+                try:
+                    item = next(self._iterator)
+                except StopIteration:
+                    self._results.put((index, _END, None))
+                    return
+                except Exception:
+                    self._results.put((index, None, sys.exc_info()))
+                    return
+                self._num_taken += 1
+
+            try:
+                self._results.put((index, self._function(item), None))
+            except Exception:
+                self._results.put((index, None, sys.exc_info()))
+                return
+
+    def __iter__(self):
+        ready = {}
+        index = 0
+        try:
+            while True:
+                while index not in ready:
+                    try:
+                        # a timeout keeps the wait interruptible with Ctrl-C
+                        i, result, exc_info = self._results.get(timeout=1)
+                    except Queue.Empty:
+                        continue
+                    ready.setdefault(i, (result, exc_info))
+
+                result, exc_info = ready.pop(index)
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if result is _END:
+                    return
+
+                # let the workers start on another item while this one is being used
+                self._slots.release()
+                yield result
+                index += 1
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stops the workers, a worker which is in the middle of preparing an item finishes it first.
+        """
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        for _ in self._threads:
+            self._slots.release()
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# the preprocessors which are not closed yet, they are closed once at exit instead of registering an exit handler per preprocessor
+_open_preprocessors = weakref.WeakSet()
+
+
+@atexit.register
+def _close_preprocessors():
+    for preprocessor in list(_open_preprocessors):
+        preprocessor.close()
+
+
+def _shared_array(shape, dtype):
+    """
+    Allocates a numpy array in shared memory, which is visible to (forked) worker processes without copying.
+    """
+    dtype = np.dtype(dtype)
+    raw = multiprocessing.sharedctypes.RawArray(ctypes.c_byte, int(np.prod(shape)) * dtype.itemsize)
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+
+def _preprocess_worker(extractor, image_addresses, augmentation, seed, images, pair_indices, annotations, masks, tasks, done):
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+
+        stream, index, slot, batch = task
+        try:
+            # the random state only depends on the batch, not on which worker (or how many) do the work
+            np.random.seed([seed, stream, index])
+            n = len(batch.mask)
+            if pair_indices is None:
+                extractor.preprocess_pair_batch(batch, image_addresses, augmentation,
+                                                out=(images[slot, :(2 * n)], annotations[slot, :n], masks[slot, :n]))
+                num_images = 2 * n
+            else:
+                unique_images, _, _, _ = extractor.preprocess_unique_pair_batch(
+                    batch, image_addresses, augmentation, out=(images[slot, :(2 * n)], pair_indices[slot, :n], annotations[slot, :n],
+                                                               masks[slot, :n]))
+                num_images = len(unique_images)
+            done.put((index, slot, n, num_images, None))
+        except Exception:
+            done.put((index, slot, 0, 0, traceback.format_exc()))
+
+
+class SharedMemoryPreprocessor(object):
+    """
+    Preprocesses `datasets.PairBatch`es of the images in `image_addresses` with `extractor.preprocess_pair_batch` in worker processes,
+    which are not limited by the GIL like threads.
+
+    The workers write the preprocessed (images, annotations, mask) straight into a ring of `slots` shared memory buffers and the consumer
+    gets numpy views on these buffers, so the batches are never copied between processes. A yielded batch is only valid until the next
+    one is requested, since its slot is then reused.
+
+    Before preprocessing a batch, the worker seeds numpy's random state with `(seed, stream, index)`, where `index` is the position of
+    the batch in the iteration, so the augmentations are reproducible no matter how many workers there are. Use a different `stream`
+    for each epoch to get different augmentations.
+
+    The workers are forked, so they get a copy of the extractor. They only run numpy code, the theano functions are not used in them.
+    Each of them also has its own copy of `utils.image_cache`, so while the workers run `settings.IMAGE_CACHE_BYTES` is split evenly
+    between the caches of the main process and the workers.
+
+    With `unique_images` the batches are preprocessed with `extractor.preprocess_unique_pair_batch` and yielded as
+    (images, pair_indices, annotations, mask).
+    """
+
+    def __init__(self, extractor, image_addresses, batch_size, augmentation=False, workers=2, slots=4, seed=0, unique_images=False):
+        assert workers >= 1 and slots >= 1
+        self.batch_size = batch_size
+        self._slots = slots
+        self._images = _shared_array((slots, batch_size * 2, 3, extractor._input_height, extractor._input_width), np.float32)
+        self._annotations = _shared_array((slots, batch_size), np.float32)
+        self._masks = _shared_array((slots, batch_size), np.int8)
+        self._pair_indices = _shared_array((slots, batch_size, 2), np.int32) if unique_images else None
+        self._tasks = multiprocessing.Queue()
+        self._done = multiprocessing.Queue()
+        # set before forking, so the workers start with the share of the budget too
+        utils.image_cache.set_max_bytes(settings.IMAGE_CACHE_BYTES // (workers + 1))
+
+        args = (extractor, image_addresses, augmentation, seed, self._images, self._pair_indices, self._annotations, self._masks,
+                self._tasks, self._done)
+        self._processes = [multiprocessing.Process(target=_preprocess_worker, args=args) for _ in range(workers)]
+        for process in self._processes:
+            process.daemon = True
+            process.start()
+        _open_preprocessors.add(self)
+
+    def _get_done(self):
+        while True:
+            try:
+                # a timeout keeps the wait interruptible and lets us notice dead workers
+                return self._done.get(timeout=1)
+            except Queue.Empty:
+                if not all(process.is_alive() for process in self._processes):
+                    raise Exception("A preprocessing worker process has died")
+
+    def iterate(self, batches, stream=0):
+        """
+        Yields the preprocessed `batches`, in order, as (images, annotations, mask) views on the shared buffers (or as
+        (images, pair_indices, annotations, mask) with `unique_images`).
+        """
+        batches = iter(batches)
+        free_slots = range(self._slots)
+        ready = {}
+        num_sent = 0
+        num_received = 0
+        next_index = 0
+        current_slot = None
+        exhausted = False
+
+        try:
+            while True:
+                if current_slot is not None:
+                    free_slots.append(current_slot)
+                    current_slot = None
+
+                while free_slots and not exhausted:
+                    try:
+                        batch = next(batches)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    assert len(batch.mask) <= self.batch_size
+                    self._tasks.put((stream, num_sent, free_slots.pop(0), batch))
+                    num_sent += 1
+
+                if next_index == num_sent:
+                    return
+
+                while next_index not in ready:
+                    index, slot, n, num_images, error = self._get_done()
+                    num_received += 1
+                    ready[index] = (slot, n, num_images, error)
+
+                slot, n, num_images, error = ready.pop(next_index)
+                next_index += 1
+                if error is not None:
+                    free_slots.append(slot)
+                    raise Exception("Error in a preprocessing worker:\n%s" % error)
+
+                current_slot = slot
+                if self._pair_indices is None:
+                    yield self._images[slot, :num_images], self._annotations[slot, :n], self._masks[slot, :n]
+                else:
+                    yield self._images[slot, :num_images], self._pair_indices[slot, :n], self._annotations[slot, :n], self._masks[slot, :n]
+        finally:
+            # wait for the batches which are still being preprocessed, so their slots are not written to after being reused
+            while num_received < num_sent:
+                self._get_done()
+                num_received += 1
+
+    def close(self):
+        _open_preprocessors.discard(self)
+        for process in self._processes:
+            if process.is_alive():
+                self._tasks.put(None)
+        for process in self._processes:
+            process.join()
+        utils.image_cache.set_max_bytes(settings.IMAGE_CACHE_BYTES)
@@ -13,12 +13,15 @@ import logging
 import settings
 import os
 import utils
+import pipeline
+import checkpoints
 import matplotlib.pylab as plt
 import boltons
 import skimage.transform
 import skimage.filters
 import skimage.color
 import scipy
+import scipy.optimize
 from sklearn.manifold import TSNE
 from sklearn.preprocessing import normalize
 
@@ -37,7 +40,9 @@ class Ghiaseddin(object):
 
     def __init__(self, extractor, dataset, train_batch_size=16, extractor_learning_rate=1e-5, ranker_learning_rate=1e-4,
                  weight_decay=1e-5, optimizer=lasagne.updates.rmsprop, ranker_nonlinearity=lasagne.nonlinearities.linear, debug=False,
-                 do_log=True):
+                 do_log=True, precompute_features=False, prefetch_batches=4, prefetch_workers=1, augmentation_workers=0,
+                 unique_image_batches=False, group_pairs_by_image=False, all_pairs_in_batch=False, feature_store=None,
+                 cut_layer=None, cut_augmentations=0, chunk_batches=0, batch_augmentation=False):
 
         self.train_batch_size = train_batch_size
         self.extractor = extractor
@@ -49,35 +54,86 @@ class Ghiaseddin(object):
         self.ranker_learning_rate = ranker_learning_rate
         self.debug = debug
         self.do_log = do_log
+        # A frozen extractor (e.g. the baselines) always gives the same output for an image below its dropout layers when there is no
+        # augmentation, so with `precompute_features` that output is computed once per image and the ranker is trained on these cached
+        # features, only the dropout and the frozen layers above it are evaluated at each step. A feature store implies it.
+        # The network is then never trained on images, so `training_function` is not compiled (it is `None`).
+        precompute_features = precompute_features or feature_store is not None
+        self.precompute_features = precompute_features and extractor_learning_rate == 0 and not extractor.augmentation
+        # With `cut_layer`, the name of a layer in `extractor.net`, the layers up to the cut are frozen and their outputs are cached
+        # per image, only the layers above the cut are fine-tuned (with `extractor_learning_rate`) together with the ranker.
+        # With augmentation, `cut_augmentations` augmented variants of each image are cached and one of them is picked at random
+        # every time the image is in a training batch, the unaugmented variant is used for testing.
+        self.cut_layer = cut_layer
+        self.cut_augmentations = cut_augmentations
+        if cut_layer is not None:
+            if cut_layer not in extractor.net:
+                raise Exception("%s has no layer named %s" % (extractor.__class__.__name__, cut_layer))
+            if extractor.augmentation and cut_augmentations < 1:
+                raise Exception("A cut layer with augmentation needs at least one cached augmented variant (cut_augmentations)")
+            self.precompute_features = True
+        self._feature_variants = 1 + cut_augmentations if cut_layer is not None and extractor.augmentation else 1
+        self._feature_ids = None
+        self._features = None
+        # a `features.FeatureStore` of the extractor outputs on disk, which is filled and read instead of running the extractor
+        if feature_store is not None and cut_layer is None and (extractor_learning_rate != 0 or extractor.augmentation):
+            raise Exception("A feature store can only be used with a frozen extractor without augmentation")
+        self.feature_store = feature_store
+        # the training batches are loaded and preprocessed in background threads while the network is busy, 0 disables it
+        self.prefetch_batches = prefetch_batches
+        self.prefetch_workers = prefetch_workers
+        # if not 0, the training batches are preprocessed in this many worker processes instead of threads
+        self.augmentation_workers = augmentation_workers
+        # if True, the training batches are augmented all at once with `augmentation.BatchAugmentation` instead of image by image, the
+        # transformations are drawn from the same distributions but not with the same random numbers as the per image augmentation
+        self.batch_augmentation = batch_augmentation
+        self.extractor.batch_augmentation = batch_augmentation
+        self._preprocessor = None
+        self._num_train_epochs_started = 0
+        # the input arrays of the network are allocated once and reused for every batch
+        self._train_buffers = None
+        self._input_buffer = None
+        # if True, each distinct image of a training batch is passed through the network once and the rank estimates are gathered
+        # for the pairs, with `group_pairs_by_image` the batches are sampled so their pairs share as many images as possible
+        self.unique_image_batches = unique_image_batches
+        self.group_pairs_by_image = group_pairs_by_image
+        # if True, a training batch is `2 * train_batch_size` images with their labels instead of pairs, and the loss is over all the
+        # pairs of these images, this needs a dataset with per image labels (OSR and PubFig)
+        self.all_pairs_in_batch = all_pairs_in_batch
+        if all_pairs_in_batch:
+            if not dataset.has_train_image_labels():
+                raise Exception("Training on all the pairs in a batch needs per image labels, which %s does not have" %
+                                dataset.__class__.__name__)
+            if unique_image_batches or group_pairs_by_image or augmentation_workers > 0:
+                raise Exception("all_pairs_in_batch can not be used with unique_image_batches, group_pairs_by_image or augmentation_workers")
+
+        # if not 0, this many training batches are uploaded at once into shared variables and the training steps index into them,
+        # instead of passing the arrays of each batch to the training function (see `_chunked_train_steps`)
+        self.chunk_batches = chunk_batches
+        if chunk_batches > 0 and unique_image_batches:
+            raise Exception("chunk_batches can not be used with unique_image_batches, the batches do not have the same number of images")
+        self.chunk_training_function = None
+        self._host_chunks = None
 
         if force_not_log:
             self.do_log = False
             logger.warning('Not logging because pastalog is not installed.')
 
-        extractor_name = self.extractor.__class__.__name__
-        if extractor.augmentation:
-            extractor_name = "%s-aug" % extractor_name
-
-        self.NAME = "e:%s-d:%s-bs:%d-elr:%f-rlr:%f-opt:%s-rnl:%s-wd:%f-rs:%s" % (extractor_name,
-                                                                                 self.dataset.get_name(),
-                                                                                 self.train_batch_size,
-                                                                                 extractor_learning_rate,
-                                                                                 ranker_learning_rate,
-                                                                                 self.optimizer.__name__,
-                                                                                 self.ranker_nonlinearity.__name__,
-                                                                                 self.weight_decay,
-                                                                                 str(settings.RANDOM_SEED))
+        self.NAME = self._model_name()
         if self.do_log:
             self.pastalog = Log('http://localhost:8100/', self.NAME)
 
-        # TODO: check if converting these to shared variable actually improves
-        # performance.
+        # the batches are passed to the training function as arrays, with `chunk_batches` they are given from shared variables instead
         self.input_var = T.ftensor4('inputs')
         self.target_var = T.fvector('targets')
 
         self.extractor.set_input_var(
             self.input_var, batch_size=train_batch_size)
         self.extractor_layer = self.extractor.get_output_layer()
+        # the layer whose outputs are cached when the features are precomputed, for a frozen extractor it is below its dropout layers
+        # (see `Extractor.get_frozen_feature_layer`) so the ranker is still trained with the dropout
+        self.feature_layer = self.extractor.net[cut_layer] if cut_layer is not None else self.extractor.get_frozen_feature_layer()
+        self._check_feature_store(feature_store)
 
         self.extractor_learning_rate_shared_var = theano.shared(
             np.cast['float32'](extractor_learning_rate), name='extractor_learning_rate')
@@ -100,13 +156,18 @@ class Ghiaseddin(object):
         self.posterior_estimate.params[
             self.posterior_estimate.b].remove('trainable')
 
-        # the clipping is done to prevent the model from diverging as caused by
-        # binary XEnt
-        self.predictions = T.clip(lasagne.layers.get_output(
-            self.posterior_estimate).ravel(), self._epsilon, 1.0 - self._epsilon)
+        # the inputs of the training functions besides the images (or features) of the batch
+        self._label_inputs = self._create_label_inputs()
+        if self.unique_image_batches:
+            # the input is the distinct images of the batch, the estimates of the two images of each pair are gathered by index
+            self.pair_indices_var = T.imatrix('pair_indices')
+            rank_estimates = lasagne.layers.get_output(self.absolute_rank_estimate).ravel()[self.pair_indices_var]
+            self._training_inputs = [self.input_var, self.pair_indices_var] + self._label_inputs
+        else:
+            rank_estimates = lasagne.layers.get_output(self.absolute_rank_estimate)
+            self._training_inputs = [self.input_var] + self._label_inputs
 
-        self.xent_loss = lasagne.objectives.binary_crossentropy(
-            self.predictions, self.target_var).mean()
+        self.xent_loss = self._xent(rank_estimates)
         self.l2_penalty = lasagne.regularization.regularize_network_params(
             self.absolute_rank_estimate, lasagne.regularization.l2)
         self.loss = self.xent_loss + self.l2_penalty * self.weight_decay
@@ -116,33 +177,153 @@ class Ghiaseddin(object):
 
         self._create_theano_functions()
 
-    def _create_theano_functions(self):
+    def _model_name(self):
+        extractor_name = self.extractor.__class__.__name__
+        if self.extractor.augmentation:
+            extractor_name = "%s-aug" % extractor_name
+        if self.cut_layer is not None:
+            extractor_name = "%s-cut:%s" % (extractor_name, self.cut_layer.replace('/', '_'))
+
+        return "e:%s-d:%s-bs:%d-elr:%f-rlr:%f-opt:%s-rnl:%s-wd:%f-rs:%s" % (extractor_name,
+                                                                            self.dataset.get_name(),
+                                                                            self.train_batch_size,
+                                                                            self.extractor_learning_rate,
+                                                                            self.ranker_learning_rate,
+                                                                            self.optimizer.__name__,
+                                                                            self.ranker_nonlinearity.__name__,
+                                                                            self.weight_decay,
+                                                                            str(settings.RANDOM_SEED))
+
+    def _check_feature_store(self, feature_store):
+        if feature_store is None:
+            return
+        feature_shape = lasagne.layers.get_output_shape(self.feature_layer)[1:]
+        if self._feature_variants > 1:
+            feature_shape = (self._feature_variants,) + feature_shape
+        if tuple(feature_store.feature_shape) != tuple(feature_shape):
+            raise Exception("The feature store has the feature shape %s instead of %s" % (feature_store.feature_shape, feature_shape))
+
+    def _create_label_inputs(self):
+        if self.all_pairs_in_batch:
+            self.labels_var = T.fvector('labels')
+            self.label_mask_var = T.fvector('label_mask')
+            return [self.labels_var, self.label_mask_var]
+        return [self.target_var]
+
+    def _xent(self, rank_estimates):
         """
-        Will be creating theano functions for training and testing
+        The training loss of a batch given the absolute rank estimates of its images, the two images of each pair are next to each other.
         """
-        if self.extractor_learning_rate != 0:
-            self._feature_extractor_updates = self.optimizer(
-                self.loss, self.extractor_params, learning_rate=self.extractor_learning_rate_shared_var)
-        else:
-            self._feature_extractor_updates = OrderedDict()
+        if self.all_pairs_in_batch:
+            return self._all_pairs_xent(rank_estimates.ravel())
 
-        if self.ranker_learning_rate != 0:
-            self._ranker_updates = self.optimizer(
-                self.loss, self.ranker_params, learning_rate=self.ranker_learning_rate_shared_var)
-        else:
-            self._ranker_updates = OrderedDict()
+        # the clipping is done to prevent the model from diverging as caused by
+        # binary XEnt
+        predictions = T.clip(lasagne.layers.get_output(self.posterior_estimate, inputs={
+            self.reshaped_input: rank_estimates.reshape((-1, 2))}).ravel(), self._epsilon, 1.0 - self._epsilon)
+        return lasagne.objectives.binary_crossentropy(predictions, self.target_var).mean()
+
+    def _all_pairs_xent(self, estimates):
+        """
+        The mean binary cross entropy over all the pairs (i, j), i < j, of the images of a batch, given their absolute rank `estimates`.
+        The posterior of a pair is the same as `posterior_estimate`: sigmoid(estimate_i - estimate_j), its target comes from the labels.
+        Pairs with a padding image (`label_mask_var` is 0) or with an unlabeled image (a negative label) are not counted.
+        """
+        posteriors = T.clip(T.nnet.sigmoid(estimates[:, np.newaxis] - estimates[np.newaxis, :]), self._epsilon, 1.0 - self._epsilon)
+        labels = self.labels_var
+        targets = T.cast(T.gt(labels[:, np.newaxis], labels[np.newaxis, :]), 'float32') + \
+            0.5 * T.cast(T.eq(labels[:, np.newaxis], labels[np.newaxis, :]), 'float32')
 
-        f = self._feature_extractor_updates.items()
-        r = self._ranker_updates.items()
-        f.extend(r)
+        positions = T.arange(estimates.shape[0])
+        image_mask = self.label_mask_var * T.cast(T.ge(labels, 0), 'float32')
+        pair_mask = image_mask[:, np.newaxis] * image_mask[np.newaxis, :] * T.gt(positions[np.newaxis, :], positions[:, np.newaxis])
 
-        self._all_updates = OrderedDict(f)
+        xent = lasagne.objectives.binary_crossentropy(posteriors, targets)
+        return T.sum(xent * pair_mask) / T.maximum(T.sum(pair_mask), 1)
 
-        self.training_function = theano.function([self.input_var, self.target_var], [
-                                                 self.loss, self.xent_loss, self.l2_penalty], updates=self._all_updates)
+    def _create_theano_functions(self):
+        """
+        Will be creating theano functions for training and testing
+        """
+        if self.precompute_features:
+            # the whole network is never trained on images, the training steps run on the cached features
+            self.training_function = None
+        else:
+            if self.extractor_learning_rate != 0:
+                self._feature_extractor_updates = self.optimizer(
+                    self.loss, self.extractor_params, learning_rate=self.extractor_learning_rate_shared_var)
+            else:
+                self._feature_extractor_updates = OrderedDict()
+
+            if self.ranker_learning_rate != 0:
+                self._ranker_updates = self.optimizer(
+                    self.loss, self.ranker_params, learning_rate=self.ranker_learning_rate_shared_var)
+            else:
+                self._ranker_updates = OrderedDict()
+
+            f = self._feature_extractor_updates.items()
+            r = self._ranker_updates.items()
+            f.extend(r)
+
+            self._all_updates = OrderedDict(f)
+            self._training_outputs = [self.loss, self.xent_loss, self.l2_penalty]
+
+            self.training_function = theano.function(self._training_inputs, self._training_outputs, updates=self._all_updates)
         self.testing_function = theano.function(
             [self.input_var], self.test_absolute_rank_estimate)
 
+        if self.precompute_features:
+            self._create_feature_theano_functions()
+
+    def _create_feature_theano_functions(self):
+        """
+        Will be creating theano functions for training on precomputed outputs of `feature_layer`.
+        The output of the feature layer is replaced with `feature_var`, so only the layers above it (if any) and the ranker are evaluated
+        at each step. The parameters below the feature layer are frozen.
+        """
+        feature_ndim = len(lasagne.layers.get_output_shape(self.feature_layer))
+        self.feature_var = T.TensorType('float32', (False,) * feature_ndim)('features')
+        feature_inputs = {self.feature_layer: self.feature_var}
+
+        self.feature_function = theano.function(
+            [self.input_var], lasagne.layers.get_output(self.feature_layer, deterministic=True))
+
+        # the features of the two images of each pair are next to each other, also with `unique_image_batches`
+        feature_xent_loss = self._xent(lasagne.layers.get_output(self.absolute_rank_estimate, inputs=feature_inputs))
+        feature_training_inputs = [self.feature_var] + self._label_inputs
+
+        # the extractor parameters above the cut are trained, the ones up to the cut are frozen
+        frozen_params = set(lasagne.layers.get_all_params(self.feature_layer))
+        self.above_cut_params = [p for p in self.extractor_params if p not in frozen_params]
+        regularizable_params = lasagne.layers.get_all_params(self.extractor_layer, regularizable=True)
+
+        # the penalty of the frozen extractor parameters is a constant, so it is computed only once
+        frozen_l2_penalty = np.cast['float32'](lasagne.regularization.apply_penalty(
+            [p for p in regularizable_params if p in frozen_params], lasagne.regularization.l2).eval())
+        ranker_regularizable = [p for p in lasagne.layers.get_all_params(self.absolute_rank_estimate, regularizable=True)
+                                if p not in set(regularizable_params)]
+        feature_l2_penalty = lasagne.regularization.apply_penalty(ranker_regularizable, lasagne.regularization.l2) + frozen_l2_penalty
+        above_cut_regularizable = [p for p in regularizable_params if p not in frozen_params]
+        if above_cut_regularizable:
+            feature_l2_penalty += lasagne.regularization.apply_penalty(above_cut_regularizable, lasagne.regularization.l2)
+        feature_loss = feature_xent_loss + feature_l2_penalty * self.weight_decay
+
+        if self.extractor_learning_rate != 0 and self.above_cut_params:
+            feature_updates = self.optimizer(
+                feature_loss, self.above_cut_params, learning_rate=self.extractor_learning_rate_shared_var)
+        else:
+            feature_updates = OrderedDict()
+        if self.ranker_learning_rate != 0:
+            feature_updates.update(self.optimizer(
+                feature_loss, self.ranker_params, learning_rate=self.ranker_learning_rate_shared_var))
+
+        self._feature_training_inputs = feature_training_inputs
+        self._feature_training_outputs = [feature_loss, feature_xent_loss, feature_l2_penalty]
+        self._feature_updates = feature_updates
+        self.feature_training_function = theano.function(feature_training_inputs, self._feature_training_outputs, updates=feature_updates)
+        self.feature_testing_function = theano.function(
+            [self.feature_var], lasagne.layers.get_output(self.absolute_rank_estimate, inputs=feature_inputs, deterministic=True))
+
     def _create_absolute_rank_estimate(self, incoming):
         """
         An abstraction around the absolute rank estimate.
@@ -155,12 +336,191 @@ class Ghiaseddin(object):
         # all the params of all the layers
         return absolute_rank_estimate_layer, absolute_rank_estimate_layer.get_params()
 
+    def _preprocess_images(self, image_ids, augmentation=False):
+        """
+        Loads and preprocesses (without augmentation by default) the images in `image_ids` into a single input array for the network.
+        The array is a view on a buffer which is reused by the next call.
+        """
+        if self._input_buffer is None or len(self._input_buffer) < len(image_ids):
+            self._input_buffer = np.zeros((len(image_ids), 3, self.extractor._input_height, self.extractor._input_width),
+                                          dtype=np.float32)
+        return self.extractor.preprocess_images([self.dataset._image_addresses[image_id] for image_id in image_ids],
+                                                out=self._input_buffer, augmentation=augmentation)
+
+    def _fill_feature_store(self, image_ids):
+        """
+        Computes and adds to the feature store the features of the images in `image_ids` which are not in it yet.
+        """
+        missing = self.feature_store.missing(image_ids)
+        if len(missing) > 0:
+            self.feature_store.put(missing, self._compute_features(missing))
+
+    def _compute_features(self, image_ids):
+        """
+        Runs the network up to the feature layer on the images in `image_ids`. With cached augmented variants, the result is
+        (n x variants x feature shape), the first variant is the unaugmented image.
+        """
+        if getattr(self, 'feature_function', None) is None:
+            self.feature_function = theano.function(
+                [self.input_var], lasagne.layers.get_output(self.feature_layer, deterministic=True))
+
+        feature_shape = tuple(lasagne.layers.get_output_shape(self.feature_layer)[1:])
+        if self._feature_variants > 1:
+            feature_shape = (self._feature_variants,) + feature_shape
+        features = np.zeros((len(image_ids),) + feature_shape, dtype=np.float32)
+
+        chunk_size = self.train_batch_size * 2
+        for start in range(0, len(image_ids), chunk_size):
+            chunk = image_ids[start:(start + chunk_size)]
+            if self._feature_variants == 1:
+                features[start:(start + len(chunk))] = self.feature_function(self._preprocess_images(chunk))
+            else:
+                for variant in range(self._feature_variants):
+                    features[start:(start + len(chunk)), variant] = self.feature_function(
+                        self._preprocess_images(chunk, augmentation=variant > 0))
+
+        return features
+
+    def _cache_features(self, image_ids):
+        """
+        Makes sure the features of all of `image_ids` are cached, only extracting the missing ones.
+        With a feature store the store is the cache, otherwise they are kept in memory, sorted by image id, so rows can be found with
+        `np.searchsorted(self._feature_ids, ...)`.
+        """
+        if self.feature_store is not None:
+            self._fill_feature_store(image_ids)
+            return
+
+        image_ids = np.unique(image_ids)
+        if self._feature_ids is not None:
+            image_ids = np.setdiff1d(image_ids, self._feature_ids, assume_unique=True)
+        if len(image_ids) == 0:
+            return
+
+        tic = dt.now()
+        num_extracted = len(image_ids)
+        features = self._compute_features(image_ids)
+        if self._feature_ids is not None:
+            image_ids = np.concatenate([self._feature_ids, image_ids])
+            features = np.concatenate([self._features, features])
+            order = np.argsort(image_ids)
+            image_ids = image_ids[order]
+            features = features[order]
+        self._feature_ids = image_ids
+        self._features = features
+        toc = dt.now()
+
+        if self.debug:
+            logger.info("Extracting features for %d images took: %s", num_extracted, str(toc - tic))
+
+    def _cached_features(self, image_ids, train=False):
+        """
+        Returns the cached features of `image_ids`, which must have been cached with `_cache_features`.
+        With cached augmented variants, a random augmented variant of each image is used for training, the unaugmented one otherwise.
+        """
+        image_ids = np.asarray(image_ids)
+        variants = None
+        if self._feature_variants > 1:
+            if train:
+                variants = np.random.randint(1, self._feature_variants, size=len(image_ids))
+            else:
+                variants = np.zeros((len(image_ids),), dtype=np.int)
+
+        if self.feature_store is not None:
+            return self.feature_store.get(image_ids, variants)
+        rows = np.searchsorted(self._feature_ids, image_ids)
+        return self._features[rows] if variants is None else self._features[rows, variants]
+
+    def _feature_train_batches(self):
+        """
+        Same as iterating over `dataset.train_batches(shuffle=True, cut_tail=True)` and preprocessing the batches, but
+        the images are replaced by their cached features.
+        """
+        self._cache_features(self.dataset.image_ids())
+
+        if self.all_pairs_in_batch:
+            for batch in self.dataset.train_image_batches(batch_size=self.train_batch_size * 2, shuffle=True, cut_tail=True):
+                yield self._cached_features(batch.image_ids, train=True), batch.labels, batch.mask
+            return
+
+        for batch in self._sample_train_batches():
+            # the two images of each pair are next to each other, like in `extractor.preprocess_pair_batch`
+            image_ids = np.stack([batch.left, batch.right], axis=1).ravel()
+            yield self._cached_features(image_ids, train=True), batch.targets, batch.mask
+
+    def _sample_train_batches(self):
+        if self.all_pairs_in_batch:
+            # as many images as a batch of pairs has, so a step costs the same
+            return self.dataset.train_image_batches(batch_size=self.train_batch_size * 2, shuffle=True, cut_tail=True)
+        if self.group_pairs_by_image:
+            return self.dataset.shared_image_batches(batch_size=self.train_batch_size, cut_tail=True)
+        return self.dataset.train_batches(batch_size=self.train_batch_size, shuffle=True, cut_tail=True)
+
+    def _preprocess_train_batch(self, batch, out):
+        if self.all_pairs_in_batch:
+            preprocess_pair_batch = self.extractor.preprocess_image_batch
+        elif self.unique_image_batches:
+            preprocess_pair_batch = self.extractor.preprocess_unique_pair_batch
+        else:
+            preprocess_pair_batch = self.extractor.preprocess_pair_batch
+        return preprocess_pair_batch(batch, self.dataset._image_addresses, self.extractor.augmentation, out=out)
+
+    def _train_batches(self):
+        """
+        Yields the preprocessed training minibatches for one epoch.
+        The arrays of a batch are reused, they are only valid until the next batch is requested.
+        """
+        if self.precompute_features:
+            for preprocessed_input in self._feature_train_batches():
+                yield preprocessed_input
+        else:
+            train_batches = self._sample_train_batches()
+
+            # a batch is being used by the network while the prefetcher prepares up to `prefetch_batches` more
+            num_buffers = self.prefetch_batches + 1 if self.augmentation_workers == 0 else 0
+            if self._train_buffers is None or len(self._train_buffers) != num_buffers:
+                if self.all_pairs_in_batch:
+                    self._train_buffers = [self.extractor.new_image_batch_buffers(self.train_batch_size * 2) for _ in range(num_buffers)]
+                else:
+                    self._train_buffers = [self.extractor.new_batch_buffers(self.train_batch_size, self.unique_image_batches)
+                                           for _ in range(num_buffers)]
+
+            def preprocess(item):
+                i, b = item
+                return self._preprocess_train_batch(b, self._train_buffers[i % num_buffers])
+
+            self._num_train_epochs_started += 1
+            if self.augmentation_workers > 0:
+                if self._preprocessor is None:
+                    self._preprocessor = pipeline.SharedMemoryPreprocessor(
+                        self.extractor, self.dataset._image_addresses, self.train_batch_size, augmentation=self.extractor.augmentation,
+                        workers=self.augmentation_workers, slots=max(self.prefetch_batches, self.augmentation_workers) + 1,
+                        seed=settings.RANDOM_SEED, unique_images=self.unique_image_batches)
+                for preprocessed_input in self._preprocessor.iterate(train_batches, stream=self._num_train_epochs_started):
+                    yield preprocessed_input
+            elif self.prefetch_batches > 0:
+                with pipeline.Prefetcher(enumerate(train_batches), preprocess, size=self.prefetch_batches,
+                                         workers=self.prefetch_workers) as batches:
+                    for preprocessed_input in batches:
+                        yield preprocessed_input
+            else:
+                for item in enumerate(train_batches):
+                    yield preprocess(item)
+
+    def _step_inputs(self, preprocessed_input):
+        # the last item is the mask, which is only used by the loss over all the pairs in the batch
+        return preprocessed_input if self.all_pairs_in_batch else preprocessed_input[:-1]
+
     def _train_1_batch(self, preprocessed_input):
         tic = dt.now()
-        input_data, input_target, input_mask = preprocessed_input
-        loss, xent_loss, l2_penalty = self.training_function(
-            input_data, input_target)
+        if self.precompute_features:
+            training_function = self.feature_training_function
+        else:
+            training_function = self.training_function
+        loss, xent_loss, l2_penalty = training_function(*self._step_inputs(preprocessed_input))
+        return self._log_train_step(tic, loss, xent_loss, l2_penalty)
 
+    def _log_train_step(self, tic, loss, xent_loss, l2_penalty):
         # log the losses
         if not np.isnan(loss):
             if self.do_log:
@@ -179,19 +539,108 @@ class Ghiaseddin(object):
             logger.debug("%d minibatch took: %s" % (self.log_step, str(toc - tic)))
         return loss
 
+    def _train_chunks(self):
+        """
+        Yields the training batches of one epoch stacked into chunks of `chunk_batches` batches, as (arrays, number of batches).
+        The arrays have the types of the inputs of the training function. There are two sets of chunk arrays, which are used in turn,
+        so a chunk is valid until the one after the next is requested.
+        """
+        num_batches = 0
+        num_chunks = 0
+        chunk = None
+        for preprocessed_input in self._train_batches():
+            inputs = self._step_inputs(preprocessed_input)
+            if self._host_chunks is None:
+                types = self._feature_training_inputs if self.precompute_features else self._training_inputs
+                self._host_chunks = [[np.zeros((self.chunk_batches * len(a),) + a.shape[1:], dtype=v.dtype) for v, a in zip(types, inputs)]
+                                     for _ in range(2)]
+            if num_batches == 0:
+                chunk = self._host_chunks[num_chunks % 2]
+
+            for c, a in zip(chunk, inputs):
+                c[(num_batches * len(a)):((num_batches + 1) * len(a))] = a
+            num_batches += 1
+
+            if num_batches == self.chunk_batches:
+                yield chunk, num_batches
+                num_batches = 0
+                num_chunks += 1
+        if num_batches > 0:
+            yield chunk, num_batches
+
+    def _create_chunk_theano_functions(self):
+        """
+        Creates the shared variables which hold two chunks of training batches on the device, a function which uploads a chunk into
+        them and a training function which takes the index of a batch in the shared variables instead of its arrays.
+        """
+        if self.precompute_features:
+            inputs, outputs, updates = self._feature_training_inputs, self._feature_training_outputs, self._feature_updates
+        else:
+            inputs, outputs, updates = self._training_inputs, self._training_outputs, self._all_updates
+
+        batch_index = T.lscalar('batch_index')
+        chunk_offset = T.lscalar('chunk_offset')
+        givens = OrderedDict()
+        upload_inputs = [chunk_offset]
+        upload_updates = OrderedDict()
+        self._chunk_buffers = []
+        for var, host_chunk in zip(inputs, self._host_chunks[0]):
+            rows = len(host_chunk) // self.chunk_batches
+            buffer = theano.shared(np.zeros((2 * len(host_chunk),) + host_chunk.shape[1:], dtype=var.dtype),
+                                   name='%s_chunks' % var.name, borrow=True)
+            givens[var] = buffer[(batch_index * rows):((batch_index + 1) * rows)]
+
+            chunk_var = var.type('%s_chunk' % var.name)
+            upload_inputs.append(chunk_var)
+            upload_updates[buffer] = T.set_subtensor(buffer[(chunk_offset * rows):(chunk_offset * rows + chunk_var.shape[0])], chunk_var)
+            self._chunk_buffers.append(buffer)
+
+        self._upload_chunk_function = theano.function(upload_inputs, [], updates=upload_updates)
+        self.chunk_training_function = theano.function([batch_index], outputs, updates=updates, givens=givens)
+
+    def _chunked_train_steps(self):
+        """
+        Trains on the batches of one epoch in chunks: the chunk is uploaded to the shared variables with one call and the training
+        steps only pass the index of their batch. The next chunk is assembled on the host in a background thread meanwhile.
+        The shared variables hold two chunks and the uploads alternate between them, so an upload never overwrites the chunk which is
+        being trained on, even when the device works asynchronously.
+        Yields the loss of each step.
+        """
+        if self.precompute_features:
+            # extracted here, so the theano feature function is not run in the background thread
+            self._cache_features(self.dataset.image_ids())
+        with pipeline.Prefetcher(self._train_chunks(), lambda chunk: chunk, size=1) as chunks:
+            for i, (chunk, num_batches) in enumerate(chunks):
+                if self.chunk_training_function is None:
+                    self._create_chunk_theano_functions()
+                offset = (i % 2) * self.chunk_batches
+                self._upload_chunk_function(offset, *[c[:(num_batches * (len(c) // self.chunk_batches))] for c in chunk])
+                for b in range(num_batches):
+                    tic = dt.now()
+                    loss, xent_loss, l2_penalty = self.chunk_training_function(offset + b)
+                    yield self._log_train_step(tic, loss, xent_loss, l2_penalty)
+
+    def _train_steps(self):
+        """
+        Trains on the batches of one epoch, yielding the loss of each step.
+        """
+        if self.chunk_batches > 0:
+            for loss in self._chunked_train_steps():
+                yield loss
+        else:
+            for preprocessed_input in self._train_batches():
+                yield self._train_1_batch(preprocessed_input)
+
     def train_one_epoch(self):
         tic = dt.now()
-        train_generator = self.dataset.train_generator(
-            batch_size=self.train_batch_size, shuffle=True, cut_tail=True)
         losses = []
-        for i, b in enumerate(train_generator):
-            preprocessed_input = self.extractor.preprocess(b, self.extractor.augmentation)
-            batch_loss = self._train_1_batch(preprocessed_input)
+        for batch_loss in self._train_steps():
             losses.append(batch_loss)
         toc = dt.now()
 
         if self.debug:
             logger.info("Training for 1 epoch took: %s", str(toc - tic))
+            logger.info("Image cache: %s", str(utils.image_cache.stats()))
         return losses
 
     def train_n_epoch(self, n):
@@ -204,26 +653,119 @@ class Ghiaseddin(object):
         total_epochs = 0
         finished = False
         while True and not finished:
-            train_generator = self.dataset.train_generator(
-                batch_size=self.train_batch_size, shuffle=True, cut_tail=True)
-            for i, b in enumerate(train_generator):
-                preprocessed_input = self.extractor.preprocess(b, self.extractor.augmentation)
-                batch_loss = self._train_1_batch(preprocessed_input)
+            train_steps = self._train_steps()
+            for batch_loss in train_steps:
                 losses.append(batch_loss)
                 current_iter += 1
                 if current_iter >= n:
                     finished = True
+                    # stops the background prefetching of the rest of the epoch
+                    train_steps.close()
                     break
             if not finished:
                 total_epochs += 1
 
         return losses, total_epochs
 
-    def _test_rank_estimate(self, preprocessed_input):
-        input_data, input_target, input_mask = preprocessed_input
-        rank_estimates = self.testing_function(input_data)
+    def solve_ranker(self, method='L-BFGS-B', max_iter=500, tol=1e-6):
+        """
+        Trains the ranker on the cached features of all the training pairs at once with a second order solver, instead of minibatch
+        updates. Only for a frozen extractor whose outputs are precomputed (the baselines), where the loss is a convex function of the
+        ranker weights: the mean binary cross entropy of sigmoid(f_left . W - f_right . W) plus the L2 penalty of W.
+
+        `method` is 'L-BFGS-B' or 'Newton-CG' of `scipy.optimize.minimize`, the loss, its gradient and Hessian products come from
+        `utils.pairwise_logistic_objective`, which never builds the pair difference features. The bias cancels out in the pair
+        differences, so it is left as it is.
+        The features are the deterministic outputs of the extractor, its dropout is not applied like when training with minibatches.
+        The solution is written into the weights of `absolute_rank_estimate`, so it is evaluated and saved like a trained ranker.
+        Returns the final training loss, without the constant penalty of the frozen extractor.
+        """
+        self._check_linear_ranker()
+        if not self.precompute_features or self.cut_layer is not None or self._feature_variants > 1:
+            raise Exception("The ranker can only be solved on the precomputed outputs of a frozen extractor")
+        if method not in ('L-BFGS-B', 'Newton-CG'):
+            raise Exception("Unknown solver method %s" % method)
+
+        tic = dt.now()
+        image_ids = self.dataset.image_ids()
+        self._cache_features(image_ids)
+        features = self._extractor_outputs(image_ids).reshape((len(image_ids), -1))
+        pairs = np.searchsorted(image_ids, np.asarray(self.dataset._train_pairs[:]))
+        targets = np.asarray(self.dataset._train_targets[:], dtype=np.float64)
+        loss_and_gradient, hessian_product = utils.pairwise_logistic_objective(features, pairs[:, 0], pairs[:, 1], targets,
+                                                                               self.weight_decay)
+
+        W = self.absolute_rank_estimate.W
+        initial = W.get_value().ravel().astype(np.float64)
+        if method == 'Newton-CG':
+            result = scipy.optimize.minimize(loss_and_gradient, initial, method=method, jac=True, hessp=hessian_product, tol=tol,
+                                             options={'maxiter': max_iter})
+        else:
+            result = scipy.optimize.minimize(loss_and_gradient, initial, method=method, jac=True, tol=tol,
+                                             options={'maxiter': max_iter})
+        W.set_value(result.x.reshape(W.get_value().shape).astype(np.float32))
+        toc = dt.now()
+
+        if self.debug:
+            logger.info("Solving the ranker with %s took %d iterations and %s: %s", method, result.nit, str(toc - tic), result.message)
+        return float(result.fun)
+
+    def _check_linear_ranker(self):
+        # the loss is only the convex objective of `utils.pairwise_logistic_objective` for a linear ranker
+        if self.ranker_nonlinearity is not lasagne.nonlinearities.linear:
+            raise ValueError("The ranker can only be solved with a linear ranker_nonlinearity, not %s" % self.ranker_nonlinearity.__name__)
+
+    def _extractor_outputs(self, image_ids):
+        """
+        Returns the deterministic outputs of the extractor for `image_ids`, computed from their cached features by the frozen layers
+        between the feature layer and the output layer, if there are any.
+        """
+        if self.feature_layer is self.extractor_layer:
+            return self._cached_features(image_ids)
+
+        if getattr(self, 'extractor_output_function', None) is None:
+            self.extractor_output_function = theano.function([self.feature_var], lasagne.layers.get_output(
+                self.extractor_layer, inputs={self.feature_layer: self.feature_var}, deterministic=True))
+        outputs = np.zeros((len(image_ids),) + tuple(lasagne.layers.get_output_shape(self.extractor_layer)[1:]), dtype=np.float32)
+        chunk_size = self.train_batch_size * 8
+        for start in range(0, len(image_ids), chunk_size):
+            chunk = image_ids[start:(start + chunk_size)]
+            outputs[start:(start + len(chunk))] = self.extractor_output_function(self._cached_features(chunk))
+        return outputs
+
+    def _rank_estimates_for_images(self, image_ids):
+        """
+        Computes the absolute rank estimate of each image in `image_ids`, each image is passed through the network only once.
+        """
+        return self._rank_estimate_matrix(image_ids).ravel()
 
-        return rank_estimates, input_target, input_mask
+    def _rank_estimate_matrix(self, image_ids):
+        """
+        Returns the (n x outputs) outputs of `absolute_rank_estimate` for the n images in `image_ids`.
+        """
+        if self.precompute_features:
+            self._cache_features(image_ids)
+
+        num_outputs = lasagne.layers.get_output_shape(self.absolute_rank_estimate)[1]
+        estimates = np.zeros((len(image_ids), num_outputs), dtype=np.float32)
+        chunk_size = self.train_batch_size * 8
+        for start in range(0, len(image_ids), chunk_size):
+            chunk = image_ids[start:(start + chunk_size)]
+            if self.precompute_features:
+                estimates[start:(start + len(chunk))] = self.feature_testing_function(self._cached_features(chunk))
+            else:
+                estimates[start:(start + len(chunk))] = self.testing_function(self._preprocess_images(chunk))
+
+        return estimates
+
+    def _test_pair_estimates(self):
+        """
+        Returns a (n x 2) array with the absolute rank estimates of the two images of each of the n testing pairs.
+        Each distinct test image is scored once and the estimates are gathered for the pairs afterwards.
+        """
+        image_ids = self.dataset.image_ids(test=True)
+        estimates = self._rank_estimates_for_images(image_ids)
+        return estimates[np.searchsorted(image_ids, np.asarray(self.dataset._test_pairs))]
 
     @staticmethod
     def _estimates_to_target_estimates(estimates):
@@ -234,48 +776,118 @@ class Ghiaseddin(object):
         posteriors += (o1 == o2) * 0.5 + (o1 > o2) * 1
         return posteriors.ravel()
 
-    def eval_accuracy(self):
+    def eval_accuracy(self, all_pairs=False):
+        """
+        Calculates the relative attribute prediction accuracy on the testing pairs.
+        If `all_pairs` is `True` the accuracy is computed over all the pairs of test images instead, for datasets with per image labels.
+        """
+        if all_pairs:
+            return self._eval_all_pairs_accuracy()
+
         tic = dt.now()
-        test_generator = self.dataset.test_generator(
-            batch_size=self.train_batch_size * 4)
-        total = 0
-        correct = 0
-
-        for batch in test_generator:
-            preprocessed_input = self.extractor.preprocess(batch)
-            estimates, target, mask = self._test_rank_estimate(
-                preprocessed_input)
-
-            estimated_target = self._estimates_to_target_estimates(estimates)
-            # TODO: this for loop could be speeded up with array operations
-            # instead of for
-            for p, t, m in zip(estimated_target, target, mask):
-                if m and t != 0.5:
-                    total += 1
-                    if t == p:
-                        correct += 1
+        estimated_target = self._estimates_to_target_estimates(self._test_pair_estimates().ravel())
+        target = np.asarray(self.dataset._test_targets)
+
+        # pairs with equal attribute strength are not counted
+        valid = target != 0.5
+        total = np.sum(valid)
+        correct = np.sum(estimated_target[valid] == target[valid])
         toc = dt.now()
 
         if self.debug:
             logger.info("Evaluation took: %s", str(toc - tic))
         return float(correct) / total
 
+    def _eval_all_pairs_accuracy(self):
+        tic = dt.now()
+        image_ids, labels = self.dataset.test_image_labels()
+        estimates = self._rank_estimates_for_images(image_ids)
+        correct, total = utils.pairwise_ranking_accuracy(estimates, labels)
+        toc = dt.now()
+
+        if self.debug:
+            logger.info("Evaluation on all %d pairs took: %s", total, str(toc - tic))
+        return float(correct) / total
+
+    def set_dataset(self, dataset, feature_store=None):
+        """
+        Switches the model to training and evaluating on `dataset` (e.g. another attribute or split), the compiled functions are kept.
+        The parameters and the optimizer state are not changed, see `get_state` and `set_state` for that.
+        The cached features are kept if `dataset` has the same images as the current one.
+        """
+        if self.all_pairs_in_batch and not dataset.has_train_image_labels():
+            raise Exception("Training on all the pairs in a batch needs per image labels, which %s does not have" %
+                            dataset.__class__.__name__)
+        if feature_store is not None and self.cut_layer is None and (self.extractor_learning_rate != 0 or self.extractor.augmentation):
+            raise Exception("A feature store can only be used with a frozen extractor without augmentation")
+        self._check_feature_store(feature_store)
+
+        if list(dataset._image_addresses) != list(self.dataset._image_addresses):
+            self._feature_ids = None
+            self._features = None
+        if self._preprocessor is not None:
+            # the worker processes have a copy of the image addresses of the old dataset
+            self._preprocessor.close()
+            self._preprocessor = None
+
+        self.dataset = dataset
+        self.feature_store = feature_store
+        self.NAME = self._model_name()
+        if self.do_log:
+            self.pastalog = Log('http://localhost:8100/', self.NAME)
+
+    def _shared_variables(self):
+        """
+        Returns all the shared variables which the compiled training and testing functions use: the parameters, the state of the
+        optimizer, the random state of the dropout layers and the learning rates.
+        """
+        functions = [self.training_function, self.testing_function, getattr(self, 'feature_training_function', None),
+                     getattr(self, 'feature_testing_function', None)]
+        variables = OrderedDict()
+        for function in functions:
+            if function is None:
+                continue
+            for function_input in function.maker.inputs:
+                if isinstance(function_input.variable, theano.compile.SharedVariable):
+                    variables[function_input.variable] = True
+        return variables.keys()
+
+    def get_state(self):
+        """
+        Returns a copy of everything which training changes: the values of all the shared variables (see `_shared_variables`), the
+        training step and numpy's random state, which is used for shuffling and augmentation.
+        """
+        return {'values': [(variable, variable.get_value()) for variable in self._shared_variables()],
+                'log_step': self.log_step,
+                'num_train_epochs_started': self._num_train_epochs_started,
+                'random_state': np.random.get_state()}
+
+    def set_state(self, state):
+        """
+        Restores a state returned by `get_state`.
+        """
+        for variable, value in state['values']:
+            variable.set_value(value)
+        self.log_step = state['log_step']
+        self._num_train_epochs_started = state['num_train_epochs_started']
+        np.random.set_state(state['random_state'])
+
     def _model_name_with_iter(self):
         return "%s-iter:%d" % (self.NAME, self.log_step)
 
     def _model_name_from_settings(self):
         return os.path.join(settings.model_root, "%s.npz" % (self._model_name_with_iter()))
 
-    def save(self, path=None):
+    def save(self, path=None, full=False):
         """
         Save the model to file
+        Only the parameters which differ from the pretrained weights of the extractor are saved, unless `full` is set (see `checkpoints`).
         TODO: save all parameters not only the network parameters, for easy resuming of training.
         """
         if not path:
             path = self._model_name_from_settings()
 
-        np.savez(path, params=lasagne.layers.get_all_param_values(
-            self.absolute_rank_estimate))
+        checkpoints.save_checkpoint(path, lasagne.layers.get_all_param_values(self.absolute_rank_estimate), self.extractor, full=full)
 
     def load(self, path=None):
         """
@@ -301,54 +913,46 @@ class Ghiaseddin(object):
             path = os.path.join(settings.model_root, the_better_model)
             self.log_step = most_iters
 
-        with np.load(path) as data:
-            loaded_from_file = data['params']
+        loaded_from_file = checkpoints.load_checkpoint(path, self.extractor)
         lasagne.layers.set_all_param_values(
             self.absolute_rank_estimate, loaded_from_file)
 
     def generate_misclassified(self):
-        test_generator = self.dataset.test_generator(
-            batch_size=self.train_batch_size)
-
         folder_path = os.path.join(
             settings.result_models_root, "missclassified|%s" % self._model_name_with_iter())
         boltons.fileutils.mkdir_p(folder_path)
 
-        num = 0
-        for batch in test_generator:
-            preprocessed_input = self.extractor.preprocess(batch)
-            estimates, target, mask = self._test_rank_estimate(
-                preprocessed_input)
-
-            estimated_target = self._estimates_to_target_estimates(estimates)
-            for p, t, m, i in zip(estimated_target, target, mask, batch):
-                if m and t != 0.5:
-                    if t != p:
-                        (img1_path, img2_path), truth = i
-                        img1 = utils.load_image(img1_path)
-                        img2 = utils.load_image(img2_path)
-
-                        fig = plt.figure(figsize=(10, 5))
-                        ax1 = fig.add_subplot(121)
-                        ax2 = fig.add_subplot(122)
-
-                        ax1.imshow(img1)
-                        ax1.axis('off')
-                        ax1.set_title('A')
-                        ax2.imshow(img2)
-                        ax2.axis('off')
-                        ax2.set_title('B')
-
-                        attribute_name = self.dataset._ATT_NAMES[
-                            self.dataset.attribute_index]
-                        truth_thing = '>' if t == 1 else '<'
-                        estimated_thing = '>' if p == 1 else '<'
-                        plt.suptitle("Attribute: %s | Truth: %s | Estimated: %s" % (
-                            attribute_name, truth_thing, estimated_thing))
-
-                        plt.savefig(os.path.join(folder_path, '%d.png' % num))
-                        plt.close()
-                        num += 1
+        estimated_target = self._estimates_to_target_estimates(self._test_pair_estimates().ravel())
+        target = np.asarray(self.dataset._test_targets)
+        misclassified = np.where((target != 0.5) & (estimated_target != target))[0]
+
+        for num, pair_id in enumerate(misclassified):
+            p = estimated_target[pair_id]
+            t = target[pair_id]
+            pair = self.dataset._test_pairs[pair_id, :]
+            img1 = self.extractor.load_image(self.dataset._image_addresses[pair[0]])
+            img2 = self.extractor.load_image(self.dataset._image_addresses[pair[1]])
+
+            fig = plt.figure(figsize=(10, 5))
+            ax1 = fig.add_subplot(121)
+            ax2 = fig.add_subplot(122)
+
+            ax1.imshow(img1)
+            ax1.axis('off')
+            ax1.set_title('A')
+            ax2.imshow(img2)
+            ax2.axis('off')
+            ax2.set_title('B')
+
+            attribute_name = self.dataset._ATT_NAMES[
+                self.dataset.attribute_index]
+            truth_thing = '>' if t == 1 else '<'
+            estimated_thing = '>' if p == 1 else '<'
+            plt.suptitle("Attribute: %s | Truth: %s | Estimated: %s" % (
+                attribute_name, truth_thing, estimated_thing))
+
+            plt.savefig(os.path.join(folder_path, '%d.png' % num))
+            plt.close()
 
     def generate_saliency(self, test_pair_ids=[], size=2):
         # get the id of the test pairs to generate saliency on
@@ -372,8 +976,8 @@ class Ghiaseddin(object):
             pair = self.dataset._test_pairs[test_pair_ids[i], :]
             img1_path = self.dataset._image_addresses[pair[0]]
             img2_path = self.dataset._image_addresses[pair[1]]
-            img1 = utils.load_image(img1_path)
-            img2 = utils.load_image(img2_path)
+            img1 = self.extractor.load_image(img1_path)
+            img2 = self.extractor.load_image(img2_path)
 
             images.append((img1, img2))
 
@@ -425,10 +1029,7 @@ class Ghiaseddin(object):
 
         return fig
 
-    def generate_embedding(self, for_all=False, random_seed=None):
-        if not random_seed:
-            random_seed = settings.RANDOM_SEED
-
+    def _compute_embedding(self, for_all=False):
         all_image_paths = self.dataset.all_images(for_all)
 
         if not getattr(self, 'embedding_fn', None):
@@ -444,7 +1045,7 @@ class Ghiaseddin(object):
         for images in boltons.iterutils.chunked(all_image_paths, self.train_batch_size * 2):
             x = np.zeros((len(images), 3, self.extractor._input_height, self.extractor._input_width), dtype=np.float32)
             for i, img_path in enumerate(images):
-                x[i, ...] = self.extractor._general_image_preprocess(utils.load_image(img_path))
+                x[i, ...] = self.extractor._general_image_preprocess(self.extractor.load_image(img_path))
             es, rs = self.embedding_fn(x)
 
             # l2 normalize the embeddings
@@ -454,6 +1055,22 @@ class Ghiaseddin(object):
             ranks[idx:(idx + len(images))] = rs.flatten()
             idx += len(images)
 
+        return embeddings, ranks
+
+    def generate_embedding(self, for_all=False, random_seed=None):
+        if not random_seed:
+            random_seed = settings.RANDOM_SEED
+
+        if self.feature_store is not None and self.cut_layer is None:
+            # the embeddings are the extractor outputs, computed from the stored features by the frozen layers above them (if any),
+            # the same layer as `_compute_embedding` uses
+            image_ids = np.arange(len(self.dataset._image_addresses)) if for_all else self.dataset.image_ids()
+            self._cache_features(image_ids)
+            embeddings = normalize(self._extractor_outputs(image_ids).reshape((len(image_ids), -1)), norm='l2', copy=False)
+            ranks = self._rank_estimates_for_images(image_ids)
+        else:
+            embeddings, ranks = self._compute_embedding(for_all)
+
         embeddings = TSNE(random_state=random_seed).fit_transform(embeddings)
         ranks = scipy.stats.rankdata(ranks).astype(np.int)
 
@@ -507,29 +1124,107 @@ class Ghiaseddin(object):
         fig.savefig(os.path.join(folder_path, 'filters-%d.png' % self.log_step))
 
     def estimates_predictions_corrects_on_test(self):
-        test_generator = self.dataset.test_generator(
-            batch_size=self.train_batch_size)
-        total_estimates = []
-        predictions = []
-        corrects = []
-
-        for batch in test_generator:
-            preprocessed_input = self.extractor.preprocess(batch)
-            estimates, target, mask = self._test_rank_estimate(
-                preprocessed_input)
-
-            total_estimates.extend(estimates[:sum(mask)])
-
-            estimated_target = self._estimates_to_target_estimates(estimates)
-
-            for p, t, m in zip(estimated_target, target, mask):
-                if m:
-                    predictions.append(p)
-                    if t == 0.5:
-                        corrects.append(0.5)
-                    elif p == t:
-                        corrects.append(1)
-                    else:
-                        corrects.append(0)
-
-        return np.array(total_estimates).flatten(), predictions, corrects
+        total_estimates = self._test_pair_estimates().ravel()
+        predictions = self._estimates_to_target_estimates(total_estimates)
+        target = np.asarray(self.dataset._test_targets)
+
+        corrects = np.where(target == 0.5, 0.5, (predictions == target) * 1)
+
+        return total_estimates, predictions.tolist(), corrects.tolist()
+
+
+class MultiAttributeGhiaseddin(Ghiaseddin):
+    """
+    One extractor with a ranker head (`_create_absolute_rank_estimate`) per attribute, trained on a `datasets.MultiAttributeDataset`.
+
+    A training pair has a target for each of the attributes which annotate it (see `datasets.MultiAttributeDataset`) and its loss comes
+    from the heads of these attributes, so the extractor is run once per batch for all the attributes, instead of once per attribute
+    with a model per attribute.
+    `eval_accuracy` returns the accuracy of each attribute, the other evaluation and visualization helpers are about a single attribute
+    and are not supported. It can not be used with `all_pairs_in_batch`, `unique_image_batches` or `augmentation_workers`.
+
+    Example Usage:
+    >>> dataset = MultiAttributeDataset([Zappos50K1(root, attribute_index=i, split_index=0) for i in range(4)])
+    >>> model = MultiAttributeGhiaseddin(VGG16(settings.vgg16_weights), dataset)
+    >>> model.train_n_epoch(10)
+    >>> print model.eval_accuracy()
+    """
+
+    def __init__(self, extractor, dataset, **kwargs):
+        if kwargs.get('all_pairs_in_batch') or kwargs.get('unique_image_batches') or kwargs.get('augmentation_workers', 0) > 0:
+            raise Exception("MultiAttributeGhiaseddin can not be used with all_pairs_in_batch, unique_image_batches or augmentation_workers")
+        self.num_attributes = len(dataset.datasets)
+        super(MultiAttributeGhiaseddin, self).__init__(extractor, dataset, **kwargs)
+
+    def _create_absolute_rank_estimate(self, incoming):
+        """
+        One head per attribute, the outputs of the heads are concatenated into a (n x attributes) estimate.
+        """
+        heads = [super(MultiAttributeGhiaseddin, self)._create_absolute_rank_estimate(incoming) for _ in range(self.num_attributes)]
+        self.rank_heads = [head for head, _ in heads]
+        params = [param for _, head_params in heads for param in head_params]
+        return lasagne.layers.ConcatLayer(self.rank_heads, axis=1), params
+
+    def _create_label_inputs(self):
+        # a row of targets per pair and the mask of the attributes which have a target
+        self.target_var = T.fmatrix('targets')
+        self.target_mask_var = T.fmatrix('target_mask')
+        return [self.target_mask_var, self.target_var]
+
+    def _xent(self, rank_estimates):
+        """
+        The binary cross entropy of each pair on the head of each of its attributes, averaged over all these (pair, attribute) entries
+        of the batch. Padding pairs have no attribute and are not counted.
+        """
+        estimates = rank_estimates.reshape((-1, 2, self.num_attributes))
+        posteriors = T.clip(T.nnet.sigmoid(estimates[:, 0, :] - estimates[:, 1, :]), self._epsilon, 1.0 - self._epsilon)
+        xent = lasagne.objectives.binary_crossentropy(posteriors, self.target_var)
+        return T.sum(xent * self.target_mask_var) / T.maximum(T.sum(self.target_mask_var), 1)
+
+    def _preprocess_train_batch(self, batch, out):
+        # the buffers of the extractor hold one target per pair, the rows of targets of the batch are used as they are
+        images, _, mask = super(MultiAttributeGhiaseddin, self)._preprocess_train_batch(batch._replace(targets=batch.targets[:, 0]), out)
+        return images, self.dataset.pair_target_mask(batch.pair_ids), batch.targets, mask
+
+    def _feature_train_batches(self):
+        self._cache_features(self.dataset.image_ids())
+        for batch in self._sample_train_batches():
+            image_ids = np.stack([batch.left, batch.right], axis=1).ravel()
+            yield self._cached_features(image_ids, train=True), self.dataset.pair_target_mask(batch.pair_ids), batch.targets, batch.mask
+
+    def solve_ranker(self, method='L-BFGS-B', max_iter=500, tol=1e-6):
+        self._check_linear_ranker()
+        raise Exception("The ranker heads of MultiAttributeGhiaseddin can not be solved, train them with minibatches")
+
+    def eval_accuracy(self, all_pairs=False):
+        """
+        Returns the accuracy of each attribute on its testing pairs (or on all the pairs of its test images with `all_pairs`), see
+        `Ghiaseddin.eval_accuracy`. The test images of all the attributes are passed through the network once for all the heads.
+        """
+        tic = dt.now()
+        if all_pairs:
+            image_ids = np.unique(np.concatenate([dataset.test_image_labels()[0] for dataset in self.dataset.datasets]))
+        else:
+            image_ids = self.dataset.image_ids(test=True)
+        estimates = self._rank_estimate_matrix(image_ids)
+
+        accuracies = []
+        for attribute, dataset in enumerate(self.dataset.datasets):
+            if all_pairs:
+                test_image_ids, labels = dataset.test_image_labels()
+                correct, total = utils.pairwise_ranking_accuracy(estimates[np.searchsorted(image_ids, test_image_ids), attribute], labels)
+            else:
+                pair_estimates = estimates[np.searchsorted(image_ids, np.asarray(dataset._test_pairs[:])), attribute]
+                estimated_target = self._estimates_to_target_estimates(pair_estimates.ravel())
+                target = np.asarray(dataset._test_targets[:])
+
+                # pairs with equal attribute strength are not counted
+                valid = target != 0.5
+                total = np.sum(valid)
+                correct = np.sum(estimated_target[valid] == target[valid])
+            accuracies.append(float(correct) / total)
+        toc = dt.now()
+
+        if self.debug:
+            logger.info("Evaluation of %d attributes took: %s", len(accuracies), str(toc - tic))
+        return accuracies
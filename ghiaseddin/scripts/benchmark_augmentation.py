@@ -0,0 +1,54 @@
+import click
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(__name__)))
+from datetime import datetime as dt
+import ghiaseddin
+
+
+@click.command()
+@click.option('--dataset', type=click.Choice(['zappos1', 'lfw', 'osr', 'pubfig']), default='lfw')
+@click.option('--extractor', type=click.Choice(['googlenet', 'vgg', 'inceptionv3']), default='vgg')
+@click.option('--batch_size', type=click.INT, default=16)
+@click.option('--batches', type=click.INT, default=20)
+def main(dataset, extractor, batch_size, batches):
+    """
+    Compares the per image augmentation path of `Extractor.preprocess` with the batched one (`batch_augmentation = True`).
+    """
+    if dataset == 'zappos1':
+        dataset = ghiaseddin.Zappos50K1(ghiaseddin.settings.zappos_root, attribute_index=0, split_index=0)
+    elif dataset == 'lfw':
+        dataset = ghiaseddin.LFW10(ghiaseddin.settings.lfw10_root, attribute_index=0)
+    elif dataset == 'osr':
+        dataset = ghiaseddin.OSR(ghiaseddin.settings.osr_root, attribute_index=0)
+    elif dataset == 'pubfig':
+        dataset = ghiaseddin.PubFig(ghiaseddin.settings.pubfig_root, attribute_index=0)
+
+    # the weights are not needed for preprocessing
+    if extractor == 'googlenet':
+        ext = ghiaseddin.GoogLeNet(augmentation=True)
+    elif extractor == 'vgg':
+        ext = ghiaseddin.VGG16(augmentation=True)
+    elif extractor == 'inceptionv3':
+        ext = ghiaseddin.extractors.InceptionV3(augmentation=True)
+
+    # the same batches for both, read once before timing so the disk cache is warm
+    generator = dataset.train_batches(batch_size=batch_size, shuffle=True, cut_tail=True)
+    the_batches = [b for _, b in zip(range(batches), generator)]
+    ext.preprocess_pair_batch(the_batches[0], dataset._image_addresses, augmentation=True)
+
+    for batched in [False, True]:
+        ext.batch_augmentation = batched
+        tic = dt.now()
+        for b in the_batches:
+            ext.preprocess_pair_batch(b, dataset._image_addresses, augmentation=True)
+        toc = dt.now()
+        seconds = (toc - tic).total_seconds()
+        sys.stdout.write('%s: %2.4f s/batch, %2.1f images/s\n' % ('batched' if batched else 'per image',
+                                                                   seconds / len(the_batches),
+                                                                   2 * batch_size * len(the_batches) / seconds))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
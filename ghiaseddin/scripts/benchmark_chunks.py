@@ -0,0 +1,51 @@
+import click
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(__name__)))
+from datetime import datetime as dt
+import ghiaseddin
+
+
+@click.command()
+@click.option('--dataset', type=click.Choice(['zappos1', 'lfw', 'osr', 'pubfig']), default='lfw')
+@click.option('--extractor', type=click.Choice(['googlenet', 'vgg']), default='googlenet')
+@click.option('--baseline', type=click.BOOL, default=False)
+@click.option('--batch_size', type=click.INT, default=16)
+@click.option('--batches', type=click.INT, default=100)
+@click.option('--chunk_batches', type=click.INT, default=16)
+def main(dataset, extractor, baseline, batch_size, batches, chunk_batches):
+    """
+    Compares the training throughput of passing the arrays of each batch to the training function with uploading chunks of
+    `chunk_batches` batches to shared variables (`Ghiaseddin(chunk_batches=...)`).
+    """
+    if dataset == 'zappos1':
+        dataset = ghiaseddin.Zappos50K1(ghiaseddin.settings.zappos_root, attribute_index=0, split_index=0)
+    elif dataset == 'lfw':
+        dataset = ghiaseddin.LFW10(ghiaseddin.settings.lfw10_root, attribute_index=0)
+    elif dataset == 'osr':
+        dataset = ghiaseddin.OSR(ghiaseddin.settings.osr_root, attribute_index=0)
+    elif dataset == 'pubfig':
+        dataset = ghiaseddin.PubFig(ghiaseddin.settings.pubfig_root, attribute_index=0)
+
+    for chunks in [0, chunk_batches]:
+        if extractor == 'googlenet':
+            ext = ghiaseddin.GoogLeNet(ghiaseddin.settings.googlenet_weights)
+        elif extractor == 'vgg':
+            ext = ghiaseddin.VGG16(ghiaseddin.settings.vgg16_weights)
+
+        model = ghiaseddin.Ghiaseddin(extractor=ext, dataset=dataset, train_batch_size=batch_size, do_log=False,
+                                      extractor_learning_rate=0 if baseline else 1e-5, chunk_batches=chunks)
+        # the first steps compile the chunk functions and warm the image (or feature) caches
+        model.train_n_iter(max(chunks, 1))
+
+        tic = dt.now()
+        model.train_n_iter(batches)
+        toc = dt.now()
+        seconds = (toc - tic).total_seconds()
+        sys.stdout.write('%s: %2.4f s/batch, %2.1f pairs/s\n' % ('chunks of %d' % chunks if chunks else 'per batch',
+                                                               seconds / batches, batch_size * batches / seconds))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
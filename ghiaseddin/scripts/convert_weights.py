@@ -0,0 +1,30 @@
+import click
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(__name__)))
+from datetime import datetime as dt
+import ghiaseddin
+
+
+@click.command()
+@click.option('--extractor', type=click.Choice(['googlenet', 'vgg', 'all']), default='all')
+def main(extractor):
+    """
+    Converts the downloaded weights pickles to one `.npy` file per parameter (see `ghiaseddin.extractors.convert_weights`), which the
+    extractors memory map instead of unpickling the whole file. This only has to be done once, and again if a weights file changes.
+    """
+    weights = []
+    if extractor in ['googlenet', 'all']:
+        weights.append(ghiaseddin.settings.googlenet_weights)
+    if extractor in ['vgg', 'all']:
+        weights.append(ghiaseddin.settings.vgg16_weights)
+
+    for path in weights:
+        tic = dt.now()
+        converted_path = ghiaseddin.extractors.convert_weights(path)
+        toc = dt.now()
+        print '%s -> %s, took: %s' % (path, converted_path, str(toc - tic))
+
+
+if __name__ == '__main__':
+    main()
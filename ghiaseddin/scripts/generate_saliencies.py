@@ -23,8 +23,9 @@ def main(dataset):
     elif dataset == 'pubfig':
         DS = ghiaseddin.PubFig
 
+    # the model is built once and switched to each attribute
+    session = ghiaseddin.Session()
     for AI in range(len(DS._ATT_NAMES)):
-        ext = ghiaseddin.VGG16(weights=ghiaseddin.settings.vgg16_weights)
         if dataset == 'zappos1':
             dst = ghiaseddin.Zappos50K1(ghiaseddin.settings.zappos_root, attribute_index=AI, split_index=0)
         elif dataset == 'lfw':
@@ -33,7 +34,7 @@ def main(dataset):
             dst = ghiaseddin.OSR(ghiaseddin.settings.osr_root, attribute_index=AI)
         elif dataset == 'pubfig':
             dst = ghiaseddin.PubFig(ghiaseddin.settings.pubfig_root, attribute_index=AI)
-        model = ghiaseddin.Ghiaseddin(ext, dst)
+        model = session.model(ghiaseddin.VGG16, dst, weights=ghiaseddin.settings.vgg16_weights)
         try:
             model.load()
             
@@ -0,0 +1,41 @@
+import click
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(__name__)))
+from datetime import datetime as dt
+import ghiaseddin
+
+
+@click.command()
+@click.option('--dataset', type=click.Choice(['zappos1', 'zappos2', 'lfw', 'osr', 'pubfig']), default='zappos1')
+@click.option('--extractor', type=click.Choice(['googlenet', 'vgg']), default='vgg')
+def main(dataset, extractor):
+    """
+    Packs the images of a dataset into a shard at the input size of the extractor (see `ghiaseddin/shards.py`).
+    This only has to be done once, after that use `--use_shards true` with train.py.
+    """
+    if dataset == 'zappos1':
+        dataset = ghiaseddin.Zappos50K1(ghiaseddin.settings.zappos_root, attribute_index=0, split_index=0)
+    elif dataset == 'zappos2':
+        dataset = ghiaseddin.Zappos50K2(ghiaseddin.settings.zappos_root, attribute_index=0)
+    elif dataset == 'lfw':
+        dataset = ghiaseddin.LFW10(ghiaseddin.settings.lfw10_root, attribute_index=0)
+    elif dataset == 'osr':
+        dataset = ghiaseddin.OSR(ghiaseddin.settings.osr_root, attribute_index=0)
+    elif dataset == 'pubfig':
+        dataset = ghiaseddin.PubFig(ghiaseddin.settings.pubfig_root, attribute_index=0)
+
+    # the weights are not needed, only the input size
+    if extractor == 'googlenet':
+        ext = ghiaseddin.GoogLeNet()
+    elif extractor == 'vgg':
+        ext = ghiaseddin.VGG16()
+
+    tic = dt.now()
+    path = ghiaseddin.shards.pack_dataset(dataset, ext, verbose=True)
+    toc = dt.now()
+    print 'Packed %d images to %s, took: %s' % (len(dataset._image_addresses), path, str(toc - tic))
+
+
+if __name__ == '__main__':
+    main()
@@ -18,7 +18,8 @@ import numpy as np
 @click.option('--epochs', type=click.INT, default=10)
 @click.option('--attribute_split', type=click.INT, default=0)
 @click.option('--do_log', type=click.BOOL, default=True, envvar='DO_LOG')
-def main(dataset, extractor, augmentation, baseline, attribute, epochs, attribute_split, do_log):
+@click.option('--all_pairs_eval', type=click.BOOL, default=False)
+def main(dataset, extractor, augmentation, baseline, attribute, epochs, attribute_split, do_log, all_pairs_eval):
     si = attribute_split
 
     if dataset == 'zappos1':
@@ -67,7 +68,7 @@ def main(dataset, extractor, augmentation, baseline, attribute, epochs, attribut
         model.train_one_epoch()
 
         if i == epochs - 1:
-            acc = model.eval_accuracy() * 100
+            acc = model.eval_accuracy(all_pairs=all_pairs_eval) * 100
             accuracies.append(acc)
             sys.stdout.write("%2.4f\n" % acc)
             sys.stdout.flush()
@@ -18,7 +18,22 @@ import numpy as np
 @click.option('--epochs', type=click.INT, default=10)
 @click.option('--attribute_split', type=click.INT, default=0)
 @click.option('--do_log', type=click.BOOL, default=True, envvar='DO_LOG')
-def main(dataset, extractor, augmentation, baseline, attribute, epochs, attribute_split, do_log):
+@click.option('--all_pairs_eval', type=click.BOOL, default=False)
+@click.option('--use_shards', type=click.BOOL, default=False)
+@click.option('--unique_image_batches', type=click.BOOL, default=False)
+@click.option('--group_pairs_by_image', type=click.BOOL, default=False)
+@click.option('--all_pairs_in_batch', type=click.BOOL, default=False)
+@click.option('--precompute_features', type=click.BOOL, default=False,
+              help='train the ranker of the baseline on the cached outputs of the frozen extractor')
+@click.option('--feature_store', type=click.Choice(['none', 'float32', 'float16']), default='none')
+@click.option('--cut_layer', type=click.STRING, default=None, help='e.g. pool4 or pool5 of vgg, the layers up to it are frozen')
+@click.option('--cut_augmentations', type=click.INT, default=4)
+@click.option('--batch_augmentation', type=click.BOOL, default=False, help='augment each training batch at once, vectorized')
+@click.option('--ranker_solver', type=click.Choice(['none', 'L-BFGS-B', 'Newton-CG']), default='none',
+              help='train the ranker of the baseline at once on the cached features')
+def main(dataset, extractor, augmentation, baseline, attribute, epochs, attribute_split, do_log, all_pairs_eval, use_shards,
+         unique_image_batches, group_pairs_by_image, all_pairs_in_batch, precompute_features, feature_store, cut_layer, cut_augmentations,
+         batch_augmentation, ranker_solver):
     si = attribute_split
 
     if dataset == 'zappos1':
@@ -43,10 +58,29 @@ def main(dataset, extractor, augmentation, baseline, attribute, epochs, attribut
     elif extractor == 'vgg':
         ext = ghiaseddin.VGG16(ghiaseddin.settings.vgg16_weights, augmentation)
 
+    if use_shards:
+        # created with scripts/pack_dataset.py
+        shard = ghiaseddin.shards.open_shard(dataset, ext)
+        if shard is None:
+            raise Exception("The dataset is not packed, run scripts/pack_dataset.py first")
+        ext.use_shard(shard)
+
     extractor_learning_rate = 1e-5
     if baseline:
         extractor_learning_rate = 0
 
+    if not augmentation:
+        cut_augmentations = 0
+
+    store = None
+    if feature_store != 'none':
+        # the extractor outputs are kept on disk, so other runs of the baseline on this dataset do not compute them again
+        if cut_layer is not None:
+            store = ghiaseddin.features.open_feature_store(dataset, ext, layer=ext.net[cut_layer], dtype=feature_store,
+                                                           variants=1 + cut_augmentations)
+        else:
+            store = ghiaseddin.features.open_feature_store(dataset, ext, dtype=feature_store)
+
     model = ghiaseddin.Ghiaseddin(extractor=ext,
                                   dataset=dataset,
                                   weight_decay=1e-5,
@@ -54,7 +88,15 @@ def main(dataset, extractor, augmentation, baseline, attribute, epochs, attribut
                                   ranker_learning_rate=1e-4,
                                   extractor_learning_rate=extractor_learning_rate,
                                   ranker_nonlinearity=lasagne.nonlinearities.linear,
-                                  do_log=do_log)
+                                  do_log=do_log,
+                                  unique_image_batches=unique_image_batches,
+                                  group_pairs_by_image=group_pairs_by_image,
+                                  all_pairs_in_batch=all_pairs_in_batch,
+                                  precompute_features=precompute_features or ranker_solver != 'none',
+                                  feature_store=store,
+                                  cut_layer=cut_layer,
+                                  cut_augmentations=cut_augmentations,
+                                  batch_augmentation=batch_augmentation)
 
     if baseline:
         model.NAME = "baseline|%s" % model.NAME
@@ -67,9 +109,15 @@ def main(dataset, extractor, augmentation, baseline, attribute, epochs, attribut
     matrixes = []
     matrixes.append(model.estimates_predictions_corrects_on_test())
     accuracies = []
+    if ranker_solver != 'none':
+        # the solver trains the ranker to convergence in one go
+        epochs = 1
     for _ in range(epochs):
-        model.train_one_epoch()
-        acc = model.eval_accuracy() * 100
+        if ranker_solver != 'none':
+            model.solve_ranker(method=ranker_solver)
+        else:
+            model.train_one_epoch()
+        acc = model.eval_accuracy(all_pairs=all_pairs_eval) * 100
         accuracies.append(acc)
         sys.stdout.write("%2.4f\n" % acc)
         sys.stdout.flush()
@@ -0,0 +1,86 @@
+import click
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(__name__)))
+from datetime import datetime as dt
+import lasagne
+import ghiaseddin
+import boltons.fileutils
+
+
+@click.command()
+@click.option('--dataset', type=click.Choice(['zappos1', 'zappos2', 'lfw', 'osr', 'pubfig']), default='zappos1')
+@click.option('--extractor', type=click.Choice(['googlenet', 'vgg']), default='vgg')
+@click.option('--augmentation', type=click.BOOL, default=False)
+@click.option('--baseline', type=click.BOOL, default=False)
+@click.option('--epochs', type=click.INT, default=10)
+@click.option('--splits', type=click.INT, default=10, help='the number of splits of zappos1, the other datasets have one')
+@click.option('--precompute_features', type=click.BOOL, default=False,
+              help='train the ranker of the baseline on the cached outputs of the frozen extractor')
+@click.option('--do_log', type=click.BOOL, default=True, envvar='DO_LOG')
+@click.option('--all_pairs_eval', type=click.BOOL, default=False)
+def main(dataset, extractor, augmentation, baseline, epochs, splits, precompute_features, do_log, all_pairs_eval):
+    """
+    Trains and evaluates on all the attributes (and splits) of a dataset in one process, like the run-*.sh scripts do with one process
+    per attribute and split. The extractor and the compiled model are built once and reused for all the runs.
+    """
+    if dataset == 'zappos1':
+        DS, root = ghiaseddin.Zappos50K1, ghiaseddin.settings.zappos_root
+    elif dataset == 'zappos2':
+        DS, root = ghiaseddin.Zappos50K2, ghiaseddin.settings.zappos_root
+    elif dataset == 'lfw':
+        DS, root = ghiaseddin.LFW10, ghiaseddin.settings.lfw10_root
+    elif dataset == 'osr':
+        DS, root = ghiaseddin.OSR, ghiaseddin.settings.osr_root
+    elif dataset == 'pubfig':
+        DS, root = ghiaseddin.PubFig, ghiaseddin.settings.pubfig_root
+    if dataset != 'zappos1':
+        splits = 1
+
+    if extractor == 'googlenet':
+        extractor_class, weights = ghiaseddin.GoogLeNet, ghiaseddin.settings.googlenet_weights
+    elif extractor == 'vgg':
+        extractor_class, weights = ghiaseddin.VGG16, ghiaseddin.settings.vgg16_weights
+
+    session = ghiaseddin.Session()
+    for si in range(splits):
+        for ai in range(len(DS._ATT_NAMES)):
+            tic = dt.now()
+            if dataset == 'zappos1':
+                dst = DS(root, attribute_index=ai, split_index=si)
+            else:
+                dst = DS(root, attribute_index=ai)
+            sys.stdout.write('===================AI: %d, A: %s, SI: %d===================\n' % (ai, dst._ATT_NAMES[ai], si))
+            sys.stdout.flush()
+
+            model = session.model(extractor_class, dst, weights=weights, augmentation=augmentation,
+                                  weight_decay=1e-5,
+                                  optimizer=lasagne.updates.rmsprop,
+                                  ranker_learning_rate=1e-4,
+                                  extractor_learning_rate=0 if baseline else 1e-5,
+                                  ranker_nonlinearity=lasagne.nonlinearities.linear,
+                                  precompute_features=precompute_features,
+                                  do_log=do_log)
+            if baseline:
+                model.NAME = "baseline|%s" % model.NAME
+
+            accuracies = []
+            for _ in range(epochs):
+                model.train_one_epoch()
+                acc = model.eval_accuracy(all_pairs=all_pairs_eval) * 100
+                accuracies.append(acc)
+                sys.stdout.write("%2.4f\n" % acc)
+                sys.stdout.flush()
+            model.save()
+
+            boltons.fileutils.mkdir_p(ghiaseddin.settings.result_models_root)
+            with(open(os.path.join(ghiaseddin.settings.result_models_root, 'acc|%s' % model._model_name_with_iter()), 'w')) as f:
+                f.write('\n'.join(["%2.4f" % a for a in accuracies]))
+                f.write('\n')
+
+            toc = dt.now()
+            print 'Took: %s' % (str(toc - tic))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import click
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(__name__)))
+from datetime import datetime as dt
+import lasagne
+import ghiaseddin
+import boltons.fileutils
+
+
+@click.command()
+@click.option('--dataset', type=click.Choice(['zappos1', 'zappos2', 'lfw', 'osr', 'pubfig']), default='zappos1')
+@click.option('--extractor', type=click.Choice(['googlenet', 'vgg']), default='vgg')
+@click.option('--augmentation', type=click.BOOL, default=False)
+@click.option('--baseline', type=click.BOOL, default=False)
+@click.option('--epochs', type=click.INT, default=10)
+@click.option('--attribute_split', type=click.INT, default=0)
+@click.option('--do_log', type=click.BOOL, default=True, envvar='DO_LOG')
+@click.option('--all_pairs_eval', type=click.BOOL, default=False)
+def main(dataset, extractor, augmentation, baseline, epochs, attribute_split, do_log, all_pairs_eval):
+    """
+    Trains one model with a ranker head per attribute on all the attributes of a dataset at once (`MultiAttributeGhiaseddin`).
+    """
+    si = attribute_split
+    if dataset == 'zappos1':
+        datasets = [ghiaseddin.Zappos50K1(ghiaseddin.settings.zappos_root, attribute_index=ai, split_index=si)
+                    for ai in range(len(ghiaseddin.Zappos50K1._ATT_NAMES))]
+    elif dataset == 'zappos2':
+        datasets = [ghiaseddin.Zappos50K2(ghiaseddin.settings.zappos_root, attribute_index=ai)
+                    for ai in range(len(ghiaseddin.Zappos50K2._ATT_NAMES))]
+    elif dataset == 'lfw':
+        datasets = [ghiaseddin.LFW10(ghiaseddin.settings.lfw10_root, attribute_index=ai) for ai in range(len(ghiaseddin.LFW10._ATT_NAMES))]
+    elif dataset == 'osr':
+        datasets = [ghiaseddin.OSR(ghiaseddin.settings.osr_root, attribute_index=ai) for ai in range(len(ghiaseddin.OSR._ATT_NAMES))]
+    elif dataset == 'pubfig':
+        datasets = [ghiaseddin.PubFig(ghiaseddin.settings.pubfig_root, attribute_index=ai) for ai in range(len(ghiaseddin.PubFig._ATT_NAMES))]
+    dataset = ghiaseddin.MultiAttributeDataset(datasets)
+
+    tic = dt.now()
+    sys.stdout.write('===================A: %s, SI: %d===================\n' % (', '.join(dataset._ATT_NAMES), si))
+    sys.stdout.flush()
+
+    if extractor == 'googlenet':
+        ext = ghiaseddin.GoogLeNet(ghiaseddin.settings.googlenet_weights, augmentation)
+    elif extractor == 'vgg':
+        ext = ghiaseddin.VGG16(ghiaseddin.settings.vgg16_weights, augmentation)
+
+    model = ghiaseddin.MultiAttributeGhiaseddin(extractor=ext,
+                                                dataset=dataset,
+                                                weight_decay=1e-5,
+                                                optimizer=lasagne.updates.rmsprop,
+                                                ranker_learning_rate=1e-4,
+                                                extractor_learning_rate=0 if baseline else 1e-5,
+                                                ranker_nonlinearity=lasagne.nonlinearities.linear,
+                                                do_log=do_log)
+    if baseline:
+        model.NAME = "baseline|%s" % model.NAME
+
+    accuracies = []
+    for _ in range(epochs):
+        model.train_one_epoch()
+        accs = [acc * 100 for acc in model.eval_accuracy(all_pairs=all_pairs_eval)]
+        accuracies.append(accs)
+        sys.stdout.write("%s\n" % ' '.join("%2.4f" % acc for acc in accs))
+        sys.stdout.flush()
+    model.save()
+
+    # one accuracy file per attribute, like train.py writes
+    boltons.fileutils.mkdir_p(ghiaseddin.settings.result_models_root)
+    for ai, attribute in enumerate(dataset._ATT_NAMES):
+        with(open(os.path.join(ghiaseddin.settings.result_models_root, 'acc|%s|%s' % (attribute, model._model_name_with_iter())), 'w')) as f:
+            f.write('\n'.join(["%2.4f" % accs[ai] for accs in accuracies]))
+            f.write('\n')
+
+    toc = dt.now()
+    print 'Took: %s' % (str(toc - tic))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Runs many experiments (e.g. all the attributes and splits of a dataset) in one process, building and compiling each model only once.
+
+Building an extractor reads its weights file and building a `Ghiaseddin` compiles its theano functions, which takes minutes for the
+big extractors. A `Session` keeps the models it has built, keyed by their signature: the extractor class, its weights file and
+augmentation and the arguments of `Ghiaseddin`. When a model with the same signature is asked for again, the built one is reset to the
+state it had right after it was built (parameters, optimizer state, random states) and switched to the new dataset.
+"""
+from collections import OrderedDict
+from ranker import Ghiaseddin
+
+
+class Session(object):
+    """
+    Example Usage:
+    >>> session = Session()
+    >>> for attribute in range(4):
+    >>>     for split in range(10):
+    >>>         dataset = Zappos50K1(settings.zappos_root, attribute_index=attribute, split_index=split)
+    >>>         model = session.model(VGG16, dataset, weights=settings.vgg16_weights, extractor_learning_rate=1e-5)
+    >>>         model.train_n_epoch(10)
+    >>>         print model.eval_accuracy()
+
+    Only one model of a signature exists, so the model returned by `model` is only valid until the next call with the same signature.
+    """
+
+    def __init__(self):
+        self._models = OrderedDict()
+        self._initial_states = {}
+
+    @staticmethod
+    def _signature(extractor_class, weights, augmentation, kwargs):
+        return (extractor_class, weights, augmentation, tuple(sorted(kwargs.items())))
+
+    def model(self, extractor_class, dataset, weights=None, augmentation=False, feature_store=None, **kwargs):
+        """
+        Returns a `Ghiaseddin(extractor_class(weights, augmentation), dataset, feature_store=feature_store, **kwargs)` in its initial
+        state, which is only built the first time it is asked for.
+        """
+        signature = self._signature(extractor_class, weights, augmentation, kwargs)
+        if signature not in self._models:
+            model = Ghiaseddin(extractor_class(weights, augmentation), dataset, feature_store=feature_store, **kwargs)
+            self._models[signature] = model
+            self._initial_states[signature] = model.get_state()
+            return model
+
+        model = self._models[signature]
+        model.set_state(self._initial_states[signature])
+        model.set_dataset(dataset, feature_store)
+        return model
+
+    def __len__(self):
+        return len(self._models)
+
+    def clear(self):
+        """
+        Forgets all the built models, to free their memory.
+        """
+        self._models.clear()
+        self._initial_states.clear()
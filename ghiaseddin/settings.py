@@ -4,6 +4,11 @@ import numpy as np
 import lasagne
 
 RANDOM_SEED = 0
+# the budget of the in-memory cache of decoded and resized images (`utils.image_cache`), 0 disables the cache
+# each process has its own cache, with `augmentation_workers` the budget is split evenly between the main process and the workers
+IMAGE_CACHE_BYTES = 2 * 1024 ** 3
+# whether the datasets store the arrays parsed from their annotation files and load them from there later, see `indexes.py`
+CACHE_DATASET_INDEXES = True
 np.random.seed(RANDOM_SEED)
 lasagne.random.set_rng(np.random)
 
@@ -27,8 +32,18 @@ _osr_pubfig_root = os.path.join(dataset_root, 'OSR-PubFig')
 osr_root = os.path.join(_osr_pubfig_root, 'relative_attributes', 'osr')
 pubfig_root = os.path.join(_osr_pubfig_root, 'relative_attributes', 'pubfig')
 
+# packed image shards of the datasets, see `shards.py`
+shard_root = os.path.join(data_root, 'shards')
+# cached indexes of the datasets, see `indexes.py`
+index_root = os.path.join(data_root, 'indexes')
+# stored extractor outputs, see `features.py`
+feature_root = os.path.join(data_root, 'features')
+
 boltons.fileutils.mkdir_p(model_root)
 boltons.fileutils.mkdir_p(result_models_root)
 boltons.fileutils.mkdir_p(zappos_root)
 boltons.fileutils.mkdir_p(lfw10_root)
 boltons.fileutils.mkdir_p(_osr_pubfig_root)
+boltons.fileutils.mkdir_p(shard_root)
+boltons.fileutils.mkdir_p(index_root)
+boltons.fileutils.mkdir_p(feature_root)
@@ -0,0 +1,107 @@
+"""
+Packed image shards: all the images of a dataset, decoded and resized to the input size of an extractor, stored in a single uint8 file.
+
+A shard is made of two files:
+    - `<name>.npy`: a (n x h x w x 3) uint8 array in the numpy format, which is read with a memory map.
+    - `<name>-index.npz`: the address of each image (the same as `Dataset._image_addresses`) and whether it could be packed.
+
+Reading an image from a shard is a slice of the memory map, without opening or decoding any file.
+"""
+import os
+import sys
+import numpy as np
+import settings
+import utils
+
+
+def shard_path(dataset, extractor, root=None):
+    """
+    Returns the path of the shard of `dataset` at the input size of `extractor` (without the extension).
+    All the attributes (and splits) of a dataset share the same images, so they share the shard.
+    """
+    if root is None:
+        root = settings.shard_root
+    name = "%s-%dx%d" % (dataset.__class__.__name__, extractor._input_height, extractor._input_width)
+    return os.path.join(root, name)
+
+
+def _images_path(path):
+    return "%s.npy" % path
+
+
+def _index_path(path):
+    return "%s-index.npz" % path
+
+
+def pack_images(image_addresses, path, new_dims, verbose=False):
+    """
+    Decodes and resizes all of `image_addresses` to `new_dims` and packs them into the shard at `path`.
+    Images which can not be read are left as zeros and are marked as missing in the index.
+    """
+    images = np.lib.format.open_memmap(_images_path(path), mode='w+', dtype=np.uint8,
+                                       shape=(len(image_addresses), new_dims[0], new_dims[1], 3))
+    valid = np.zeros((len(image_addresses),), dtype=np.bool)
+    for i, image_addr in enumerate(image_addresses):
+        try:
+            images[i, ...] = utils.decode_resized_image(image_addr, new_dims)
+            valid[i] = True
+        except (IOError, ValueError):
+            if verbose:
+                sys.stdout.write('could not read %s\n' % image_addr)
+        if verbose and (i + 1) % 1000 == 0:
+            sys.stdout.write('%d / %d\n' % (i + 1, len(image_addresses)))
+            sys.stdout.flush()
+    images.flush()
+    del images
+
+    # the index is written last, a shard without an index is incomplete
+    np.savez(_index_path(path), addresses=np.array(image_addresses), valid=valid)
+
+
+def pack_dataset(dataset, extractor, root=None, verbose=False):
+    path = shard_path(dataset, extractor, root)
+    pack_images(dataset._image_addresses, path, (extractor._input_height, extractor._input_width), verbose)
+    return path
+
+
+def open_shard(dataset, extractor, root=None):
+    """
+    Returns the `ImageShard` of `dataset` for `extractor`, or `None` if it has not been packed.
+    """
+    path = shard_path(dataset, extractor, root)
+    if not os.path.exists(_index_path(path)):
+        return None
+    return ImageShard(path)
+
+
+class ImageShard(object):
+    """
+    Reads the images of a packed shard through a memory map. Images are looked up by address (`get`) or by row (`[]`).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.images = np.load(_images_path(path), mmap_mode='r')
+        with np.load(_index_path(path)) as index:
+            self.addresses = list(index['addresses'])
+            valid = index['valid']
+        self._rows = dict((address, i) for i, address in enumerate(self.addresses) if valid[i])
+
+    @property
+    def image_dims(self):
+        return self.images.shape[1:3]
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def __contains__(self, image_addr):
+        return image_addr in self._rows
+
+    def __getitem__(self, row):
+        return self.images[row]
+
+    def get(self, image_addr):
+        """
+        Returns the (h x w x 3) uint8 image at `image_addr` as a read-only view on the shard.
+        """
+        return self.images[self._rows[image_addr]]
@@ -1,10 +1,19 @@
 import skimage
 import skimage.io
 import numpy as np
-from scipy.ndimage import zoom
+import threading
+import hashlib
+from collections import OrderedDict
+from scipy.ndimage import zoom, affine_transform
+import scipy.special
 from skimage.transform import resize
 import matplotlib.pylab as plt
 import keras_image_preprocessing
+import settings
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 # The following two function are borrowed from Caffe
 # https://github.com/BVLC/caffe/blob/32dc03f14c36d1df46f37a7d13ad528e52c6f786/python/caffe/io.py#L278-L337
@@ -47,6 +56,8 @@ def resize_image(im, new_dims, interp_order=1):
     -------
     im : resized ndarray with shape (new_dims[0], new_dims[1], K)
     """
+    if tuple(im.shape[:2]) == tuple(new_dims):
+        return im.astype(np.float32)
     if im.shape[-1] == 1 or im.shape[-1] == 3:
         im_min, im_max = im.min(), im.max()
         if im_max > im_min:
@@ -68,6 +79,234 @@ def resize_image(im, new_dims, interp_order=1):
     return resized_im.astype(np.float32)
 
 
+class ImageCache(object):
+    """
+    A least recently used cache of decoded images, which are stored already resized and as compact uint8 arrays.
+
+    Images are keyed by their path and the size they are resized to, and the cache holds at most `max_bytes` bytes of images, evicting
+    the least recently used ones when it is full. The number of hits, misses and evictions are counted for `stats`.
+    It is safe to use from several threads, but each worker process has its own copy (see `pipeline.SharedMemoryPreprocessor`).
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, filename, new_dims):
+        """
+        Returns the image at `filename` resized to `new_dims` as a read-only (H x W x 3) uint8 array, decoding it if it is not cached.
+        """
+        key = (filename, tuple(new_dims))
+        with self._lock:
+            img = self._images.pop(key, None)
+            if img is not None:
+                # put it back as the most recently used one
+                self._images[key] = img
+                self.hits += 1
+                return img
+            self.misses += 1
+
+        img = decode_resized_image(filename, new_dims)
+        img.flags.writeable = False
+        if img.nbytes > self.max_bytes:
+            return img
+
+        with self._lock:
+            if key not in self._images:
+                self._images[key] = img
+                self.current_bytes += img.nbytes
+            self._evict()
+        return img
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes:
+            _, evicted = self._images.popitem(last=False)
+            self.current_bytes -= evicted.nbytes
+            self.evictions += 1
+
+    def set_max_bytes(self, max_bytes):
+        """
+        Changes the budget of the cache, evicting the least recently used images which do not fit any more.
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'images': len(self._images), 'bytes': self.current_bytes}
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.current_bytes = 0
+
+
+def load_image_uint8(filename, min_dims=None):
+    """
+    Loads an image as a (H x W x 3) uint8 RGB array, without converting it to float.
+    If `min_dims` is given and the image is a JPEG, the decoder scales it down by 1/2, 1/4 or 1/8 in the DCT domain (PIL's
+    `Image.draft`), to the smallest of these sizes which is still at least `min_dims`. Decoding at a reduced size is much cheaper
+    than decoding the full image and resizing it afterwards.
+    """
+    img = Image.open(filename)
+    if min_dims is not None and img.format == 'JPEG':
+        img.draft('RGB', (min_dims[1], min_dims[0]))
+    return np.asarray(img.convert('RGB'))
+
+
+def decode_resized_image(filename, new_dims):
+    """
+    Decodes an image and resizes it to `new_dims`, returning a (H x W x 3) uint8 array.
+    With PIL the image stays uint8 all the way, JPEGs are decoded at a reduced size (see `load_image_uint8`) and then resized
+    with bilinear interpolation. Without PIL it falls back to `load_image` and `resize_image`.
+    """
+    if Image is None:
+        img = resize_image(load_image(filename), new_dims)
+        return np.clip(img * 255 + 0.5, 0, 255).astype(np.uint8)
+
+    img = load_image_uint8(filename, new_dims)
+    if img.shape[:2] == tuple(new_dims):
+        return img
+    return np.asarray(Image.fromarray(img).resize((new_dims[1], new_dims[0]), Image.BILINEAR))
+
+
+image_cache = ImageCache(settings.IMAGE_CACHE_BYTES)
+
+
+def load_resized_image(filename, new_dims):
+    """
+    Loads an image resized to `new_dims` as a read-only (H x W x 3) uint8 array, through `image_cache`.
+    """
+    return image_cache.get(filename, new_dims)
+
+
+def file_hash(filename, block_size=2 ** 20):
+    """
+    Returns the md5 hex digest of the content of a file.
+    """
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def _count_inversions(values):
+    """
+    Counts the pairs i < j for which values[i] > values[j] in O(n log n).
+
+    This is a most significant bit first radix sort of the dense ranks of `values`: at each bit, the items are stably grouped by the
+    higher bits of their ranks and an inversion is a one followed by a zero within a group, as the pair first differs at this bit.
+    Each bit takes O(n) vectorized operations and there are O(log n) bits.
+    """
+    ranks = np.unique(values, return_inverse=True)[1].astype(np.int64)
+    n = len(ranks)
+    inversions = 0
+    positions = np.arange(n)
+    for bit in reversed(range(int(ranks.max()).bit_length() if n else 0)):
+        ones = (ranks >> bit) & 1
+        # the items are stably sorted by the higher bits, so each group is contiguous
+        higher = ranks >> (bit + 1)
+        is_start = np.concatenate([[True], higher[1:] != higher[:-1]])
+        starts = np.flatnonzero(is_start)
+        group = np.cumsum(is_start) - 1
+        ones_before = np.cumsum(ones) - ones
+        ones_before -= ones_before[starts][group]
+        inversions += np.sum(ones_before[ones == 0])
+        # stably move the zeros of each group before its ones
+        zeros_in_group = np.diff(np.append(starts, n)) - np.add.reduceat(ones, starts)
+        zeros_before = positions - starts[group] - ones_before
+        target = starts[group] + np.where(ones == 1, zeros_in_group[group] + ones_before, zeros_before)
+        sorted_ranks = np.empty_like(ranks)
+        sorted_ranks[target] = ranks
+        ranks = sorted_ranks
+    return int(inversions)
+
+
+def _count_tied_pairs(*keys):
+    """
+    Counts the pairs of items which are equal in all of `keys`.
+    """
+    order = np.lexsort(keys)
+    sorted_keys = np.array([k[order] for k in keys])
+    boundaries = np.concatenate([[True], np.any(sorted_keys[:, 1:] != sorted_keys[:, :-1], axis=0), [True]])
+    group_sizes = np.diff(np.where(boundaries)[0]).astype(np.int64)
+    return int(np.sum(group_sizes * (group_sizes - 1) // 2))
+
+
+def pairwise_ranking_accuracy(scores, labels):
+    """
+    Computes the accuracy of `scores` on all the pairs of items, without building the pairs.
+
+    This gives the same result as creating the targets `(labels[i] == labels[j]) * 0.5 + (labels[i] > labels[j]) * 1.0`
+    and the predictions `(scores[i] == scores[j]) * 0.5 + (scores[i] > scores[j]) * 1.0` for all the pairs i < j and
+    counting the correct predictions on pairs with a target other than 0.5. Instead of the O(n^2) pairs, the wrongly
+    ordered pairs are counted as inversions in O(n log n).
+
+    Returns:
+        (correct, total) -- the number of correctly ordered pairs and the number of pairs with different labels
+    """
+    scores = np.asarray(scores).ravel()
+    labels = np.asarray(labels).ravel()
+    assert len(scores) == len(labels)
+    n = len(scores)
+
+    total = n * (n - 1) // 2 - _count_tied_pairs(labels)
+    # pairs with different labels but the same score are predicted as 0.5, which is always wrong
+    score_ties = _count_tied_pairs(scores) - _count_tied_pairs(scores, labels)
+    # after sorting by label and then score, an inversion in the scores is a pair ordered the wrong way
+    order = np.lexsort((scores, labels))
+    wrong_order = _count_inversions(scores[order])
+
+    return total - score_ties - wrong_order, total
+
+
+def pairwise_logistic_objective(features, left, right, targets, weight_decay):
+    """
+    Returns the functions `loss_and_gradient(w)` and `hessian_product(w, v)` of the ranking loss of a linear ranker with weights `w` on
+    the rows of `features`: the mean binary cross entropy of sigmoid(features[left] . w - features[right] . w) with `targets` plus
+    `weight_decay * |w|^2`.
+
+    The features are only projected once per row on `w` (or on the direction `v`), and the gradients of the pairs are summed back per
+    row with `np.bincount`, so the (pairs x features) differences are never built.
+    """
+    num_pairs = len(targets)
+    num_rows = len(features)
+
+    def row_sums(pair_values):
+        # the sum of the values of the pairs for each row, positive on the left and negative on the right
+        return np.bincount(left, pair_values, num_rows) - np.bincount(right, pair_values, num_rows)
+
+    def project(w):
+        # in the type of the features (e.g. float32), to avoid a float64 copy of the feature matrix
+        return features.dot(w.astype(features.dtype)).astype(np.float64)
+
+    def posteriors(w):
+        differences = project(w)
+        differences = differences[left] - differences[right]
+        return differences, scipy.special.expit(differences)
+
+    def loss_and_gradient(w):
+        differences, p = posteriors(w)
+        xent = np.mean(np.logaddexp(0, differences) - targets * differences)
+        gradient = features.T.dot(row_sums((p - targets) / num_pairs).astype(features.dtype)).astype(np.float64)
+        return xent + weight_decay * w.dot(w), gradient + 2 * weight_decay * w
+
+    def hessian_product(w, v):
+        _, p = posteriors(w)
+        directions = project(v)
+        curvature = p * (1 - p) / num_pairs * (directions[left] - directions[right])
+        return features.T.dot(row_sums(curvature).astype(features.dtype)).astype(np.float64) + 2 * weight_decay * v
+
+    return loss_and_gradient, hessian_product
+
+
 def convert_estimates_on_test_to_matrix(predictions, height=10):
     predictions = np.reshape(predictions, (-1, 1)).T
     predictions = np.resize(predictions, (height, predictions.shape[1]))
@@ -109,3 +348,76 @@ def random_augmentation(img):
     img = _random_zoom(img)
     img = _random_rotate(img)
     return img
+
+
+def _random_augmentation_matrix(h, w):
+    """
+    Returns the (3 x 3) affine matrix of the random flip, zoom and rotation of `random_augmentation` for an (h x w) image.
+    The matrix maps (row, col, 1) coordinates of the augmented image to coordinates of the original image, like `apply_transform`.
+    The random numbers are drawn in the same order and from the same distributions as `random_augmentation`.
+    """
+    flip_matrix = np.eye(3)
+    if np.random.rand() > 0.5:
+        flip_matrix = np.array([[1, 0, 0],
+                                [0, -1, w - 1],
+                                [0, 0, 1]])
+
+    zx, zy = np.random.uniform(0.65, 0.6, 2)
+    zoom_matrix = np.array([[zx, 0, 0],
+                            [0, zy, 0],
+                            [0, 0, 1]])
+
+    theta = np.pi / 180 * np.random.uniform(-20, 20)
+    rotation_matrix = np.array([[np.cos(theta), -np.sin(theta), 0],
+                                [np.sin(theta), np.cos(theta), 0],
+                                [0, 0, 1]])
+
+    zoom_matrix = keras_image_preprocessing.transform_matrix_offset_center(zoom_matrix, h, w)
+    rotation_matrix = keras_image_preprocessing.transform_matrix_offset_center(rotation_matrix, h, w)
+    # the flip is applied first, then the zoom and then the rotation, each one maps its output to its input
+    return np.dot(np.dot(flip_matrix, zoom_matrix), rotation_matrix)
+
+
+def _resize_matrix(old_dims, new_dims):
+    """
+    Returns the (3 x 3) affine matrix which maps coordinates of an image resized to `new_dims` to coordinates of the `old_dims` image,
+    with pixel centers aligned like `resize_image`.
+    """
+    scale_h = float(old_dims[0]) / new_dims[0]
+    scale_w = float(old_dims[1]) / new_dims[1]
+    return np.array([[scale_h, 0, 0.5 * scale_h - 0.5],
+                     [0, scale_w, 0.5 * scale_w - 0.5],
+                     [0, 0, 1]])
+
+
+def warp_image(im, matrix, new_dims, interp_order=1):
+    """
+    Warps an image with an affine matrix straight to the new dimensions, in a single interpolation pass over all the channels.
+    Parameters
+    ----------
+    im : (H x W x K) ndarray
+    matrix : (3 x 3) affine matrix mapping (row, col, 1) coordinates of the output to coordinates of `im`.
+    new_dims : (height, width) tuple of output dimensions.
+    interp_order : interpolation order, default is linear.
+    Returns
+    -------
+    im : warped ndarray with shape (new_dims[0], new_dims[1], K)
+    """
+    # the channel axis is mapped to itself, so channels never get mixed
+    channel_matrix = np.eye(3)
+    channel_matrix[:2, :2] = matrix[:2, :2]
+    offset = (matrix[0, 2], matrix[1, 2], 0)
+    output_shape = (new_dims[0], new_dims[1], im.shape[2])
+    return affine_transform(im, channel_matrix, offset=offset, output_shape=output_shape,
+                            order=interp_order, mode='nearest').astype(np.float32)
+
+
+def random_augmentation_resized(img, new_dims, interp_order=0):
+    """
+    Same as `resize_image(random_augmentation(img), new_dims)` but the flip, zoom, rotation and resize are composed into a single
+    affine matrix and applied in one interpolation pass at the output resolution.
+    The default `interp_order` is nearest neighbour, like the flip, zoom and rotation of `random_augmentation`.
+    """
+    h, w = img.shape[:2]
+    matrix = np.dot(_random_augmentation_matrix(h, w), _resize_matrix((h, w), new_dims))
+    return warp_image(img, matrix, new_dims, interp_order=interp_order)
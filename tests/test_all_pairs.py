@@ -0,0 +1,53 @@
+import itertools
+import os
+import sys
+import unittest
+import matplotlib
+matplotlib.use('Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'ghiaseddin'))
+import numpy as np
+import datasets
+
+
+class AllPairsTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.image_ids = np.sort(random_state.choice(1000, size=37, replace=False))
+        self.labels = random_state.randint(0, 4, size=37)
+        self.pairs = datasets.AllPairs(self.image_ids, self.labels)
+        self.expected_pairs = np.array(list(itertools.combinations(self.image_ids, 2)))
+        self.expected_targets = np.array([(li == lj) * 0.5 + (li > lj) * 1.0
+                                          for li, lj in itertools.combinations(self.labels, 2)], dtype=np.float32)
+
+    def test_same_as_combinations(self):
+        self.assertEqual(len(self.pairs), len(self.expected_pairs))
+        self.assertEqual(self.pairs.shape, self.expected_pairs.shape)
+        np.testing.assert_array_equal(np.asarray(self.pairs), self.expected_pairs)
+        np.testing.assert_array_equal(np.asarray(self.pairs.targets), self.expected_targets)
+
+    def test_indexing(self):
+        ks = np.array([0, 5, 35, 36, 100, len(self.pairs) - 1])
+        np.testing.assert_array_equal(self.pairs[ks], self.expected_pairs[ks])
+        np.testing.assert_array_equal(self.pairs[100:200], self.expected_pairs[100:200])
+        np.testing.assert_array_equal(self.pairs[-1], self.expected_pairs[-1])
+        for k in ks:
+            np.testing.assert_array_equal(self.pairs[k, :], self.expected_pairs[k, :])
+            self.assertEqual(self.pairs[k, 0], self.expected_pairs[k, 0])
+            self.assertEqual(self.pairs.targets[k], self.expected_targets[k])
+        np.testing.assert_array_equal(self.pairs.targets[ks], self.expected_targets[ks])
+
+    def test_pair_ids_inverts_positions(self):
+        all_ids = np.arange(len(self.pairs))
+        i, j = self.pairs._positions(all_ids)
+        self.assertTrue(np.all(i < j))
+        np.testing.assert_array_equal(self.pairs.pair_ids(i, j), all_ids)
+
+    def test_permutation(self):
+        permutation = self.pairs.permutation(seed=3)
+        np.testing.assert_array_equal(np.sort(permutation[:]), np.arange(len(self.pairs)))
+        np.testing.assert_array_equal(self.pairs.permutation(seed=3)[:], permutation[:])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import sys
+import shutil
+import pickle
+import tempfile
+import unittest
+import matplotlib
+matplotlib.use('Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'ghiaseddin'))
+import numpy as np
+import lasagne
+import checkpoints
+
+
+class TinyExtractor(object):
+    """
+    A network with the weights interface of `extractors.Extractor`: the pretrained values are under 'param values' of a pickle.
+    """
+
+    def __init__(self, weights):
+        self.weights = weights
+        self.num_weight_reads = 0
+        input_layer = lasagne.layers.InputLayer((None, 6))
+        self.out_layer = lasagne.layers.DenseLayer(input_layer, num_units=4)
+
+    def _get_weights_from_file(self, file_addr, weights_key):
+        self.num_weight_reads += 1
+        with open(file_addr, 'rb') as f:
+            return pickle.load(f)[weights_key]
+
+    def get_output_layer(self):
+        return self.out_layer
+
+
+class CheckpointsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        random_state = np.random.RandomState(0)
+        self.pretrained = [random_state.randn(6, 4).astype(np.float32), random_state.randn(4).astype(np.float32)]
+        self.weights = os.path.join(self.root, 'weights.pkl')
+        with open(self.weights, 'wb') as f:
+            pickle.dump({'param values': self.pretrained}, f)
+        self.extractor = TinyExtractor(self.weights)
+        self.ranker = [random_state.randn(4, 1).astype(np.float32), random_state.randn(1).astype(np.float32)]
+        self.path = os.path.join(self.root, 'checkpoint.npz')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def assertValuesEqual(self, values, expected):
+        self.assertEqual(len(values), len(expected))
+        for value, expected_value in zip(values, expected):
+            np.testing.assert_array_equal(value, expected_value)
+
+    def stored_params(self):
+        with np.load(self.path) as data:
+            return sorted(key for key in data.files if key.startswith('param'))
+
+    def test_frozen_extractor(self):
+        values = [value.copy() for value in self.pretrained] + self.ranker
+        checkpoints.save_checkpoint(self.path, values, self.extractor)
+        # only the ranker is stored
+        self.assertEqual(self.stored_params(), ['param_2', 'param_3'])
+        self.assertValuesEqual(checkpoints.load_checkpoint(self.path, self.extractor), values)
+
+    def test_fine_tuned_extractor(self):
+        values = [self.pretrained[0] + 1, self.pretrained[1].copy()] + self.ranker
+        checkpoints.save_checkpoint(self.path, values, self.extractor)
+        self.assertEqual(self.stored_params(), ['param_0', 'param_2', 'param_3'])
+        self.assertValuesEqual(checkpoints.load_checkpoint(self.path, self.extractor), values)
+
+    def test_full(self):
+        values = self.pretrained + self.ranker
+        checkpoints.save_checkpoint(self.path, values, self.extractor, full=True)
+        self.assertEqual(self.stored_params(), ['params'])
+        self.assertValuesEqual(checkpoints.load_checkpoint(self.path, TinyExtractor(None)), values)
+
+    def test_legacy_params(self):
+        values = [self.pretrained[0] + 1, self.pretrained[1]] + self.ranker
+        np.savez(self.path, params=values)
+        self.assertValuesEqual(checkpoints.load_checkpoint(self.path, self.extractor), values)
+
+    def test_without_weights_file(self):
+        values = self.pretrained + self.ranker
+        checkpoints.save_checkpoint(self.path, values, TinyExtractor(None))
+        self.assertEqual(self.stored_params(), ['params'])
+        self.assertValuesEqual(checkpoints.load_checkpoint(self.path, self.extractor), values)
+
+    def test_other_weights_file(self):
+        checkpoints.save_checkpoint(self.path, self.pretrained + self.ranker, self.extractor)
+        other_weights = os.path.join(self.root, 'other.pkl')
+        with open(other_weights, 'wb') as f:
+            pickle.dump({'param values': [value + 1 for value in self.pretrained]}, f)
+        with self.assertRaises(Exception):
+            checkpoints.load_checkpoint(self.path, TinyExtractor(other_weights))
+        with self.assertRaises(Exception):
+            checkpoints.load_checkpoint(self.path, TinyExtractor(None))
+
+    def test_reads_the_weights_once(self):
+        for i in range(3):
+            checkpoints.save_checkpoint(self.path, self.pretrained + [value + i for value in self.ranker], self.extractor)
+        self.assertEqual(self.extractor.num_weight_reads, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
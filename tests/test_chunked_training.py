@@ -0,0 +1,96 @@
+import os
+import sys
+import unittest
+import matplotlib
+matplotlib.use('Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'ghiaseddin'))
+import numpy as np
+import lasagne
+import datasets
+import ranker
+
+NUM_IMAGES = 30
+
+
+class TinyExtractor(object):
+    """
+    A small frozen network with the interface of `extractors.Extractor`, which only runs on the CPU. The preprocessed image of an
+    image address is a fixed random array.
+    """
+    INPUT_LAYER_NAME = 'input'
+    _input_height = 8
+    _input_width = 8
+    out_layer_dim = 5
+
+    def __init__(self):
+        self.weights = None
+        self.augmentation = False
+        self.net = {}
+        self.net['input'] = lasagne.layers.InputLayer((None, 3, 8, 8))
+        self.net['conv1'] = lasagne.layers.Conv2DLayer(self.net['input'], 4, 3, pad=1)
+        self.net['pool1'] = lasagne.layers.MaxPool2DLayer(self.net['conv1'], 2)
+        self.net['fc'] = lasagne.layers.DenseLayer(self.net['pool1'], num_units=5)
+        self.out_layer = self.net['fc']
+        self._images = np.random.RandomState(1).rand(NUM_IMAGES, 3, 8, 8).astype(np.float32)
+
+    def set_input_var(self, input_var, batch_size=None):
+        self.net['input'].input_var = input_var
+        self.net['input'].shape = (batch_size, 3, 8, 8)
+
+    def get_output_layer(self):
+        return self.out_layer
+
+    def get_frozen_feature_layer(self):
+        return self.out_layer
+
+    def preprocess_images(self, image_addresses, out=None, augmentation=False):
+        images = self._images[[int(address) for address in image_addresses]]
+        if out is None:
+            return images
+        out[:len(images)] = images
+        return out[:len(images)]
+
+
+class TinyDataset(datasets.Dataset):
+    _ATT_NAMES = ['a']
+
+    def __init__(self):
+        super(TinyDataset, self).__init__(None, 0)
+        random_state = np.random.RandomState(2)
+        self._image_addresses = [str(i) for i in range(NUM_IMAGES)]
+        labels = random_state.randint(0, 4, size=NUM_IMAGES)
+        self._train_pairs = random_state.randint(0, NUM_IMAGES, size=(70, 2))
+        self._train_targets = ((labels[self._train_pairs[:, 0]] == labels[self._train_pairs[:, 1]]) * 0.5 +
+                               (labels[self._train_pairs[:, 0]] > labels[self._train_pairs[:, 1]]) * 1.0).astype(np.float32)
+        self._test_pairs = self._train_pairs[:10]
+        self._test_targets = self._train_targets[:10]
+
+
+class ChunkedTrainingTest(unittest.TestCase):
+
+    def model(self, chunk_batches):
+        lasagne.random.set_rng(np.random.RandomState(0))
+        return ranker.Ghiaseddin(TinyExtractor(), TinyDataset(), train_batch_size=4, extractor_learning_rate=0, do_log=False,
+                                 precompute_features=True, chunk_batches=chunk_batches)
+
+    def train(self, model, epochs):
+        np.random.seed(3)
+        return np.concatenate([model.train_one_epoch() for _ in range(epochs)])
+
+    def test_same_loss_as_unchunked(self):
+        unchunked = self.model(chunk_batches=0)
+        expected = self.train(unchunked, epochs=2)
+        # 17 batches per epoch, so the last chunk of an epoch is not full
+        for chunk_batches in [1, 3, 17, 40]:
+            model = self.model(chunk_batches)
+            losses = self.train(model, epochs=2)
+            self.assertIsNotNone(model.chunk_training_function)
+            self.assertEqual(len(losses), 34)
+            np.testing.assert_allclose(losses, expected, rtol=1e-5)
+            for param, expected_param in zip(lasagne.layers.get_all_param_values(model.absolute_rank_estimate),
+                                             lasagne.layers.get_all_param_values(unchunked.absolute_rank_estimate)):
+                np.testing.assert_allclose(param, expected_param, rtol=1e-5, atol=1e-7)
+
+
+if __name__ == '__main__':
+    unittest.main()
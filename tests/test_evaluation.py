@@ -0,0 +1,78 @@
+import os
+import sys
+import unittest
+import matplotlib
+matplotlib.use('Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'ghiaseddin'))
+import numpy as np
+import datasets
+import ranker
+
+
+class PairsDataset(datasets.Dataset):
+    _ATT_NAMES = ['attribute']
+
+    def __init__(self, pairs, targets):
+        super(PairsDataset, self).__init__(None, 0)
+        self._test_pairs = pairs
+        self._test_targets = targets
+
+
+def _model(dataset, scores):
+    # only the parts the evaluation needs, the rank estimates are looked up in `scores` instead of running the network
+    model = ranker.Ghiaseddin.__new__(ranker.Ghiaseddin)
+    model.dataset = dataset
+    model.debug = False
+    model._rank_estimates_for_images = lambda image_ids: scores[image_ids]
+    return model
+
+
+def _per_pair_evaluation(scores, pairs, targets):
+    """
+    The evaluation as it was done before, one pair at a time.
+    """
+    estimates = []
+    predictions = []
+    corrects = []
+    total = 0
+    correct = 0
+    for (left, right), target in zip(pairs, targets):
+        estimates.extend([scores[left], scores[right]])
+        prediction = (scores[left] == scores[right]) * 0.5 + (scores[left] > scores[right]) * 1
+        predictions.append(prediction)
+        if target == 0.5:
+            corrects.append(0.5)
+        else:
+            corrects.append(1 if prediction == target else 0)
+            total += 1
+            correct += prediction == target
+    return float(correct) / total, np.array(estimates), predictions, corrects
+
+
+class EvaluationTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        # few distinct scores and labels, so there are ties, and images which are not in any pair
+        self.scores = random_state.randint(0, 5, size=60).astype(np.float32)
+        labels = random_state.randint(0, 4, size=60)
+        self.pairs = random_state.choice(np.arange(5, 60, 2), size=(200, 2))
+        left = labels[self.pairs[:, 0]]
+        right = labels[self.pairs[:, 1]]
+        self.targets = ((left == right) * 0.5 + (left > right) * 1.0).astype(np.float32)
+        self.model = _model(PairsDataset(self.pairs, self.targets), self.scores)
+
+    def test_accuracy_is_the_same_as_per_pair(self):
+        accuracy = _per_pair_evaluation(self.scores, self.pairs, self.targets)[0]
+        self.assertEqual(self.model.eval_accuracy(), accuracy)
+
+    def test_estimates_predictions_corrects_are_the_same_as_per_pair(self):
+        _, estimates, predictions, corrects = _per_pair_evaluation(self.scores, self.pairs, self.targets)
+        model_estimates, model_predictions, model_corrects = self.model.estimates_predictions_corrects_on_test()
+        np.testing.assert_array_equal(model_estimates, estimates)
+        self.assertEqual(model_predictions, predictions)
+        self.assertEqual(model_corrects, corrects)
+
+
+if __name__ == '__main__':
+    unittest.main()
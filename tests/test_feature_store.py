@@ -0,0 +1,73 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import matplotlib
+matplotlib.use('Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'ghiaseddin'))
+import numpy as np
+import features
+
+
+class FeatureStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'store')
+        self.features = np.random.RandomState(0).randn(10, 3, 2).astype(np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_present_mask_round_trip(self):
+        store = features.FeatureStore(self.path, 10, (3, 2))
+        self.assertEqual(len(store), 10)
+        self.assertEqual(store.feature_shape, (3, 2))
+        np.testing.assert_array_equal(store.missing([4, 1, 1, 7]), [1, 4, 7])
+
+        store.put([1, 4], self.features[[1, 4]])
+        self.assertIn(1, store)
+        self.assertNotIn(7, store)
+        np.testing.assert_array_equal(store.missing([4, 1, 7]), [7])
+        np.testing.assert_array_equal(store.get([4, 1, 4]), self.features[[4, 1, 4]])
+        del store
+
+        # reopened, the features and the present mask are read back from the files
+        store = features.FeatureStore(self.path, 10, (3, 2))
+        np.testing.assert_array_equal(store.missing(np.arange(10)), [0, 2, 3, 5, 6, 7, 8, 9])
+        np.testing.assert_array_equal(store.get([1, 4]), self.features[[1, 4]])
+        store.put(store.missing(np.arange(10)), self.features[store.missing(np.arange(10))])
+        self.assertEqual(len(store.missing(np.arange(10))), 0)
+        np.testing.assert_array_equal(store.get(np.arange(10)), self.features)
+
+    def test_get_missing_features(self):
+        store = features.FeatureStore(self.path, 10, (3, 2))
+        store.put([2], self.features[[2]])
+        with self.assertRaises(AssertionError):
+            store.get([2, 3])
+
+    def test_float16(self):
+        store = features.FeatureStore(self.path, 10, (3, 2), dtype=np.float16)
+        store.put(np.arange(10), self.features)
+        result = features.FeatureStore(self.path, 10, (3, 2), dtype=np.float16).get(np.arange(10))
+        self.assertEqual(result.dtype, np.float32)
+        np.testing.assert_allclose(result, self.features, rtol=1e-3, atol=1e-3)
+
+    def test_variants(self):
+        variant_features = np.random.RandomState(1).randn(10, 4, 3).astype(np.float32)
+        store = features.FeatureStore(self.path, 10, (4, 3))
+        store.put(np.arange(10), variant_features)
+        variants = np.array([0, 3, 1])
+        np.testing.assert_array_equal(store.get([5, 5, 9], variants), variant_features[[5, 5, 9], variants])
+
+    def test_reopened_with_another_shape(self):
+        features.FeatureStore(self.path, 10, (3, 2))
+        with self.assertRaises(Exception):
+            features.FeatureStore(self.path, 10, (3, 3))
+        with self.assertRaises(Exception):
+            features.FeatureStore(self.path, 10, (3, 2), dtype=np.float16)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import matplotlib
+matplotlib.use('Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'ghiaseddin'))
+import numpy as np
+import skimage.io
+import utils
+
+DIMS = (4, 5)
+IMAGE_BYTES = DIMS[0] * DIMS[1] * 3
+
+
+class ImageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        random_state = np.random.RandomState(0)
+        self.filenames = []
+        for i in range(4):
+            filename = os.path.join(self.directory, '%d.png' % i)
+            skimage.io.imsave(filename, random_state.randint(0, 256, (8, 10, 3)).astype(np.uint8))
+            self.filenames.append(filename)
+        self.cache = utils.ImageCache(3 * IMAGE_BYTES)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertStats(self, hits, misses, evictions, images):
+        self.assertEqual(self.cache.stats(), {'hits': hits, 'misses': misses, 'evictions': evictions,
+                                              'images': images, 'bytes': images * IMAGE_BYTES})
+
+    def cached(self):
+        return [filename for filename, _ in self.cache._images.keys()]
+
+    def test_hits_and_misses(self):
+        img = self.cache.get(self.filenames[0], DIMS)
+        self.assertEqual(img.shape, DIMS + (3,))
+        self.assertEqual(img.dtype, np.uint8)
+        self.assertFalse(img.flags.writeable)
+        np.testing.assert_array_equal(img, utils.decode_resized_image(self.filenames[0], DIMS))
+        self.assertStats(hits=0, misses=1, evictions=0, images=1)
+
+        self.assertIs(self.cache.get(self.filenames[0], DIMS), img)
+        self.assertStats(hits=1, misses=1, evictions=0, images=1)
+
+        # another size of the same image is another entry
+        self.cache.get(self.filenames[0], (2, 2))
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_evicts_least_recently_used(self):
+        for filename in self.filenames[:3]:
+            self.cache.get(filename, DIMS)
+        # a hit makes the first image the most recently used one, so the second is evicted next
+        self.cache.get(self.filenames[0], DIMS)
+        self.cache.get(self.filenames[3], DIMS)
+        self.assertEqual(self.cached(), [self.filenames[2], self.filenames[0], self.filenames[3]])
+        self.assertStats(hits=1, misses=4, evictions=1, images=3)
+
+        self.cache.get(self.filenames[1], DIMS)
+        self.assertEqual(self.cached(), [self.filenames[0], self.filenames[3], self.filenames[1]])
+        self.assertStats(hits=1, misses=5, evictions=2, images=3)
+
+    def test_set_max_bytes(self):
+        for filename in self.filenames[:3]:
+            self.cache.get(filename, DIMS)
+        self.cache.set_max_bytes(IMAGE_BYTES)
+        self.assertEqual(self.cached(), [self.filenames[2]])
+        self.assertStats(hits=0, misses=3, evictions=2, images=1)
+
+    def test_image_larger_than_the_cache(self):
+        self.cache.set_max_bytes(IMAGE_BYTES - 1)
+        self.cache.get(self.filenames[0], DIMS)
+        self.assertStats(hits=0, misses=1, evictions=0, images=0)
+
+    def test_clear(self):
+        self.cache.get(self.filenames[0], DIMS)
+        self.cache.clear()
+        self.assertEqual(self.cache.current_bytes, 0)
+        self.cache.get(self.filenames[0], DIMS)
+        self.assertEqual(self.cache.misses, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import matplotlib
+matplotlib.use('Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'ghiaseddin'))
+import numpy as np
+import settings
+import indexes
+import utils
+
+
+class CachedIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.source = os.path.join(self.root, 'annotations.txt')
+        with open(self.source, 'w') as f:
+            f.write('1 2 3\n')
+        self.num_builds = 0
+        self.cache_dataset_indexes = settings.CACHE_DATASET_INDEXES
+        settings.CACHE_DATASET_INDEXES = True
+
+    def tearDown(self):
+        settings.CACHE_DATASET_INDEXES = self.cache_dataset_indexes
+        shutil.rmtree(self.root)
+
+    def build(self):
+        self.num_builds += 1
+        with open(self.source) as f:
+            return {'values': np.array([int(v) for v in f.read().split()])}
+
+    def cached_index(self):
+        return indexes.cached_index('index', [self.source], self.build, root=self.root)
+
+    def meta(self):
+        with open(os.path.join(self.root, 'index', 'meta.json')) as f:
+            return json.load(f)
+
+    def change_meta(self, **changes):
+        meta = self.meta()
+        meta['sources'][0].update(changes)
+        indexes._write_meta(os.path.join(self.root, 'index'), meta)
+
+    def test_reused(self):
+        np.testing.assert_array_equal(self.cached_index()['values'], [1, 2, 3])
+        arrays = self.cached_index()
+        self.assertEqual(self.num_builds, 1)
+        self.assertIsInstance(arrays['values'], np.memmap)
+        np.testing.assert_array_equal(arrays['values'], [1, 2, 3])
+
+    def test_changed_source(self):
+        self.cached_index()
+        with open(self.source, 'w') as f:
+            f.write('4 5 6 7\n')
+        np.testing.assert_array_equal(self.cached_index()['values'], [4, 5, 6, 7])
+        self.assertEqual(self.num_builds, 2)
+
+    def test_changed_size(self):
+        self.cached_index()
+        self.change_meta(size=self.meta()['sources'][0]['size'] + 1)
+        self.cached_index()
+        self.assertEqual(self.num_builds, 2)
+
+    def test_changed_mtime_same_content(self):
+        self.cached_index()
+        mtime = self.meta()['sources'][0]['mtime']
+        self.change_meta(mtime=mtime - 100)
+        self.cached_index()
+        # the content is hashed again and is the same, so only the modification time is updated
+        self.assertEqual(self.num_builds, 1)
+        self.assertEqual(self.meta()['sources'][0]['mtime'], mtime)
+
+    def test_changed_mtime_and_md5(self):
+        self.cached_index()
+        self.change_meta(mtime=self.meta()['sources'][0]['mtime'] - 100, md5='0' * 32)
+        self.cached_index()
+        self.assertEqual(self.num_builds, 2)
+        self.assertEqual(self.meta()['sources'][0]['md5'], utils.file_hash(self.source))
+
+    def test_changed_md5_same_mtime(self):
+        self.cached_index()
+        # the hash is only checked when the modification time changed
+        self.change_meta(md5='0' * 32)
+        self.cached_index()
+        self.assertEqual(self.num_builds, 1)
+
+    def test_changed_version(self):
+        self.cached_index()
+        meta = self.meta()
+        meta['version'] = indexes.INDEX_VERSION + 1
+        indexes._write_meta(os.path.join(self.root, 'index'), meta)
+        self.cached_index()
+        self.assertEqual(self.num_builds, 2)
+        self.assertEqual(self.meta()['version'], indexes.INDEX_VERSION)
+
+    def test_disabled(self):
+        settings.CACHE_DATASET_INDEXES = False
+        self.cached_index()
+        self.cached_index()
+        self.assertEqual(self.num_builds, 2)
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'index')))
+
+
+if __name__ == '__main__':
+    unittest.main()
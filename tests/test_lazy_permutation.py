@@ -0,0 +1,34 @@
+import os
+import sys
+import unittest
+import matplotlib
+matplotlib.use('Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'ghiaseddin'))
+import numpy as np
+import datasets
+
+
+class LazyPermutationTest(unittest.TestCase):
+
+    def test_is_a_permutation(self):
+        for n in [1, 2, 3, 17, 1000, 1025]:
+            perm = datasets.LazyPermutation(n, np.random.RandomState(n))
+            self.assertEqual(sorted(perm[np.arange(n)]), range(n))
+
+    def test_scalar_lookup_matches_array_lookup(self):
+        # not a power of two, so some positions need cycle walking
+        n = 1000
+        perm = datasets.LazyPermutation(n, np.random.RandomState(0))
+        values = perm[np.arange(n)]
+        for i in range(n):
+            self.assertEqual(perm[i], values[i])
+            self.assertEqual(np.ndim(perm[i]), 0)
+
+    def test_slice_lookup(self):
+        perm = datasets.LazyPermutation(1000, np.random.RandomState(1))
+        np.testing.assert_array_equal(perm[100:200], perm[np.arange(100, 200)])
+        self.assertEqual(len(perm[990:2000]), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
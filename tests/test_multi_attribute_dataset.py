@@ -0,0 +1,81 @@
+import collections
+import os
+import sys
+import unittest
+import matplotlib
+matplotlib.use('Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'ghiaseddin'))
+import numpy as np
+import datasets
+
+IMAGE_ADDRESSES = ['%d.jpg' % i for i in range(12)]
+
+
+class PairsDataset(datasets.Dataset):
+    _ATT_NAMES = ['a', 'b', 'c']
+
+    def __init__(self, attribute_index, pairs, targets):
+        super(PairsDataset, self).__init__(None, attribute_index)
+        self._image_addresses = IMAGE_ADDRESSES
+        self._train_pairs = np.array(pairs)
+        self._train_targets = np.array(targets, dtype=np.float32)
+        self._test_pairs = self._train_pairs
+        self._test_targets = self._train_targets
+
+
+def _entries(pairs, targets, masks):
+    return collections.Counter((tuple(pair), attribute, target[attribute])
+                               for pair, target, mask in zip(pairs, targets, masks) for attribute in np.flatnonzero(mask))
+
+
+class MultiAttributeDatasetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.datasets = [PairsDataset(0, [[0, 1], [2, 3], [4, 5], [0, 1]], [1, 0, 0.5, 1]),
+                         PairsDataset(1, [[2, 3], [0, 1], [1, 0], [6, 7]], [1, 0.5, 0, 0]),
+                         # all the pairs of images 8, 9 and 10, like OSR and PubFig
+                         PairsDataset(2, [[8, 9], [8, 10], [9, 10], [0, 1]], [0, 1, 0.5, 0.5])]
+        self.dataset = datasets.MultiAttributeDataset(self.datasets)
+
+    def test_merges_identical_pairs(self):
+        pairs = [tuple(pair) for pair in self.dataset._train_pairs]
+        # (0, 1) is twice in the first attribute, so it is in two rows
+        self.assertEqual(sorted(pairs), [(0, 1), (0, 1), (1, 0), (2, 3), (4, 5), (6, 7), (8, 9), (8, 10), (9, 10)])
+        self.assertEqual(self.dataset._train_targets.shape, (9, 3))
+        self.assertEqual(self.dataset._train_target_mask.shape, (9, 3))
+
+        row = pairs.index((2, 3))
+        np.testing.assert_array_equal(self.dataset._train_target_mask[row], [1, 1, 0])
+        np.testing.assert_array_equal(self.dataset._train_targets[row, :2], [0, 1])
+
+        rows = [i for i, pair in enumerate(pairs) if pair == (0, 1)]
+        np.testing.assert_array_equal(np.sort(self.dataset._train_target_mask[rows].sum(axis=1)), [1, 3])
+
+    def test_keeps_all_the_annotations(self):
+        expected = collections.Counter()
+        for attribute, dataset in enumerate(self.datasets):
+            expected.update((tuple(pair), attribute, target) for pair, target in zip(dataset._train_pairs, dataset._train_targets))
+        self.assertEqual(_entries(self.dataset._train_pairs, self.dataset._train_targets, self.dataset._train_target_mask), expected)
+
+    def test_pair_target_mask(self):
+        mask = self.dataset.pair_target_mask([3, -1, 0])
+        self.assertEqual(mask.dtype, np.float32)
+        np.testing.assert_array_equal(mask[0], self.dataset._train_target_mask[3])
+        np.testing.assert_array_equal(mask[1], [0, 0, 0])
+        np.testing.assert_array_equal(mask[2], self.dataset._train_target_mask[0])
+
+    def test_batches(self):
+        batches = list(self.dataset.train_batches(batch_size=4, shuffle=True, cut_tail=False))
+        self.assertEqual(len(batches), 3)
+        pairs = np.concatenate([np.stack([batch.left, batch.right], axis=1)[batch.mask == 1] for batch in batches])
+        targets = np.concatenate([batch.targets[batch.mask == 1] for batch in batches])
+        masks = np.concatenate([self.dataset.pair_target_mask(batch.pair_ids)[batch.mask == 1] for batch in batches])
+        self.assertEqual(targets.shape, (9, 3))
+        self.assertEqual(_entries(pairs, targets, masks),
+                         _entries(self.dataset._train_pairs, self.dataset._train_targets, self.dataset._train_target_mask))
+        # the padding pairs of the last batch have no attribute
+        np.testing.assert_array_equal(self.dataset.pair_target_mask(batches[-1].pair_ids)[1:], np.zeros((3, 3)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import os
+import sys
+import unittest
+import matplotlib
+matplotlib.use('Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'ghiaseddin'))
+import numpy as np
+import scipy.special
+import lasagne
+import utils
+import ranker
+
+
+def _pair_difference_loss(features, left, right, targets, weight_decay, w):
+    """
+    The same loss on the explicit (pairs x features) differences.
+    """
+    differences = (features[left] - features[right]).dot(w)
+    p = np.clip(scipy.special.expit(differences), 1e-12, 1 - 1e-12)
+    return np.mean(-targets * np.log(p) - (1 - targets) * np.log(1 - p)) + weight_decay * w.dot(w)
+
+
+class PairwiseLogisticObjectiveTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.features = random_state.randn(30, 8)
+        pairs = random_state.randint(0, 30, size=(100, 2))
+        self.left = pairs[:, 0]
+        self.right = pairs[:, 1]
+        self.targets = random_state.choice([0, 0.5, 1], size=100)
+        self.weight_decay = 1e-2
+        self.w = random_state.randn(8) * 0.3
+        self.loss_and_gradient, self.hessian_product = utils.pairwise_logistic_objective(
+            self.features, self.left, self.right, self.targets, self.weight_decay)
+
+    def _loss(self, w):
+        return _pair_difference_loss(self.features, self.left, self.right, self.targets, self.weight_decay, w)
+
+    def test_loss(self):
+        self.assertAlmostEqual(self.loss_and_gradient(self.w)[0], self._loss(self.w), places=10)
+
+    def test_gradient(self):
+        _, gradient = self.loss_and_gradient(self.w)
+        eps = 1e-6
+        numeric = [(self._loss(self.w + eps * e) - self._loss(self.w - eps * e)) / (2 * eps) for e in np.eye(len(self.w))]
+        np.testing.assert_allclose(gradient, numeric, rtol=1e-5, atol=1e-8)
+
+    def test_hessian_product(self):
+        v = np.random.RandomState(1).randn(len(self.w))
+        eps = 1e-6
+        numeric = (self.loss_and_gradient(self.w + eps * v)[1] - self.loss_and_gradient(self.w - eps * v)[1]) / (2 * eps)
+        np.testing.assert_allclose(self.hessian_product(self.w, v), numeric, rtol=1e-5, atol=1e-8)
+
+
+
+class SolveRankerTest(unittest.TestCase):
+
+    def test_nonlinear_ranker(self):
+        for cls in [ranker.Ghiaseddin, ranker.MultiAttributeGhiaseddin]:
+            model = cls.__new__(cls)
+            model.ranker_nonlinearity = lasagne.nonlinearities.sigmoid
+            with self.assertRaises(ValueError):
+                model.solve_ranker()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import itertools
+import os
+import sys
+import unittest
+import matplotlib
+matplotlib.use('Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'ghiaseddin'))
+import numpy as np
+import utils
+
+
+def _brute_force_accuracy(scores, labels):
+    correct = 0
+    total = 0
+    for i, j in itertools.combinations(range(len(scores)), 2):
+        target = (labels[i] == labels[j]) * 0.5 + (labels[i] > labels[j]) * 1.0
+        prediction = (scores[i] == scores[j]) * 0.5 + (scores[i] > scores[j]) * 1.0
+        if target != 0.5:
+            total += 1
+            correct += prediction == target
+    return correct, total
+
+
+class PairwiseRankingAccuracyTest(unittest.TestCase):
+
+    def test_same_as_brute_force(self):
+        random_state = np.random.RandomState(0)
+        for n in [2, 3, 10, 57, 200]:
+            for num_scores in [3, 1000]:
+                scores = random_state.randint(0, num_scores, size=n).astype(np.float32)
+                labels = random_state.randint(0, 5, size=n)
+                self.assertEqual(utils.pairwise_ranking_accuracy(scores, labels), _brute_force_accuracy(scores, labels))
+
+    def test_count_inversions(self):
+        random_state = np.random.RandomState(1)
+        for n in [1, 2, 5, 64, 100]:
+            values = random_state.randint(0, 10, size=n)
+            expected = sum(values[i] > values[j] for i, j in itertools.combinations(range(n), 2))
+            self.assertEqual(utils._count_inversions(values), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
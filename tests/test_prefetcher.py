@@ -0,0 +1,65 @@
+import os
+import sys
+import time
+import unittest
+import matplotlib
+matplotlib.use('Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'ghiaseddin'))
+import numpy as np
+import pipeline
+
+
+def _slow_square(x):
+    # the items finish out of order with several workers
+    time.sleep(np.random.RandomState(x).uniform(0, 0.01))
+    return x * x
+
+
+class PrefetcherTest(unittest.TestCase):
+
+    def test_keeps_order(self):
+        for workers in [1, 4]:
+            with pipeline.Prefetcher(range(50), _slow_square, size=8, workers=workers) as results:
+                self.assertEqual(list(results), [x * x for x in range(50)])
+
+    def test_empty(self):
+        with pipeline.Prefetcher([], _slow_square, workers=2) as results:
+            self.assertEqual(list(results), [])
+
+    def test_reraises_function_exception(self):
+        def function(x):
+            if x == 7:
+                raise ValueError("bad item %d" % x)
+            return x
+
+        for workers in [1, 3]:
+            seen = []
+            with pipeline.Prefetcher(range(20), function, size=4, workers=workers) as results:
+                with self.assertRaisesRegexp(ValueError, "bad item 7"):
+                    for x in results:
+                        seen.append(x)
+            # the items before the failing one are still yielded, in order
+            self.assertEqual(seen, range(7))
+
+    def test_reraises_iterable_exception(self):
+        def items():
+            yield 0
+            yield 1
+            raise KeyError("broken iterable")
+
+        with pipeline.Prefetcher(items(), lambda x: x, workers=2) as results:
+            with self.assertRaises(KeyError):
+                list(results)
+
+    def test_close_before_the_end(self):
+        prefetcher = pipeline.Prefetcher(iter(range(1000)), lambda x: x, size=2, workers=2)
+        for x in prefetcher:
+            if x == 3:
+                break
+        prefetcher.close()
+        for thread in prefetcher._threads:
+            self.assertFalse(thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()